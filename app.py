@@ -1,16 +1,47 @@
-import os
-import logging
-import re
-import time
-import csv
-import io
-import html
-from flask import Flask, request, jsonify
-import requests
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения
-load_dotenv()
+import startup
+
+with startup.measure_import('stdlib'):
+    import os
+    import logging
+    import time
+    import csv
+    import itertools
+    import html
+    import threading
+    import hashlib
+    import json
+    from array import array
+    from collections import deque
+
+with startup.measure_import('flask'):
+    from flask import Flask, request, jsonify, g
+
+# Загружаем переменные окружения (до импорта модулей, читающих настройки).
+# На хостинге они уже заданы, поэтому python-dotenv импортируем, только если есть .env
+if os.path.exists('.env') or os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')):
+    with startup.measure_import('dotenv'):
+        from dotenv import load_dotenv
+        load_dotenv()
+
+# requests (в http_client) и google-auth (в gsheets) импортируются при первом запросе наружу,
+# long polling (update_poller) - только в этом режиме
+with startup.measure_import('app_modules'):
+    import http_client
+    import gsheets
+    from telegram_queue import OutboundDispatcher
+    from result_cache import ReplyCache, ResultCache
+    from popularity import SpaceSaving
+    from records import RECORD_FIELDS, Record, StringPool, make_record, memory_report, row_values
+    from rendering import extract_kic_info, MessageCache
+    from sheet_ingest import (INGEST_CHUNK_SIZE, CountingIterator, IngestTimer, detect_delimiter,
+                              detect_encoding, iter_decoded_lines, read_head)
+    from kic_index import KicIndex
+    from metrics import (Counter, Gauge, Histogram, SIZE_BUCKETS, finish_request_timing, render_metrics,
+                         stage, start_request_timing)
+    from sheet_diff import diff_records
+    from shared_snapshot import RefreshLock, SharedSnapshot, read_shared_version, write_shared_snapshot
+    from search_index import (TrigramIndex, PrefixIndex, FuzzyIndex, has_latin_letters, rank_matches,
+                              switch_keyboard_layout)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -26,13 +57,217 @@ GOOGLE_SHEET_GID = '1532223079'  # ID листа "Общий"
 # Формируем правильный URL для CSV экспорта
 PUBLIC_SHEET_URL = f"https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}/export?format=csv&gid={GOOGLE_SHEET_GID}"
 
+# Источники данных в порядке попыток:
+#   'csv'        - публичный CSV экспорт
+#   'sheets_api' - Google Sheets API (нужны GOOGLE_CREDENTIALS и google-auth)
+#   'mock'       - тестовые данные gsheets.MOCK_DATA, если нет ни свежих, ни сохраненных данных
+#                  (только для разработки, по умолчанию выключены)
+DATA_SOURCES = [name.strip() for name in os.environ.get('DATA_SOURCES', 'csv').split(',') if name.strip()]
+# Диапазоны для Sheets API через ';' - читаются одним запросом batchGet
+SHEETS_API_RANGES = [value.strip() for value in os.environ.get('SHEETS_API_RANGES', 'Общий!A:G').split(';')
+                     if value.strip()]
+
 # Кэширование данных
 data_cache = None
 cache_timestamp = 0
 CACHE_DURATION = 300  # 5 минут
 
-def get_google_sheet_data():
-    """Получение данных из Google Sheets через CSV экспорт"""
+# Режим обновления кэша:
+#   'background' - устаревшие данные отдаются сразу, а перезагрузка идет в фоновом потоке
+#   'sync'       - перезагрузка выполняется внутри запроса (старое поведение)
+CACHE_REFRESH_MODE = os.environ.get('CACHE_REFRESH_MODE', 'background')
+# Мягкий TTL: после него данные считаются устаревшими и обновляются в фоне
+CACHE_SOFT_TTL = int(os.environ.get('CACHE_SOFT_TTL', CACHE_DURATION))
+# Жесткий TTL: после него данные слишком старые, обновляем синхронно
+CACHE_HARD_TTL = int(os.environ.get('CACHE_HARD_TTL', 3600))
+# Пауза между повторными попытками после неудачного обновления
+CACHE_RETRY_INTERVAL = int(os.environ.get('CACHE_RETRY_INTERVAL', 30))
+
+# Состояние фонового обновления (отдается в /debug)
+_refresh_lock = threading.Lock()
+# Загрузка данных в процессе идет только в одном потоке: остальные ждут ее
+# результата или отвечают по текущим данным. Повторно входимая, потому что
+# первая загрузка (из снимка или таблицы) вызывает refresh_data под ней же
+_load_lock = threading.RLock()
+refresh_status = {
+    'in_progress': False,
+    'loads': 0,  # сколько загрузок данных завершено
+    'joined': 0,  # сколько вызовов дождались чужой загрузки вместо своей
+    'last_attempt': None,
+    'last_success': None,
+    'last_result': None,
+    'last_error': None,
+    'last_duration_ms': None,
+    'successes': 0,
+    'failures': 0,
+}
+
+# Снимок последних успешно загруженных данных на диске.
+# Позволяет новому процессу стартовать без похода в Google Sheets
+# и пережить недоступность таблицы.
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', '/tmp/adresa_kic_snapshot.json')
+SNAPSHOT_VERSION = 1
+
+# Inline-режим: сколько подсказок показывать и сколько секунд Telegram их кэширует
+INLINE_RESULTS_LIMIT = int(os.environ.get('INLINE_RESULTS_LIMIT', 10))
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 60))
+
+# Отвечать на обновление прямо в теле ответа на webhook (без отдельного вызова sendMessage).
+# Telegram не сообщает о результате такого вызова, поэтому режим включается явно.
+WEBHOOK_REPLY_IN_RESPONSE = os.environ.get('WEBHOOK_REPLY_IN_RESPONSE', '0').lower() in ('1', 'true', 'yes')
+
+# Отправка сообщений: 'direct' - прямо в запросе, 'queue' - через очередь с ограничением
+# скорости (глобально ~30 сообщений/с, в один чат ~1 сообщение/с)
+TELEGRAM_SEND_MODE = os.environ.get('TELEGRAM_SEND_MODE', 'direct')
+outbound_queue = OutboundDispatcher(
+    lambda payload: post_telegram_api(payload, retries=0),  # повторы делает сама очередь
+    workers=int(os.environ.get('TELEGRAM_QUEUE_WORKERS', 4)),
+    max_size=int(os.environ.get('TELEGRAM_QUEUE_SIZE', 1000)),
+    global_rate=float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30)),
+    chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+)
+
+# Способ получения обновлений: 'webhook' - Flask-маршрут /webhook,
+# 'polling' - getUpdates (long polling) без входящего HTTPS
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook')
+# Long polling: потоков обработки, обновлений за запрос, время ожидания getUpdates (секунды)
+POLL_WORKERS = int(os.environ.get('POLL_WORKERS', 8))
+POLL_LIMIT = int(os.environ.get('POLL_LIMIT', 100))
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', 25))
+
+# Нечеткий поиск: сколько опечаток допускать (больше - крупнее индекс)
+FUZZY_MAX_DISTANCE = int(os.environ.get('FUZZY_MAX_DISTANCE', 2))
+
+# Общий снимок для нескольких процессов (пусто - выключено). Таблицу загружает
+# только процесс, взявший блокировку, и записывает снимок с номером версии;
+# остальные отображают его в память и переключаются при смене версии
+SHARED_SNAPSHOT_PATH = os.environ.get('SHARED_SNAPSHOT_PATH', '')
+# Как часто проверять, не записал ли другой процесс новую версию (секунды)
+SHARED_SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('SHARED_SNAPSHOT_CHECK_INTERVAL', 2))
+# Сколько секунд процесс без данных ждет общий снимок, пока таблицу загружает другой процесс
+SHARED_SNAPSHOT_WAIT = float(os.environ.get('SHARED_SNAPSHOT_WAIT', 30))
+shared_refresh_lock = RefreshLock(f"{SHARED_SNAPSHOT_PATH}.lock") if SHARED_SNAPSHOT_PATH else None
+shared_state = {
+    'version': None,  # версия установленного общего снимка
+    'identity': None,  # (inode, размер) файла этой версии
+    'checked_at': 0,
+    'installed': 0,
+    'published': 0,
+    'lock_busy': 0,
+    'last_error': None
+}
+
+# Сколько лучших совпадений по подстроке отбирать (остальные не ищутся и не показываются)
+SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT', 100))
+# Длинные списки результатов показываются страницами (сообщение Telegram не длиннее 4096 символов)
+RESULTS_PAGE_SIZE = int(os.environ.get('RESULTS_PAGE_SIZE', 10))
+# Найденные списки хранятся для листания кнопками ◀/▶: сколько наборов и сколько секунд
+result_cache = ResultCache(max_size=int(os.environ.get('RESULT_CACHE_SIZE', 1000)),
+                           ttl=int(os.environ.get('RESULT_CACHE_TTL', 3600)))
+# Готовые ответы на поисковые запросы для текущей версии данных (0 - не кэшировать)
+reply_cache = ReplyCache(max_size=int(os.environ.get('REPLY_CACHE_SIZE', 2000)))
+# Номер версии данных: новый у каждого собранного кэша, по нему сбрасывается reply_cache
+data_versions = itertools.count(1)
+
+# Кнопки "Популярные населенные пункты": самые частые успешные поиски по названию.
+# Частоты считаются приближенно (Space-Saving) не больше чем для POPULAR_CAPACITY названий
+POPULAR_KEYBOARD_SIZE = int(os.environ.get('POPULAR_KEYBOARD_SIZE', 12))
+popular_localities = SpaceSaving(capacity=int(os.environ.get('POPULAR_CAPACITY', 200)),
+                                 top_n=POPULAR_KEYBOARD_SIZE)
+# Файл со счетчиками популярности между перезапусками ('' - не сохранять) и период записи (секунды)
+POPULAR_PATH = os.environ.get('POPULAR_PATH', '')
+POPULAR_SAVE_INTERVAL = int(os.environ.get('POPULAR_SAVE_INTERVAL', 300))
+popular_state = {
+    'keyboard': None,  # (версия рейтинга, версия данных, клавиатура)
+    'saved_at': 0,
+    'saved_total': 0,
+}
+popular_save_lock = threading.Lock()
+
+# Перезагрузка индексов по изменениям вместо полной перестройки
+INCREMENTAL_RELOAD = os.environ.get('INCREMENTAL_RELOAD', '1').lower() in ('1', 'true', 'yes')
+# Если изменилась большая доля записей, дешевле построить индексы заново
+INCREMENTAL_MAX_CHANGE_RATIO = float(os.environ.get('INCREMENTAL_MAX_CHANGE_RATIO', 0.3))
+# Журнал последних перезагрузок (отдается в /debug)
+reload_changelog = deque(maxlen=int(os.environ.get('RELOAD_CHANGELOG_SIZE', 20)))
+
+# Показатели последнего разбора выгрузки (отдаются в /debug)
+ingest_stats = {}
+# Отчет о памяти для /debug: (data_version, построен ли нечеткий индекс) → отчет.
+# Хранится отдельно: установленный словарь кэша читают другие потоки, его не меняем
+memory_reports = {}
+
+# Маркер "таблица не изменилась с прошлой загрузки"
+SHEET_NOT_MODIFIED = object()
+
+# Валидаторы последней успешно разобранной выгрузки (для условных запросов)
+sheet_validators = {
+    'etag': None,
+    'last_modified': None,
+    'content_hash': None,
+}
+
+# Названия источников данных кэша для пользователя
+DATA_SOURCE_LABELS = {
+    'google_sheets': 'Google Sheets',
+    'snapshot': 'сохраненная копия таблицы',
+    'shared_snapshot': 'сохраненная копия таблицы',
+    'mock': 'тестовые данные',
+    'empty': 'нет данных',
+}
+
+# Счетчики загрузок таблицы (отдаются в /debug)
+fetch_stats = {
+    'source': None,  # источник последней успешной загрузки
+    'requests': 0,
+    'not_modified_304': 0,
+    'unchanged_hash': 0,
+    'changed': 0,
+    'errors': 0,
+    'bytes_downloaded': 0,
+}
+
+# Доля webhook-запросов с подробной разбивкой времени по этапам (0 - выключено).
+# Разбивка попадает в лог, в /debug и в заголовок Server-Timing ответа
+WEBHOOK_TIMING_SAMPLE_RATE = float(os.environ.get('WEBHOOK_TIMING_SAMPLE_RATE', 0))
+webhook_timings = deque(maxlen=50)
+
+# Метрики (/metrics)
+sheet_fetch_seconds = Histogram('kic_bot_sheet_fetch_seconds',
+                                'Время загрузки выгрузки таблицы вместе с потоковым разбором', ['result'])
+sheet_fetch_bytes = Histogram('kic_bot_sheet_fetch_bytes', 'Размер загруженной выгрузки таблицы',
+                              buckets=SIZE_BUCKETS)
+sheet_parse_seconds = Histogram('kic_bot_sheet_parse_seconds', 'Время разбора CSV', ['method'])
+index_build_seconds = Histogram('kic_bot_index_build_seconds', 'Время построения индексов', ['mode'])
+search_seconds = Histogram('kic_bot_search_seconds', 'Время поиска по виду запроса', ['type'])
+telegram_request_seconds = Histogram('kic_bot_telegram_request_seconds', 'Время вызова Telegram Bot API',
+                                     ['method'])
+telegram_responses = Counter('kic_bot_telegram_responses_total', 'Ответы Telegram Bot API по кодам',
+                             ['method', 'status'])
+webhook_seconds = Histogram('kic_bot_webhook_seconds', 'Время обработки webhook', ['update'])
+polled_update_seconds = Histogram('kic_bot_polled_update_seconds',
+                                  'Время обработки обновления из getUpdates', ['update'])
+data_requests = Counter('kic_bot_data_requests_total', 'Обращения к кэшу данных (hit, stale, miss)',
+                        ['result'])
+data_refreshes = Counter('kic_bot_data_refresh_total', 'Обновления данных по результату', ['result'])
+reply_cache_lookups = Counter('kic_bot_reply_cache_total', 'Обращения к кэшу готовых ответов (hit, miss)',
+                              ['result'])
+Gauge('kic_bot_reply_cache_entries', 'Ответов в кэше готовых ответов',
+      callback=lambda: reply_cache.get_stats()['size'])
+Gauge('kic_bot_data_cache_age_seconds', 'Возраст данных в кэше',
+      callback=lambda: time.time() - cache_timestamp if data_cache is not None else None)
+Gauge('kic_bot_data_records', 'Число записей в кэше',
+      callback=lambda: len(data_cache['all_records']) if data_cache is not None else None)
+Gauge('kic_bot_telegram_queue_depth', 'Сообщений в очереди отправки',
+      callback=lambda: outbound_queue.get_stats()['queue_depth'])
+
+def get_google_sheet_data(conditional=False):
+    """Получение данных из Google Sheets через CSV экспорт
+    
+    При conditional=True отправляет условный запрос (ETag/Last-Modified) и
+    сравнивает хэш содержимого с прошлой загрузкой. Если таблица не изменилась,
+    возвращает SHEET_NOT_MODIFIED без повторного разбора.
+    """
     try:
         logger.info(f"Загружаем данные по URL: {PUBLIC_SHEET_URL}")
         
@@ -40,74 +275,193 @@ def get_google_sheet_data():
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        response = requests.get(PUBLIC_SHEET_URL, headers=headers, timeout=15)
+        if conditional:
+            if sheet_validators['etag']:
+                headers['If-None-Match'] = sheet_validators['etag']
+            if sheet_validators['last_modified']:
+                headers['If-Modified-Since'] = sheet_validators['last_modified']
         
-        if response.status_code == 200:
-            # Проверяем, что это действительно CSV
-            content_type = response.headers.get('Content-Type', '').lower()
-            content = response.text[:200]  # Первые 200 символов для проверки
-            
-            logger.info(f"Content-Type: {content_type}")
-            logger.info(f"Первые 200 символов ответа: {content}")
+        fetch_stats['requests'] += 1
+        # stream=True: тело читается порциями и разбирается по мере загрузки
+        response = http_client.get(PUBLIC_SHEET_URL, headers=headers, timeout=15, stream=True)
+        
+        try:
+            if conditional and response.status_code == 304:
+                fetch_stats['not_modified_304'] += 1
+                logger.info("Таблица не изменилась (304 Not Modified)")
+                return SHEET_NOT_MODIFIED
             
-            if 'html' in content_type or '<html' in content.lower() or '<!doctype' in content.lower():
-                logger.error("Получен HTML вместо CSV. Таблица вероятно требует авторизации.")
+            if response.status_code != 200:
+                fetch_stats['errors'] += 1
+                logger.error(f"Ошибка при загрузке данных: {response.status_code}")
+                logger.error(f"Ответ: {response.text[:500]}")
                 return []
             
-            # Пробуем разные кодировки
-            encodings = ['utf-8', 'cp1251', 'windows-1251', 'iso-8859-1']
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
             
-            for encoding in encodings:
-                try:
-                    decoded_text = response.content.decode(encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-            else:
-                decoded_text = response.text
+            # Сырые порции ответа: одна копия тела, нужна для хэша и запасного парсера
+            chunks = []
+            digest = hashlib.sha256()
             
-            # Парсим CSV
-            try:
-                # Используем StringIO для csv.reader
-                csv_data = io.StringIO(decoded_text)
-                
-                # Автоматически определяем разделитель
-                sample = csv_data.read(1024)
-                csv_data.seek(0)
-                
-                # Пробуем разные разделители
-                for delimiter in [',', ';', '\t']:
-                    csv_data.seek(0)
-                    try:
-                        reader = csv.reader(csv_data, delimiter=delimiter)
-                        rows = list(reader)
-                        if len(rows) > 1:
-                            logger.info(f"Успешно распарсено с разделителем '{delimiter}': {len(rows)} строк")
-                            return process_csv_rows(rows)
-                    except Exception as e:
-                        logger.debug(f"Разделитель '{delimiter}' не подошел: {e}")
-                        continue
-                
-                # Если не получилось, пробуем простой парсинг
-                logger.info("Пробуем простой парсинг CSV...")
-                return parse_csv_simple(decoded_text)
+            def download():
+                for chunk in response.iter_content(chunk_size=INGEST_CHUNK_SIZE):
+                    if chunk:
+                        chunks.append(chunk)
+                        digest.update(chunk)
+                        yield chunk
+            
+            if conditional and sheet_validators['content_hash']:
+                # Сначала сравниваем содержимое с прошлой загрузкой, разбираем только при изменениях
+                for _ in download():
+                    pass
+                fetch_stats['bytes_downloaded'] += sum(len(chunk) for chunk in chunks)
+                sheet_fetch_bytes.observe(sum(len(chunk) for chunk in chunks))
                 
-            except Exception as e:
-                logger.error(f"Ошибка парсинга CSV: {e}")
-                return parse_csv_simple(decoded_text)
+                if digest.hexdigest() == sheet_validators['content_hash']:
+                    fetch_stats['unchanged_hash'] += 1
+                    sheet_validators['etag'] = etag
+                    sheet_validators['last_modified'] = last_modified
+                    logger.info("Таблица не изменилась (совпадает хэш содержимого)")
+                    return SHEET_NOT_MODIFIED
                 
-        else:
-            logger.error(f"Ошибка при загрузке данных: {response.status_code}")
-            logger.error(f"Ответ: {response.text[:500]}")
-            return []
+                records = parse_sheet_stream(iter(chunks), chunks, response.headers.get('Content-Type', ''))
+            else:
+                # Разбираем прямо во время загрузки. Тело ответа читается один раз,
+                # поэтому дочитываем тот же генератор, а не создаем новый
+                stream = download()
+                records = parse_sheet_stream(stream, chunks, response.headers.get('Content-Type', ''))
+                for _ in stream:
+                    pass  # на случай, если разбор остановился раньше конца ответа
+                fetch_stats['bytes_downloaded'] += sum(len(chunk) for chunk in chunks)
+                sheet_fetch_bytes.observe(sum(len(chunk) for chunk in chunks))
+            
+            if records:
+                fetch_stats['changed'] += 1
+                sheet_validators['etag'] = etag
+                sheet_validators['last_modified'] = last_modified
+                sheet_validators['content_hash'] = digest.hexdigest()
+            else:
+                fetch_stats['errors'] += 1
+            
+            return records
+        finally:
+            response.close()
             
     except Exception as e:
+        fetch_stats['errors'] += 1
         logger.error(f"Исключение при загрузке данных: {str(e)}", exc_info=True)
         return []
 
+def get_sheets_api_data(conditional=False):
+    """Получение данных через Google Sheets API (все диапазоны одним запросом batchGet)
+    
+    Условных запросов у API нет, поэтому при conditional=True сравнивается
+    хэш значений с прошлой загрузкой: без изменений - SHEET_NOT_MODIFIED.
+    """
+    fetch_stats['requests'] += 1
+    tables = gsheets.batch_get_values(GOOGLE_SHEET_ID, SHEETS_API_RANGES)
+    if tables is None:
+        fetch_stats['errors'] += 1
+        return []
+    
+    content_hash = hashlib.sha256(json.dumps(tables, ensure_ascii=False).encode('utf-8')).hexdigest()
+    if conditional and content_hash == sheet_validators['content_hash']:
+        fetch_stats['unchanged_hash'] += 1
+        logger.info("Таблица не изменилась (совпадает хэш значений Sheets API)")
+        return SHEET_NOT_MODIFIED
+    
+    timer = IngestTimer()
+    # Заголовок есть в начале каждого диапазона, а process_csv_rows пропускает только первый
+    records = [record for table in tables for record in process_csv_rows(table)]
+    ingest_stats.update(timer.report(sum(map(len, tables)), len(records), 0, 'utf-8', None, 'sheets_api'))
+    sheet_parse_seconds.observe(ingest_stats['seconds'], method='sheets_api')
+    
+    if records:
+        fetch_stats['changed'] += 1
+        sheet_validators['etag'] = None
+        sheet_validators['last_modified'] = None
+        sheet_validators['content_hash'] = content_hash
+    else:
+        fetch_stats['errors'] += 1
+    return records
+
+# Загрузчики источников данных: conditional → записи, SHEET_NOT_MODIFIED или []
+DATA_SOURCE_LOADERS = {
+    'csv': get_google_sheet_data,
+    'sheets_api': get_sheets_api_data,
+}
+
+def fetch_sheet_data(conditional=False):
+    """Загрузка из источников DATA_SOURCES по очереди до первого успешного"""
+    for name in DATA_SOURCES:
+        loader = DATA_SOURCE_LOADERS.get(name)
+        if loader is None:
+            continue
+        try:
+            data = loader(conditional=conditional)
+        except Exception as e:
+            fetch_stats['errors'] += 1
+            logger.error(f"Ошибка источника данных '{name}': {e}", exc_info=True)
+            data = []
+        if data:
+            fetch_stats['source'] = name
+            return data
+        logger.warning(f"Источник данных '{name}' не вернул данных")
+    return []
+
+def parse_sheet_stream(chunks, buffered_chunks, content_type=''):
+    """Потоковый разбор CSV из ответа Google Sheets
+    
+    Кодировка и разделитель определяются один раз по первым килобайтам,
+    дальше строки декодируются и разбираются по мере поступления порций.
+    buffered_chunks - уже прочитанные порции (нужны запасному парсеру).
+    """
+    timer = IngestTimer()
+    content_type = content_type.lower()
+    
+    head, sample = read_head(chunks)
+    if not sample:
+        logger.error("Пустой ответ вместо CSV")
+        return []
+    
+    # Проверяем, что это действительно CSV
+    content = sample[:800].decode('utf-8', errors='ignore')[:200]  # Первые 200 символов для проверки
+    
+    logger.info(f"Content-Type: {content_type}")
+    logger.info(f"Первые 200 символов ответа: {content}")
+    
+    if 'html' in content_type or '<html' in content.lower() or '<!doctype' in content.lower():
+        logger.error("Получен HTML вместо CSV. Таблица вероятно требует авторизации.")
+        return []
+    
+    encoding = detect_encoding(sample)
+    delimiter = detect_delimiter(sample.decode(encoding, errors='ignore'))
+    logger.info(f"Формат CSV: кодировка {encoding}, разделитель '{delimiter}'")
+    
+    rows = CountingIterator(csv.reader(iter_decoded_lines(itertools.chain(head, chunks), encoding), delimiter=delimiter))
+    try:
+        records = process_csv_rows(rows)
+        method = 'csv'
+    except csv.Error as e:
+        # Битый CSV: дочитываем ответ и пробуем простой парсинг
+        logger.error(f"Ошибка парсинга CSV: {e}")
+        logger.info("Пробуем простой парсинг CSV...")
+        for _ in chunks:
+            pass
+        rows = CountingIterator(iter_decoded_lines(buffered_chunks, encoding))
+        records = parse_csv_simple(rows)
+        method = 'simple'
+    
+    ingest_stats.update(timer.report(rows.count, len(records), sum(len(chunk) for chunk in buffered_chunks),
+                                     encoding, delimiter, method))
+    sheet_parse_seconds.observe(ingest_stats['seconds'], method=method)
+    logger.info(f"Разобрано {rows.count} строк за {ingest_stats['seconds']} с ({ingest_stats['rows_per_sec']} строк/с)")
+    return records
+
 def parse_csv_simple(csv_text):
-    """Простой парсинг CSV"""
-    lines = csv_text.strip().split('\n')
+    """Простой парсинг CSV (csv_text - строка или итератор строк)"""
+    lines = csv_text.strip().split('\n') if isinstance(csv_text, str) else csv_text
     records = []
     
     for i, line in enumerate(lines):
@@ -115,25 +469,20 @@ def parse_csv_simple(csv_text):
         if not line.strip():
             continue
         
-        # Разделяем строку, учитывая кавычки
+        # Разделяем строку, учитывая кавычки (кавычки в значения не попадают)
         parts = []
-        current_part = ''
+        start = 0
         in_quotes = False
         
-        for char in line:
+        for position, char in enumerate(line):
             if char == '"':
                 in_quotes = not in_quotes
             elif char == ',' and not in_quotes:
-                parts.append(current_part.strip())
-                current_part = ''
-            else:
-                current_part += char
+                parts.append(line[start:position].replace('"', '').strip())
+                start = position + 1
         
         # Добавляем последнюю часть
-        parts.append(current_part.strip())
-        
-        # Убираем кавычки
-        parts = [part.strip('"') for part in parts]
+        parts.append(line[start:].replace('"', '').strip())
         
         # Пропускаем заголовок
         if i == 0 and any(header in ' '.join(parts).lower() for header in ['населен', 'locality', 'город', 'населённый']):
@@ -204,220 +553,747 @@ def process_csv_rows(rows):
     logger.info(f"CSV парсинг нашел {len(records)} записей")
     return records
 
-def get_data():
-    """Получение данных с кэшированием ТОЛЬКО из базы знаний"""
-    global data_cache, cache_timestamp
+def is_valid_record(record):
+    """Проверка, что это реальный населенный пункт, а не JS код или пустая строка"""
+    locality_lower = record['locality'].lower()
+    return bool(record['locality'] and len(record['locality']) < 50 and 
+                locality_lower != 'населенный пункт' and
+                not any(keyword in locality_lower for keyword in ['function', 'var ', 'return', 'if(', 'for(']))
+
+def build_data_cache(data, current_time, source='google_sheets', previous=None):
+    """Построение структур для поиска по загруженным записям
     
-    current_time = time.time()
+    Записи хранятся компактно (Record + общие строки), а индексы
+    ссылаются на них номерами в all_records.
+    """
+    # Создаем структуры для поиска
+    locality_map = {}  # название в нижнем регистре → номер записи
+    all_records = []  # Сохраняем все записи для поиска
+    locality_keys = []  # названия в нижнем регистре (общие для всех индексов)
+    pool = StringPool()
+    
+    for raw_record in data:
+        # Очищаем и нормализуем данные
+        record = make_record(raw_record, pool)
+        
+        if is_valid_record(record):
+            record_id = len(all_records)
+            locality_lower = pool.get(record['locality'].lower())
+            
+            # Для точного поиска сохраняем в словарь
+            locality_map[locality_lower] = record_id
+            
+            # Сохраняем все записи для поиска по подстроке
+            all_records.append(record)
+            locality_keys.append(locality_lower)
+    
+    return {
+        'locality_map': locality_map,
+        'all_records': all_records,  # Сохраняем все записи для поиска
+        'locality_keys': locality_keys,
+        'kic_index': KicIndex(all_records),  # Коды КИЦ: точный поиск, все отделения банка, диапазоны
+        'trigram_index': TrigramIndex(all_records, locality_keys),  # Индекс для поиска по подстроке
+        'prefix_index': PrefixIndex(all_records, locality_keys),  # Индекс для подсказок по префиксу
+        'fuzzy_index': FuzzyIndex(all_records, max_distance=FUZZY_MAX_DISTANCE),  # Индекс для поиска с опечатками
+        # Готовые тексты ответов; неизменившиеся части берутся из предыдущего кэша
+        'messages': MessageCache(all_records, previous['messages'] if previous else None),
+        'string_pool': pool,
+        'raw_count': len(data),
+        'last_update': current_time,
+        'source': source if data else 'empty',
+        'positions': None,  # номера записей совпадают с порядком строк таблицы
+        'data_version': next(data_versions)
+    }
+
+def apply_sheet_changes(previous, changes, current_time, raw_count, source='google_sheets'):
+    """Новая версия кэша: изменения применяются к копиям структур предыдущей версии
+    
+    Перестраиваются только записи из changes, а списки и массивы индексов
+    копируются при записи, так что предыдущая версия остается целой
+    для запросов, которые еще с ней работают.
+    
+    Удаленные записи замещаются последними, а новые добавляются в конец,
+    поэтому номера записей расходятся с порядком строк. Позиция каждой записи
+    в таблице хранится в positions: по ней выбирается запись для точного
+    названия и упорядочиваются результаты, как при полной сборке.
+    """
+    all_records = list(previous['all_records'])
+    locality_keys = list(previous['locality_keys'])
+    positions = changes.positions
+    kic_index = previous['kic_index'].copy(all_records)
+    pool = previous['string_pool']  # в пул строки только добавляются, его можно не копировать
+    messages = previous['messages'].copy(all_records)
+    indexes = (
+        previous['trigram_index'].copy(all_records, locality_keys),
+        previous['prefix_index'].copy(all_records),
+        previous['fuzzy_index'].copy(all_records),
+    )
+    
+    def unindex_record(record_id):
+        key = locality_keys[record_id]
+        for structure in indexes:
+            structure.remove(record_id, key)
+        kic_index.remove(record_id, all_records[record_id]['kic'])
+    
+    def index_record(record_id):
+        key = locality_keys[record_id]
+        for structure in indexes:
+            structure.add(record_id, key)
+        kic_index.add(record_id, all_records[record_id]['kic'])
+        messages.set(record_id, all_records[record_id])
+    
+    for record_id, record, position in changes.updates:
+        unindex_record(record_id)
+        all_records[record_id] = record
+        locality_keys[record_id] = pool.get(record['locality'].lower())
+        positions[record_id] = position
+        index_record(record_id)
+    
+    # Удаленную запись заменяем последней, чтобы номера оставались без пропусков
+    for record_id in changes.deletes:
+        last_id = len(all_records) - 1
+        unindex_record(record_id)
+        if record_id != last_id:
+            unindex_record(last_id)
+            all_records[record_id] = all_records[last_id]
+            locality_keys[record_id] = locality_keys[last_id]
+            positions[record_id] = positions[last_id]
+            index_record(record_id)
+        all_records.pop()
+        locality_keys.pop()
+        positions.pop()
+        messages.pop()
+    
+    for record, position in changes.inserts:
+        all_records.append(record)
+        locality_keys.append(pool.get(record['locality'].lower()))
+        positions.append(position)
+        index_record(len(all_records) - 1)
+    
+    messages.prune_memo()
+    
+    if all(position == record_id for record_id, position in enumerate(positions)):
+        positions = None
+    else:
+        positions = array('I', positions)
+    
+    return {
+        # Перестраивается целиком: точное название - последняя запись в порядке таблицы
+        'locality_map': build_locality_map(locality_keys, sheet_order(positions, len(all_records))),
+        'all_records': all_records,
+        'locality_keys': locality_keys,
+        'kic_index': kic_index,
+        'trigram_index': indexes[0],
+        'prefix_index': indexes[1],
+        'fuzzy_index': indexes[2],
+        'messages': messages,
+        'string_pool': pool,
+        'raw_count': raw_count,
+        'last_update': current_time,
+        'source': source,
+        'positions': positions,
+        'data_version': next(data_versions)
+    }
+
+def sheet_order(positions, count=None):
+    """Номера записей в порядке строк таблицы (positions - позиции записей или None)"""
+    if positions is None:
+        return range(count)
+    order = [0] * len(positions)
+    for record_id, position in enumerate(positions):
+        order[position] = record_id
+    return order
+
+def build_locality_map(locality_keys, order):
+    """Название в нижнем регистре → номер последней записи с ним (order - номера в порядке таблицы)
+    
+    Названия в словаре идут в порядке первого появления в таблице, как при полной сборке.
+    """
+    locality_map = {}
+    for record_id in order:
+        locality_map[locality_keys[record_id]] = record_id
+    return locality_map
+
+def sheet_records(cache):
+    """Записи кэша в порядке строк таблицы"""
+    all_records = cache['all_records']
+    if cache['positions'] is None:
+        return all_records
+    return [all_records[record_id] for record_id in sheet_order(cache['positions'], len(all_records))]
+
+def sheet_position_key(cache):
+    """Ключ сортировки номеров записей по порядку в таблице; None - номера уже в этом порядке"""
+    positions = cache['positions']
+    return positions.__getitem__ if positions is not None else None
+
+def reload_data_cache(data, current_time, source='google_sheets'):
+    """Новая версия кэша по свежей выгрузке таблицы
+    
+    Если данные уже есть, выгрузка сравнивается с ними и применяются только
+    изменения; при большом числе изменений индексы строятся заново.
+    Итог записывается в журнал перезагрузок (/debug).
+    """
+    started = time.time()
+    previous = data_cache
+    changes = None
+    new_cache = None
     
-    if data_cache is None or current_time - cache_timestamp > CACHE_DURATION:
-        logger.info("Обновление кэша данных ...")
+    if INCREMENTAL_RELOAD and data and previous is not None and previous['source'] != 'empty':
+        pool = previous['string_pool']
         
-        # Загружаем ТОЛЬКО из Google Sheets
-        data = get_google_sheet_data()
+        def make_valid_record(values):
+            record = Record(*map(pool.get, values))
+            return record if is_valid_record(record) else None
         
-        # Если не удалось загрузить, используем пустые данные
-        if not data:
-            logger.error("Не удалось загрузить данные")
-            data = []
+        changes = diff_records(previous['all_records'], map(row_values, data), make_valid_record)
         
-        # Создаем структуры для поиска
-        locality_map = {}
-        all_records = []  # Сохраняем все записи для поиска
-        kic_map = {}
+        if changes.total <= len(previous['all_records']) * INCREMENTAL_MAX_CHANGE_RATIO:
+            new_cache = apply_sheet_changes(previous, changes, current_time, len(data), source)
+    
+    mode = 'incremental'
+    if new_cache is None:
+        mode = 'full'
+        new_cache = build_data_cache(data, current_time, source=source, previous=previous)
+    
+    entry = {
+        'time': current_time,
+        'mode': mode,
+        'records': len(new_cache['all_records']),
+        'rendered': new_cache['messages'].rendered,
+        'duration_ms': int((time.time() - started) * 1000)
+    }
+    if changes is not None:
+        entry.update(changes.summary(previous['all_records']))
+    reload_changelog.appendleft(entry)
+    index_build_seconds.observe(time.time() - started, mode=mode)
+    
+    logger.info(f"Перезагрузка индексов ({mode}): {entry}")
+    return new_cache
+
+def get_memory_report():
+    """Отчет о памяти текущих данных (считается один раз на версию данных)"""
+    if not data_cache:
+        return None
+    
+    cache = data_cache
+    # Нечеткий индекс строится при первом поиске - после этого отчет считаем заново
+    key = (cache['data_version'], cache['fuzzy_index'].names is not None)
+    report = memory_reports.get(key)
+    if report is None:
+        report = memory_report(cache['all_records'], cache['string_pool'], {
+            'locality_map': cache['locality_map'],
+            'kic_index': cache['kic_index'],
+            'trigram_index': cache['trigram_index'],
+            'prefix_index': cache['prefix_index'],
+            'fuzzy_index': cache['fuzzy_index'],
+            'messages': cache['messages'],
+        })
+        # Отчеты прошлых версий данных больше не нужны
+        memory_reports.clear()
+        memory_reports[key] = report
+    return report
+
+def save_snapshot(records):
+    """Сохранение записей в файл снимка (атомарно, через временный файл)"""
+    if not SNAPSHOT_PATH:
+        return False
+    
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'validators': sheet_validators,
+        'fields': RECORD_FIELDS,
+        'records': [record.to_row() for record in records]
+    }
+    
+    tmp_path = f"{SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        logger.info(f"Снимок данных сохранен: {SNAPSHOT_PATH} ({len(records)} записей)")
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить снимок данных: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+def load_snapshot():
+    """Загрузка записей из файла снимка → (records, saved_at) или None"""
+    if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+        return None
+    
+    try:
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            snapshot = json.load(f)
         
-        for record in data:
-            # Очищаем и нормализуем данные
-            record['locality'] = record['locality'].strip()
-            record['type'] = record['type'].strip()
-            record['kic'] = record['kic'].strip()
-            
-            # Проверяем, что это реальный населенный пункт, а не JS код или пустая строка
-            if (record['locality'] and len(record['locality']) < 50 and 
-                record['locality'].lower() != 'населенный пункт' and
-                not any(keyword in record['locality'].lower() for keyword in ['function', 'var ', 'return', 'if(', 'for('])):
-                
-                locality_lower = record['locality'].lower()
-                
-                # Для точного поиска сохраняем в словарь
-                locality_map[locality_lower] = record
-                
-                # Сохраняем все записи для поиска по подстроке
-                all_records.append(record)
-                
-                # Извлекаем код КИЦ
-                kic_match = re.search(r'№\s*(\d+/\d+)', record['kic'])
-                if kic_match:
-                    kic_code = kic_match.group(1)
-                    if kic_code not in kic_map:
-                        kic_map[kic_code] = []
-                    kic_map[kic_code].append(record)
-                else:
-                    # Альтернативный поиск кода КИЦ
-                    alt_match = re.search(r'(\d+/\d+)', record['kic'])
-                    if alt_match:
-                        kic_code = alt_match.group(1)
-                        if kic_code not in kic_map:
-                            kic_map[kic_code] = []
-                        kic_map[kic_code].append(record)
-        
-        data_cache = {
-            'locality_map': locality_map,
-            'all_records': all_records,  # Сохраняем все записи для поиска
-            'kic_map': kic_map,
-            'raw_data': data,
-            'last_update': current_time,
-            'source': 'google_sheets' if data else 'empty'
-        }
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.warning(f"Неподдерживаемая версия снимка: {snapshot.get('version')}")
+            return None
+        
+        fields = snapshot['fields']
+        records = [dict(zip(fields, row)) for row in snapshot['records']]
+        if not records:
+            return None
         
-        cache_timestamp = current_time
-        logger.info(f"Данные загружены: {len(all_records)} записей, {len(kic_map)} КИЦ")
-        logger.info(f"Источник данных: {data_cache['source']}")
+        # Восстанавливаем валидаторы, чтобы первая перепроверка была условной
+        for key, value in snapshot.get('validators', {}).items():
+            if key in sheet_validators:
+                sheet_validators[key] = value
         
-        # Логируем первые 10 записей для проверки
-        if all_records:
-            logger.info("Первые 10 записей из таблицы:")
-            for i, record in enumerate(all_records[:10]):
-                logger.info(f"{i+1}. {record['locality']} ({record['type']}) - {record['kic']}")
+        logger.info(f"Загружен снимок данных: {SNAPSHOT_PATH} ({len(records)} записей)")
+        return records, snapshot.get('saved_at', 0)
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать снимок данных: {e}")
+        return None
+
+def install_snapshot():
+    """Установка данных из снимка в кэш. Возвращает True при успехе"""
+    global data_cache, cache_timestamp
     
-    return data_cache['locality_map'], data_cache['all_records'], data_cache['kic_map']
+    snapshot = load_snapshot()
+    if not snapshot:
+        return False
+    
+    records, saved_at = snapshot
+    with index_build_seconds.time(mode='snapshot'):
+        new_cache = build_data_cache(records, saved_at, source='snapshot', previous=data_cache)
+    cache_timestamp = saved_at
+    data_cache = new_cache
+    return True
+
+def install_empty_cache():
+    """Пустые данные в кэш, чтобы запросы получали ответ, пока данных нет"""
+    global data_cache
+    data_cache = build_data_cache([], 0)
 
-def extract_kic_info(kic_text):
-    """Извлекает информацию о КИЦ из строки"""
-    # Ищем номер ДО
-    do_match = re.search(r'ДО\s*№\s*(\d+/\d+)', kic_text)
-    do_number = do_match.group(1) if do_match else ""
+def build_cache_from_shared(snapshot, previous=None):
+    """Кэш данных поверх общего снимка
     
-    # Ищем название КИЦ (всё после "КИЦ")
-    kic_name_match = re.search(r'КИЦ\s*(.+)', kic_text)
-    if kic_name_match:
-        kic_name = kic_name_match.group(1).strip()
-    else:
-        # Если нет "КИЦ", используем всю строку
-        kic_name = kic_text.strip()
+    Записи, списки триграмм, порядок префиксного индекса и коды КИЦ
+    берутся из отображенного файла; словари (точные названия, нечеткий
+    поиск, готовые тексты) строятся в процессе.
+    """
+    header = snapshot.header
+    pool = StringPool()
+    for value in snapshot.strings:
+        pool.get(value)
+    
+    all_records = snapshot.records()
+    locality_keys = [pool.get(record['locality'].lower()) for record in all_records]
+    sections = snapshot.sections
+    positions = sections.get('positions')
     
-    return do_number, kic_name
+    return {
+        # Последняя запись с таким названием в порядке таблицы, как в build_data_cache
+        'locality_map': build_locality_map(locality_keys, sheet_order(positions, len(all_records))),
+        'all_records': all_records,
+        'locality_keys': locality_keys,
+        'kic_index': KicIndex.from_arrays(all_records, sections['kic_codes'], sections['kic_ids'],
+                                          header['kic_branch_widths']),
+        'trigram_index': TrigramIndex.from_postings(all_records, locality_keys, snapshot.trigram_postings()),
+        'prefix_index': PrefixIndex.from_order(all_records, locality_keys, sections['prefix_ids']),
+        'fuzzy_index': FuzzyIndex(all_records, max_distance=FUZZY_MAX_DISTANCE),
+        'messages': MessageCache(all_records, previous['messages'] if previous else None),
+        'string_pool': pool,
+        'raw_count': header.get('raw_count', len(all_records)),
+        'last_update': header.get('saved_at', 0),
+        'source': 'shared_snapshot',
+        'positions': positions,
+        'data_version': next(data_versions)
+    }
 
-def find_all_matches(all_records, search_text):
-    """Находит все совпадения по поисковому тексту"""
-    search_lower = search_text.lower()
-    matches = []
+def install_shared_snapshot(force=False):
+    """Переход на версию общего снимка, записанную другим процессом
     
-    # Ищем во ВСЕХ записях из базы знаний
-    for record in all_records:
-        # Проверяем, содержит ли название населенного пункта искомый текст
-        if search_lower in record['locality'].lower():
-            # Фильтруем только реальные совпадения
-            if (record['locality'] and len(record['locality']) < 50 and 
-                not any(keyword in record['locality'].lower() for keyword in ['function', 'var ', 'return', 'if('])):
-                matches.append(record)
+    Проверка не чаще SHARED_SNAPSHOT_CHECK_INTERVAL (если не force).
+    Возвращает True, если установлена новая версия.
+    """
+    now = time.time()
+    if not force and now - shared_state['checked_at'] < SHARED_SNAPSHOT_CHECK_INTERVAL:
+        return False
+    shared_state['checked_at'] = now
     
-    # Убираем дубликаты (если есть одинаковые записи)
-    unique_matches = []
-    seen = set()
+    if not _load_lock.acquire(blocking=False):
+        # Данные сейчас загружает другой поток
+        return False
+    try:
+        return _install_shared_snapshot()
+    finally:
+        _load_lock.release()
+
+def _install_shared_snapshot():
+    global data_cache, cache_timestamp
     
-    for match in matches:
-        # Создаем уникальный ключ для каждой записи
-        key = (match['locality'].lower(), match['type'], match['kic'], match['address'])
-        if key not in seen:
-            seen.add(key)
-            unique_matches.append(match)
+    current = read_shared_version(SHARED_SNAPSHOT_PATH)
+    if current is None:
+        return False
+    version, identity = current
+    
+    if version == shared_state['version']:
+        # Та же версия; процесс-обновляльщик мог подтвердить ее свежесть (304) - это видно по mtime
+        try:
+            cache_timestamp = max(cache_timestamp, os.path.getmtime(SHARED_SNAPSHOT_PATH))
+        except OSError:
+            pass
+        return False
+    
+    try:
+        snapshot = SharedSnapshot(SHARED_SNAPSHOT_PATH)
+        with index_build_seconds.time(mode='shared_snapshot'):
+            new_cache = build_cache_from_shared(snapshot, previous=data_cache)
+    except Exception as e:
+        shared_state['last_error'] = str(e)
+        logger.warning(f"Не удалось прочитать общий снимок: {e}")
+        return False
+    
+    # Валидаторы нужны, если обновлять данные в следующий раз будет этот процесс
+    for key, value in snapshot.header.get('validators', {}).items():
+        if key in sheet_validators:
+            sheet_validators[key] = value
+    
+    cache_timestamp = max(snapshot.header.get('saved_at', 0), os.path.getmtime(SHARED_SNAPSHOT_PATH))
+    data_cache = new_cache
+    shared_state['version'] = snapshot.version
+    shared_state['identity'] = snapshot.identity
+    shared_state['installed'] += 1
+    shared_state['last_error'] = None
+    logger.info(f"Установлен общий снимок версии {snapshot.version} ({len(new_cache['all_records'])} записей)")
+    return True
+
+def publish_shared_snapshot(cache):
+    """Запись общего снимка со следующим номером версии (под блокировкой обновления)"""
+    current = read_shared_version(SHARED_SNAPSHOT_PATH)
+    version = max(current[0] if current else 0, shared_state['version'] or 0) + 1
+    
+    try:
+        write_shared_snapshot(SHARED_SNAPSHOT_PATH, cache, version, {
+            'saved_at': cache['last_update'],
+            'raw_count': cache['raw_count'],
+            'validators': sheet_validators
+        })
+    except Exception as e:
+        shared_state['last_error'] = str(e)
+        logger.warning(f"Не удалось записать общий снимок: {e}")
+        return False
+    
+    # Своя версия уже установлена - не перечитываем ее
+    shared_state['version'] = version
+    shared_state['identity'] = (read_shared_version(SHARED_SNAPSHOT_PATH) or (None, None))[1]
+    shared_state['published'] += 1
+    logger.info(f"Общий снимок версии {version} записан: {SHARED_SNAPSHOT_PATH}")
+    return True
+
+def refresh_data(force=True):
+    """Перезагрузка данных из Google Sheets.
+    
+    При неудаче сохраняет ранее загруженные данные (если они есть).
+    Возвращает True, если данные успешно обновлены.
+    Если загрузка уже идет в другом потоке, вызов дожидается ее и
+    возвращает ее результат, не загружая таблицу второй раз.
+    В режиме общего снимка таблицу загружает только процесс, взявший
+    блокировку; при force=False обновление пропускается, если другой
+    процесс уже записал свежую версию.
+    """
+    loads = refresh_status['loads']
+    with _load_lock:
+        if refresh_status['loads'] != loads:
+            # Пока ждали блокировку, данные загрузил другой поток
+            refresh_status['joined'] += 1
+            return refresh_status['last_result'] in ('ok', 'not_modified')
+        if not force and is_cache_fresh():
+            # Данные уже обновлены (другим потоком или процессом)
+            return True
+        try:
+            return _refresh_shared(force)
+        finally:
+            refresh_status['loads'] += 1
+
+def is_cache_fresh():
+    return data_cache is not None and time.time() - cache_timestamp < CACHE_SOFT_TTL
+
+def _refresh_shared(force):
+    if shared_refresh_lock is None:
+        return _refresh_data()
+    
+    if not shared_refresh_lock.acquire():
+        # Данные уже обновляет другой процесс - возьмем его результат из общего снимка
+        shared_state['lock_busy'] += 1
+        logger.info("Данные обновляет другой процесс")
+        if not wait_for_shared_snapshot():
+            return False
+    
+    try:
+        install_shared_snapshot(force=True)
+        if not force and is_cache_fresh():
+            return True
+        return _refresh_data()
+    finally:
+        shared_refresh_lock.release()
+
+def wait_for_shared_snapshot():
+    """Ожидание общего снимка от процесса, который держит блокировку обновления
+    
+    Процесс с данными сразу продолжает работать со своими. Процесс без данных
+    (холодный старт) ждет до SHARED_SNAPSHOT_WAIT секунд, пока появится версия
+    снимка. Если блокировка за это время освободилась, а снимка так и нет,
+    возвращает True: блокировка взята, таблицу загружаем сами. Иначе ставит
+    локальный снимок или пустые данные и возвращает False.
+    """
+    deadline = time.monotonic() + SHARED_SNAPSHOT_WAIT
+    while True:
+        if install_shared_snapshot(force=True) or data_cache is not None:
+            return False
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(min(SHARED_SNAPSHOT_CHECK_INTERVAL, 0.2))
+        if shared_refresh_lock.acquire():
+            return True
     
-    return unique_matches
+    logger.warning(f"Общий снимок не появился за {SHARED_SNAPSHOT_WAIT:.0f} с, отвечаем без него")
+    if not install_snapshot():
+        install_empty_cache()
+    return False
 
-def clean_phone_number(phone):
-    """Очищает номер телефона для ссылки tel:"""
-    if not phone:
-        return ""
+def _refresh_data():
+    global data_cache, cache_timestamp
     
-    # Убираем все символы, кроме цифр и плюса
-    cleaned = re.sub(r'[^\d+]', '', phone)
+    started = time.time()
+    refresh_status['last_attempt'] = started
+    logger.info("Обновление кэша данных ...")
     
-    # Если номер начинается с 8 и имеет 11 цифр, заменяем 8 на 7
-    if len(cleaned) == 11 and cleaned.startswith('8'):
-        cleaned = '7' + cleaned[1:]
+    # Условный запрос имеет смысл, только если в кэше уже есть данные из таблицы
+    conditional = data_cache is not None and data_cache['source'] in ('google_sheets', 'snapshot', 'shared_snapshot')
     
-    # Если номер имеет 10 цифр (без кода страны), добавляем 7
-    elif len(cleaned) == 10:
-        cleaned = '7' + cleaned
+    source = 'google_sheets'
+    try:
+        # Загружаем ТОЛЬКО из Google Sheets (CSV экспорт или Sheets API)
+        data = fetch_sheet_data(conditional=conditional)
+        error = None if data else "Google Sheets вернул пустые данные"
+    except Exception as e:
+        logger.error(f"Исключение при обновлении данных: {str(e)}", exc_info=True)
+        data = []
+        error = str(e)
     
-    # Если нет плюса в начале, добавляем его
-    if cleaned and not cleaned.startswith('+'):
-        if cleaned.startswith('7'):
-            cleaned = '+' + cleaned
+    refresh_status['last_duration_ms'] = int((time.time() - started) * 1000)
+    fetch_result = 'not_modified' if data is SHEET_NOT_MODIFIED else 'changed' if data else 'error'
+    sheet_fetch_seconds.observe(time.time() - started, result=fetch_result)
+    
+    if data is SHEET_NOT_MODIFIED:
+        # Таблица не изменилась - просто продлеваем жизнь кэша без перестройки индексов.
+        # Текущий словарь могут читать другие потоки, поэтому меняем его копию
+        cache_timestamp = time.time()
+        # Данные снимка подтверждены таблицей
+        data_cache = {**data_cache, 'last_update': cache_timestamp, 'source': 'google_sheets'}
+        refresh_status['successes'] += 1
+        refresh_status['last_success'] = cache_timestamp
+        refresh_status['last_error'] = None
+        refresh_status['last_result'] = 'not_modified'
+        logger.info("Данные не изменились, кэш продлен")
+        data_refreshes.inc(result='not_modified')
+        if SHARED_SNAPSHOT_PATH and os.path.exists(SHARED_SNAPSHOT_PATH):
+            # Сообщаем другим процессам, что их версия тоже свежая
+            os.utime(SHARED_SNAPSHOT_PATH)
+        return True
+    
+    if not data:
+        logger.error("Не удалось загрузить данные")
+        refresh_status['failures'] += 1
+        refresh_status['last_error'] = error
+        
+        if data_cache is not None and data_cache['source'] != 'empty':
+            # Оставляем старые данные, повторим попытку позже
+            refresh_status['last_result'] = 'failed_kept_stale'
+            logger.warning(f"Используем ранее загруженные данные (возраст {int(started - cache_timestamp)} с)")
+            data_refreshes.inc(result='failed_kept_stale')
+            return False
+        
+        if install_snapshot():
+            # Старых данных в памяти нет, но есть снимок на диске
+            refresh_status['last_result'] = 'failed_using_snapshot'
+            logger.warning("Используем данные из снимка на диске")
+            data_refreshes.inc(result='failed_using_snapshot')
+            return False
+        
+        if 'mock' in DATA_SOURCES:
+            # Последний вариант - тестовые данные, чтобы бот отвечал хоть что-то
+            refresh_status['last_result'] = 'failed_using_mock'
+            logger.warning("Используем тестовые данные")
+            source = 'mock'
+            data = process_csv_rows(gsheets.mock_sheet_rows())
         else:
-            cleaned = '+7' + cleaned
+            # Старых данных нет - используем пустые данные
+            refresh_status['last_result'] = 'failed_empty'
+            data = []
+    else:
+        refresh_status['successes'] += 1
+        refresh_status['last_success'] = time.time()
+        refresh_status['last_error'] = None
+        refresh_status['last_result'] = 'ok'
+    
+    current_time = time.time()
+    new_cache = reload_data_cache(data, current_time, source)
+    all_records = new_cache['all_records']
+    
+    # Сначала время, потом данные: читатель не увидит новые данные со старым временем
+    cache_timestamp = current_time
+    data_cache = new_cache
+    
+    if all_records and source != 'mock':
+        save_snapshot(sheet_records(new_cache))
+        if SHARED_SNAPSHOT_PATH:
+            publish_shared_snapshot(new_cache)
     
-    # Убираем все символы, кроме цифр и плюса в начале
-    if cleaned.startswith('+'):
-        country_code = '+'
-        digits = cleaned[1:]
+    logger.info(f"Данные загружены: {len(all_records)} записей, {len(new_cache['kic_index'])} КИЦ")
+    logger.info(f"Источник данных: {data_cache['source']}")
+    
+    # Логируем первые 10 записей для проверки
+    if all_records:
+        logger.info("Первые 10 записей из таблицы:")
+        for i, record in enumerate(all_records[:10]):
+            logger.info(f"{i+1}. {record['locality']} ({record['type']}) - {record['kic']}")
+    
+    data_refreshes.inc(result=refresh_status['last_result'])
+    return bool(data) and source != 'mock'
+
+def _background_refresh():
+    """Фоновое обновление данных"""
+    try:
+        refresh_data(force=False)
+    finally:
+        with _refresh_lock:
+            refresh_status['in_progress'] = False
+
+def start_background_refresh():
+    """Запуск фонового обновления, если оно еще не идет"""
+    with _refresh_lock:
+        if refresh_status['in_progress']:
+            return False
+        
+        # После неудачной попытки не долбим Google Sheets на каждом запросе
+        last_attempt = refresh_status['last_attempt']
+        if (refresh_status['last_error'] is not None and last_attempt and
+                time.time() - last_attempt < CACHE_RETRY_INTERVAL):
+            return False
+        
+        refresh_status['in_progress'] = True
+    
+    logger.info("Данные устарели, запускаем фоновое обновление")
+    thread = threading.Thread(target=_background_refresh, name='data-refresh', daemon=True)
+    thread.start()
+    return True
+
+def get_snapshot():
+    """Текущий набор данных целиком: записи, индексы и готовые тексты.
+    
+    Все структуры берутся из одного словаря, поэтому согласованы между собой
+    даже если кэш обновится во время обработки запроса. Словарь после
+    установки не меняется: обновление подменяет его целиком.
+    """
+    if SHARED_SNAPSHOT_PATH:
+        # Другой процесс мог записать новую версию общего снимка
+        install_shared_snapshot()
+    
+    current_time = time.time()
+    cache_age = current_time - cache_timestamp
+    
+    if data_cache is None:
+        data_requests.inc(result='miss')
+        with _load_lock:
+            # Первый запрос загружает данные, остальные ждут его здесь
+            if data_cache is None:
+                started = time.perf_counter()
+                if install_snapshot():
+                    # Отвечаем из снимка сразу, а свежие данные подтягиваем в фоне
+                    start_background_refresh()
+                else:
+                    refresh_data(force=False)
+                if data_cache is None:
+                    # Загрузка в другом потоке оборвалась - отвечаем пустыми данными, повторим позже
+                    install_empty_cache()
+                startup.mark('first_data_load', duration_ms=round((time.perf_counter() - started) * 1000, 1),
+                             source=data_cache['source'])
+    elif cache_age > CACHE_SOFT_TTL:
+        data_requests.inc(result='stale')
+        last_attempt = refresh_status['last_attempt'] or 0
+        recently_failed = (refresh_status['last_error'] is not None and
+                           current_time - last_attempt < CACHE_RETRY_INTERVAL)
+        
+        if CACHE_REFRESH_MODE != 'background' or cache_age > CACHE_HARD_TTL:
+            # Данные слишком старые - обновляем прямо в запросе
+            # (если обновление уже идет, дожидаемся его)
+            if not recently_failed:
+                refresh_data(force=False)
+        else:
+            # Отдаем устаревшие данные сразу, обновляем в фоне
+            start_background_refresh()
     else:
-        country_code = ''
-        digits = cleaned
-    
-    # Оставляем только цифры
-    digits = re.sub(r'\D', '', digits)
-    
-    return country_code + digits
-
-def format_record(record):
-    """Форматирование записи для отображения с кликабельными ссылками"""
-    do_number, kic_name = extract_kic_info(record['kic'])
-    
-    kic_display = record['kic']
-    if do_number and kic_name:
-        kic_display = f"ДО №{do_number} КИЦ {kic_name}"
-    
-    # Очищаем номер телефона для ссылки
-    phone_cleaned = clean_phone_number(record['phone'])
-    
-    # Экранируем HTML-сущности в тексте (кроме ссылок)
-    locality_escaped = html.escape(record['locality'])
-    type_escaped = html.escape(record['type'])
-    kic_display_escaped = html.escape(kic_display)
-    address_escaped = html.escape(record['address'])
-    fio_escaped = html.escape(record['fio'])
-    phone_display = html.escape(record['phone']) if record['phone'] else ""
-    email_display = html.escape(record['email']) if record['email'] else ""
-    
-    # Логируем для отладки
-    logger.info(f"Форматирование записи: {record['locality']}")
-    logger.info(f"Телефон оригинальный: '{record['phone']}'")
-    logger.info(f"Телефон очищенный: '{phone_cleaned}'")
-    logger.info(f"Email: '{record['email']}'")
-    
-    # Формируем HTML-сообщение с кликабельными ссылками
-    html_message = (
-        f"<b>📍 Населенный пункт:</b> {locality_escaped} ({type_escaped})\n\n"
-        f"<b>🏢 КИЦ:</b> {kic_display_escaped}\n"
-        f"<b>📫 Адрес КИЦ:</b> {address_escaped}\n\n"
-        f"<b>👤 РКИЦ:</b> {fio_escaped}\n"
-    )
+        data_requests.inc(result='hit')
     
-    # Добавляем кликабельный телефон с правильным форматом
-    if phone_cleaned and record['phone']:
-        # Для телефона используем формат +79991234567
-        # Убедимся, что номер начинается с +
-        if not phone_cleaned.startswith('+'):
-            phone_cleaned = '+' + phone_cleaned
-        
-        html_message += f'<b>📞 Телефон:</b> <a href="tel:{phone_cleaned}">{phone_display}</a>\n'
-    elif record['phone']:
-        html_message += f"<b>📞 Телефон:</b> {phone_display}\n"
-    
-    # Добавляем кликабельный email
-    if record['email']:
-        # Очищаем email от лишних пробелов
-        email_clean = record['email'].strip()
-        html_message += f'<b>📧 Email:</b> <a href="mailto:{email_clean}">{email_display}</a>\n'
-    
-    html_message += (
-        f"\n<b>📊 Источник:</b> база знаний\n"
-        f"<i>🔄 Для нового поиска используйте кнопки ниже</i>"
-    )
+    return data_cache
+
+def get_data():
+    """Получение данных с кэшированием ТОЛЬКО из базы знаний"""
+    snapshot = get_snapshot()
+    return snapshot['locality_map'], snapshot['all_records'], snapshot['kic_index']
+
+def get_search_index():
+    """Индекс триграмм текущих данных"""
+    return data_cache['trigram_index'] if data_cache else None
+
+def find_all_match_ids(all_records, search_text, index=None, prefix_index=None, limit=None, positions=None):
+    """Номера записей, совпадающих с поисковым текстом, по релевантности
+    
+    limit - сколько лучших совпадений вернуть (None - все). Если передан индекс
+    триграмм, построенный по этим же записям, проверяются только кандидаты из
+    индекса, иначе - все записи. С префиксным индексом сначала ранжируются
+    названия, начинающиеся с запроса: если их набралось limit, совпадения
+    внутри названий их не обгонят и не просматриваются. positions - позиции
+    записей в таблице, если номера с ними не совпадают (для равных по релевантности).
+    """
+    search_lower = search_text.lower()
+    
+    if index is not None and index.records is all_records:
+        keys = index.keys
+        candidates = index.candidate_ids(search_lower)
+    else:
+        keys = [record['locality'].lower() for record in all_records]
+        candidates = range(len(all_records))
+        prefix_index = None
+    
+    def make_filter():
+        seen = set()
+        
+        def accept(record_id, locality_lower):
+            # Фильтруем только реальные совпадения
+            record = all_records[record_id]
+            locality = record['locality']
+            if not (locality and len(locality) < 50 and
+                    not any(keyword in locality_lower for keyword in ['function', 'var ', 'return', 'if('])):
+                return False
+            # Убираем дубликаты (если есть одинаковые записи)
+            key = (locality_lower, record['type'], record['kic'], record['address'])
+            if key in seen:
+                return False
+            seen.add(key)
+            return True
+        
+        return accept
+    
+    if limit is not None and prefix_index is not None and prefix_index.records is all_records and search_lower:
+        ranked = rank_matches(all_records, keys, prefix_index.iter_prefix(search_lower), search_lower, limit,
+                              make_filter(), positions)
+        if len(ranked) >= limit:
+            return ranked
     
-    return html_message
+    return rank_matches(all_records, keys, candidates, search_lower, limit, make_filter(), positions)
+
+def find_all_matches(all_records, search_text, index=None, limit=None):
+    """Находит все совпадения по поисковому тексту (limit лучших по релевантности)"""
+    return [all_records[record_id] for record_id in find_all_match_ids(all_records, search_text, index, limit=limit)]
 
 def get_main_keyboard():
     """Клавиатура главного меню"""
@@ -431,27 +1307,150 @@ def get_main_keyboard():
         "one_time_keyboard": False
     }
 
-def get_localities_keyboard():
-    """Клавиатура с популярными населенными пунктами"""
-    locality_map, all_records, _ = get_data()
-    
-    # Фильтруем только реальные населенные пункты
-    real_localities = []
-    for locality_key, record in locality_map.items():
-        if (record['locality'] and len(record['locality']) < 50 and 
-            not any(keyword in record['locality'].lower() for keyword in ['function', 'var ', 'return', 'if('])):
-            real_localities.append(record['locality'])
-    
-    # Убираем дубликаты названий
-    unique_localities = []
+def build_results_page(results, page):
+    """Текст и кнопки страницы списка результатов → (text, reply_markup)"""
+    record_ids = results['ids']
+    messages = results['messages']
+    pages = (len(record_ids) + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    start = page * RESULTS_PAGE_SIZE
+    
+    text = results['header']
+    text += "".join(f"{i}. {messages.line(record_id)}\n"
+                    for i, record_id in enumerate(record_ids[start:start + RESULTS_PAGE_SIZE], start + 1))
+    text += results['footer']
+    
+    if pages <= 1:
+        return text, get_main_keyboard()
+    
+    token = results['token']
+    buttons = []
+    if page > 0:
+        buttons.append({"text": "◀", "callback_data": f"page:{token}:{page - 1}"})
+    buttons.append({"text": f"{page + 1}/{pages}", "callback_data": "noop"})
+    if page < pages - 1:
+        buttons.append({"text": "▶", "callback_data": f"page:{token}:{page + 1}"})
+    return text, {"inline_keyboard": [buttons]}
+
+def build_results_reply(record_ids, messages, header, footer):
+    """Список результатов → (text, reply_markup); длинный список - первая страница с кнопками ◀/▶
+    
+    Список сохраняется в result_cache вместе с готовыми текстами данных, по
+    которым он найден, поэтому страницы не зависят от обновления кэша данных.
+    """
+    results = {'ids': record_ids, 'messages': messages, 'header': header, 'footer': footer, 'token': None}
+    if len(record_ids) > RESULTS_PAGE_SIZE:
+        results['token'] = result_cache.put(results)
+    return build_results_page(results, 0)
+
+def results_available(reply_markup):
+    """Доступны ли еще страницы, на которые ссылаются кнопки ◀/▶ ответа"""
+    for row in reply_markup.get('inline_keyboard', ()):
+        for button in row:
+            if button.get('callback_data', '').startswith('page:'):
+                return result_cache.has(button['callback_data'].split(':')[1])
+    return True
+
+def handle_callback_query(callback_query):
+    """Нажатие inline-кнопки → ответы (перелистывание страницы результатов)"""
+    answer = {"method": "answerCallbackQuery", "callback_query_id": callback_query['id']}
+    data = callback_query.get('data', '')
+    message = callback_query.get('message')
+    
+    if not data.startswith('page:') or not message:
+        return [answer]
+    
+    try:
+        _, token, page = data.split(':')
+        page = int(page)
+    except ValueError:
+        return [answer]
+    
+    results = result_cache.get(token)
+    if results is None:
+        answer["text"] = "⌛ Результаты поиска устарели, повторите поиск"
+        return [answer]
+    
+    text, keyboard = build_results_page(results, page)
+    edit = {
+        "method": "editMessageText",
+        "chat_id": message['chat']['id'],
+        "message_id": message['message_id'],
+        "text": text,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True,
+        "reply_markup": keyboard
+    }
+    return [edit, answer]
+
+def save_popular():
+    """Сохранение счетчиков популярности в файл (атомарно, через временный файл)"""
+    if not POPULAR_PATH or not popular_save_lock.acquire(blocking=False):
+        return False
+    
+    state = popular_localities.to_state()
+    tmp_path = f"{POPULAR_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**state, 'saved_at': time.time()}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, POPULAR_PATH)
+        popular_state['saved_total'] = state['total']
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить счетчики популярности: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    finally:
+        popular_state['saved_at'] = time.time()
+        popular_save_lock.release()
+
+def load_popular():
+    """Загрузка счетчиков популярности из файла"""
+    if not POPULAR_PATH or not os.path.exists(POPULAR_PATH):
+        return False
+    
+    try:
+        with open(POPULAR_PATH, encoding='utf-8') as f:
+            state = json.load(f)
+        popular_localities.load_state(state)
+        popular_state['saved_total'] = popular_localities.total
+        logger.info(f"Счетчики популярности загружены: {POPULAR_PATH} ({len(state['counters'])} названий)")
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить счетчики популярности: {e}")
+        return False
+
+def record_popular(locality):
+    """Учет успешного поиска населенного пункта"""
+    popular_localities.add(locality)
+    if (POPULAR_PATH and popular_localities.total != popular_state['saved_total']
+            and time.time() - popular_state['saved_at'] >= POPULAR_SAVE_INTERVAL):
+        save_popular()
+
+def build_localities_keyboard(names, snapshot):
+    """Клавиатура с населенными пунктами names; недостающие кнопки - первые пункты таблицы"""
+    locality_map = snapshot['locality_map']
+    all_records = snapshot['all_records']
+    
+    # Популярные названия, которые еще есть в данных, без повторов
+    localities = []
     seen = set()
-    for locality in real_localities:
-        if locality not in seen:
-            seen.add(locality)
-            unique_localities.append(locality)
+    for name in names:
+        if name.lower() in locality_map and name.lower() not in seen:
+            seen.add(name.lower())
+            localities.append(name)
     
-    # Берем первые 12 реальных населенных пунктов
-    localities = unique_localities[:12]
+    # Пока статистики мало, добираем первыми населенными пунктами таблицы
+    # (записи в кэше уже проверены is_valid_record)
+    for locality_key, record_id in locality_map.items():
+        if len(localities) >= POPULAR_KEYBOARD_SIZE:
+            break
+        if locality_key not in seen:
+            seen.add(locality_key)
+            localities.append(all_records[record_id]['locality'])
     
     keyboard = []
     row = []
@@ -469,246 +1468,526 @@ def get_localities_keyboard():
         "one_time_keyboard": False
     }
 
+def get_localities_keyboard():
+    """Клавиатура с популярными населенными пунктами
+    
+    Готовая клавиатура собирается заново только при изменении рейтинга
+    популярности или данных.
+    """
+    snapshot = get_snapshot()
+    version, top = popular_localities.get_top()
+    cached = popular_state['keyboard']
+    if cached is None or cached[:2] != (version, snapshot['data_version']):
+        keyboard = build_localities_keyboard([name for name, _ in top], snapshot)
+        cached = popular_state['keyboard'] = (version, snapshot['data_version'], keyboard)
+    return cached[2]
+
+def build_inline_results(query):
+    """Подсказки для inline-режима: населенные пункты, начинающиеся с введенного текста"""
+    snapshot = get_snapshot()
+    all_records = snapshot['all_records']
+    messages = snapshot['messages']
+    
+    with search_seconds.time(stage='search_prefix', type='prefix'):
+        record_ids = snapshot['prefix_index'].search(query.strip().lower(), limit=INLINE_RESULTS_LIMIT,
+                                                     order=sheet_position_key(snapshot))
+    
+    results = []
+    for record_id in record_ids:
+        record = all_records[record_id]
+        do_number, kic_name = extract_kic_info(record['kic'])
+        results.append({
+            "type": "article",
+            "id": str(record_id),
+            "title": f"{record['locality']} ({record['type']})" if record['type'] else record['locality'],
+            "description": f"ДО №{do_number} КИЦ {kic_name}" if do_number else record['kic'],
+            "input_message_content": {
+                "message_text": messages.card(record_id),
+                "parse_mode": "HTML",
+                "disable_web_page_preview": True
+            }
+        })
+    
+    return results
+
 @app.route('/')
 def home():
     return "✅ Бот для поиска КИЦ работает! Используйте /start в Telegram"
 
-@app.route('/webhook', methods=['POST', 'GET'])
-def webhook():
-    if request.method == 'GET':
-        return jsonify({"status": "webhook is active"})
+@app.after_request
+def mark_first_response(response):
+    """Время от старта процесса до первого ответа (профиль холодного старта)"""
+    startup.mark('first_response', path=request.path)
+    return response
+
+@app.before_request
+def start_webhook_timing():
+    if request.endpoint == 'webhook' and request.method == 'POST':
+        g.webhook_started = time.perf_counter()
+        start_request_timing('webhook', WEBHOOK_TIMING_SAMPLE_RATE)
+
+@app.after_request
+def finish_webhook_timing(response):
+    """Метрика времени webhook и разбивка по этапам для выбранных запросов"""
+    started = g.pop('webhook_started', None)
+    if started is None:
+        return response
     
-    try:
-        update = request.get_json()
+    update_type = get_update_type(request.get_json(silent=True) or {})
+    startup.mark('first_webhook_reply', update=update_type)
+    webhook_seconds.observe(time.perf_counter() - started, update=update_type)
+    
+    timing = finish_request_timing()
+    if timing is not None:
+        response.headers['Server-Timing'] = timing.server_timing()
+        entry = {'update': update_type, **timing.to_dict()}
+        webhook_timings.appendleft(entry)
+        logger.info(f"Разбивка времени webhook: {entry}")
+    
+    return response
+
+def get_update_type(update):
+    return next((key for key in update if key != 'update_id'), 'unknown')
+
+def get_search_reply(text, snapshot):
+    """Ответ на поисковый запрос → (text, reply_markup)
+    
+    Готовые ответы лежат в reply_cache по нормализованному запросу и версии
+    данных, поэтому повторный запрос не выполняет поиск и отрисовку заново.
+    """
+    query = ' '.join(text.split())
+    key = query.lower()
+    # Ответ со списком результатов годится, пока доступны его страницы
+    reply = reply_cache.get(key, snapshot['data_version'], valid=lambda reply: results_available(reply[1]))
+    if reply is not None:
+        reply_cache_lookups.inc(result='hit')
+    else:
+        reply_cache_lookups.inc(result='miss')
+        reply = build_search_reply(query, snapshot)
+        reply_cache.put(key, snapshot['data_version'], reply)
+    
+    response_text, reply_markup, found_locality = reply
+    if found_locality:
+        record_popular(found_locality)
+    return response_text, reply_markup
+
+def build_search_reply(text, snapshot):
+    """Поиск по тексту запроса и отрисовка ответа → (text, reply_markup, found_locality)
+    
+    found_locality - название населенного пункта, если поиск по названию нашел
+    ровно одну запись (для счетчиков популярности), иначе None.
+    """
+    all_records = snapshot['all_records']
+    # Готовые тексты карточек и строк списка по номеру записи
+    messages = snapshot['messages']
+    # Клавиатура списка результатов (по умолчанию - главное меню)
+    reply_markup = None
+    found_locality = None
+    
+    # Проверяем, является ли ввод кодом КИЦ (точный код, начало кода или диапазон)
+    with search_seconds.time(stage='search_kic', type='kic'):
+        kic_lookup = snapshot['kic_index'].lookup(text, sheet_position_key(snapshot))
+    
+    if kic_lookup:
+        record_ids, kic_code = kic_lookup
+        
+        if len(record_ids) > 1:
+            response_text, reply_markup = build_results_reply(
+                record_ids, messages,
+                f"<b>🔍 Найдено {len(record_ids)} записей для КИЦ {html.escape(kic_code)}:</b>\n\n",
+                "\n<b>🔍 Уточните поиск, введя полное название населенного пункта.</b>"
+            )
+        elif record_ids:
+            response_text = messages.card(record_ids[0])
+        else:
+            response_text = f"❌ <b>КИЦ с кодом {html.escape(kic_code)} не найден в базе знаний.</b>"
+    
+    else:
+        # Ищем точное совпадение
+        locality_lower = text.lower()
+        with search_seconds.time(stage='search_exact', type='exact'):
+            record_id = snapshot['locality_map'].get(locality_lower)
         
-        if 'message' in update:
-            chat_id = update['message']['chat']['id']
-            text = update['message'].get('text', '').strip()
+        if record_id is not None:
+            response_text = messages.card(record_id)
+            found_locality = all_records[record_id]['locality']
+        else:
+            # Ищем ВСЕ совпадения (включая частичные) В базе знаний
+            with search_seconds.time(stage='search_substring', type='substring'):
+                match_ids = find_all_match_ids(all_records, text, snapshot['trigram_index'],
+                                               snapshot['prefix_index'], SEARCH_RESULTS_LIMIT, snapshot['positions'])
+            
+            if not match_ids and has_latin_letters(text):
+                # Возможно, текст набран в английской раскладке
+                with search_seconds.time(stage='search_layout', type='layout'):
+                    match_ids = find_all_match_ids(all_records, switch_keyboard_layout(text), snapshot['trigram_index'],
+                                                   snapshot['prefix_index'], SEARCH_RESULTS_LIMIT, snapshot['positions'])
             
-            if text == '/start':
-                response_text = (
-                    "👋 Привет! Я бот Адреса КИЦ.\n\n"
-                    "Я ищу данные в базе знаний.\n"
-                    "Выберите тип поиска:"
-                )
-                keyboard = get_main_keyboard()
-                send_telegram_message(chat_id, response_text, keyboard)
+            # Ничего не нашли - ищем похожие названия (опечатки, ё/е)
+            similar_ids = []
+            if not match_ids:
+                with search_seconds.time(stage='search_fuzzy', type='fuzzy'):
+                    similar_ids = [record_id for _, record_id in
+                                   snapshot['fuzzy_index'].search(text, order=sheet_position_key(snapshot))]
             
-            elif text == "🔍 Поиск по населенному пункту":
-                response_text = "🏘️ Введите название населенного пункта (например: Октябрьское):"
-                send_telegram_message(chat_id, response_text)
+            if match_ids:
+                if len(match_ids) == 1:
+                    response_text = messages.card(match_ids[0])
+                    found_locality = all_records[match_ids[0]]['locality']
+                else:
+                    if len(match_ids) < SEARCH_RESULTS_LIMIT:
+                        header = f"<b>🔍 Найдено {len(match_ids)} похожих населенных пунктов в базе знаний:</b>\n\n"
+                    else:
+                        header = f"<b>🔍 {len(match_ids)} самых подходящих населенных пунктов в базе знаний:</b>\n\n"
+                    response_text, reply_markup = build_results_reply(
+                        match_ids, messages, header,
+                        "\n<b>🔍 Введите полное и точное название населенного пункта для получения подробной информации.</b>"
+                    )
+            elif similar_ids:
+                text_escaped = html.escape(text)
+                if len(similar_ids) == 1:
+                    response_text = (
+                        f"<b>🔎 «{text_escaped}» не найден. Возможно, вы имели в виду:</b>\n\n"
+                        + messages.card(similar_ids[0])
+                    )
+                else:
+                    response_text = f"<b>🔎 «{text_escaped}» не найден. Возможно, вы имели в виду:</b>\n\n"
+                    response_text += "".join(f"{i}. {messages.titles[record_id]}\n" for i, record_id in enumerate(similar_ids, 1))
+                    response_text += "\n<b>🔍 Введите полное и точное название населенного пункта для получения подробной информации.</b>"
+            else:
+                # Проверяем, есть ли вообще данные в таблице
+                if not all_records:
+                    response_text = (
+                        f"❌ <b>Нет данных в базе знаний.</b>\n\n"
+                        "<b>Проверьте:</b>\n"
+                        f"1. Доступ к таблице: https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}\n"
+                        "2. Что таблица опубликована для общего доступа\n"
+                        "3. Нажмите '🔄 Обновить данные' для повторной загрузки"
+                    )
+                else:
+                    text_escaped = html.escape(text)
+                    response_text = (
+                        f"❌ <b>Населенный пункт «{text_escaped}» не найден в Google Sheets.</b>\n\n"
+                        f"<b>Всего записей в таблице:</b> {len(all_records)}\n"
+                        "<b>Попробуйте:</b>\n"
+                        "• Проверить правильность написания\n"
+                        "• Использовать часть названия (например, 'окт' вместо 'октябрьское')\n"
+                        "• Воспользоваться кнопкой '📍 Популярные населенные пункты'\n"
+                        f"• Проверить данные в таблице: https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}"
+                    )
+    
+    return response_text, reply_markup or get_main_keyboard(), found_locality
+
+def handle_update(update):
+    """Обработка обновления Telegram → список ответов (параметры методов Bot API)
+    
+    Не зависит от способа получения обновлений: используется и webhook,
+    и режимом long polling.
+    """
+    replies = []
+    
+    if 'inline_query' in update:
+        # Подсказки по мере ввода (inline-режим)
+        inline_query = update['inline_query']
+        results = build_inline_results(inline_query.get('query', ''))
+        replies.append(build_inline_answer_payload(inline_query['id'], results))
+    
+    elif 'callback_query' in update:
+        # Кнопки ◀/▶ под списком результатов
+        replies.extend(handle_callback_query(update['callback_query']))
+    
+    elif 'message' in update:
+        chat_id = update['message']['chat']['id']
+        text = update['message'].get('text', '').strip()
+        
+        if text == '/start':
+            response_text = (
+                "👋 Привет! Я бот Адреса КИЦ.\n\n"
+                "Я ищу данные в базе знаний.\n"
+                "Выберите тип поиска:"
+            )
+            keyboard = get_main_keyboard()
+            replies.append(build_message_payload(chat_id, response_text, keyboard))
+        
+        elif text == "🔍 Поиск по населенному пункту":
+            response_text = "🏘️ Введите название населенного пункта (например: Октябрьское):"
+            replies.append(build_message_payload(chat_id, response_text))
+        
+        elif text == "🏢 Поиск по КИЦ":
+            response_text = "🏢 Введите код КИЦ (например: 8598/0496):"
+            replies.append(build_message_payload(chat_id, response_text))
+        
+        elif text == "📍 Популярные населенные пункты":
+            response_text = "📍 Выберите населенный пункт:"
+            keyboard = get_localities_keyboard()
+            replies.append(build_message_payload(chat_id, response_text, keyboard))
+        
+        elif text == "↩️ Назад":
+            response_text = "Главное меню:"
+            keyboard = get_main_keyboard()
+            replies.append(build_message_payload(chat_id, response_text, keyboard))
+        
+        elif text == "🔄 Обновить данные":
+            refreshed = refresh_data()
+            locality_map, all_records, kic_index = get_data()
             
-            elif text == "🏢 Поиск по КИЦ":
-                response_text = "🏢 Введите код КИЦ (например: 8598/0496):"
-                send_telegram_message(chat_id, response_text)
+            if refreshed and all_records:
+                response_text = f"✅ Данные успешно обновлены из базы знаний\n\nЗагружено {len(all_records)} записей."
+            else:
+                response_text = "❌ Не удалось загрузить данные из базы знаний. Проверьте доступ к таблице."
             
-            elif text == "📍 Популярные населенные пункты":
-                response_text = "📍 Выберите населенный пункт:"
-                keyboard = get_localities_keyboard()
-                send_telegram_message(chat_id, response_text, keyboard)
+            keyboard = get_main_keyboard()
+            replies.append(build_message_payload(chat_id, response_text, keyboard))
+        
+        elif text == "❓ Помощь":
+            response_text = (
+                "🤖 Помощь по боту поиска КИЦ\n\n"
+                "• 🔍 Поиск по населенному пункту - найти КИЦ по названию населенного пункта\n"
+                "• 🏢 Поиск по КИЦ - найти по коду кассово-инкассаторского центра\n"
+                "• 📍 Популярные населенные пункты - быстрый выбор из списка\n"
+                "• 📊 Статистика - информация о базе данных\n"
+                "• 🔄 Обновить данные - обновить данные из базы данных\n\n"
+                "📝 Данные загружаются из базы данных\n"
+                "📊 Формат таблицы: Название | Тип | КИЦ | Адрес | ФИО | Телефон | Email\n\n"
+                "🔍 Примеры поиска:\n"
+                "• При вводе 'Октябрь' найдет все населенные пункты, содержащие это слово\n"
+                "• При вводе '8598/0496' найдет все записи с этим кодом КИЦ\n"
+                "• Можно вводить часть названия: 'окт', 'октя', 'октяб', 'ктя'\n"
+                "• В любом чате наберите имя бота и начало названия - подсказки появятся по мере ввода"
+            )
+            keyboard = get_main_keyboard()
+            replies.append(build_message_payload(chat_id, response_text, keyboard))
+        
+        elif text == "📊 Статистика":
+            locality_map, all_records, kic_index = get_data()
+            source = data_cache['source'] if data_cache and 'source' in data_cache else 'unknown'
             
-            elif text == "↩️ Назад":
-                response_text = "Главное меню:"
-                keyboard = get_main_keyboard()
-                send_telegram_message(chat_id, response_text, keyboard)
+            # Считаем только реальные записи
+            real_records = 0
+            example_records = []
             
-            elif text == "🔄 Обновить данные":
-                global data_cache, cache_timestamp
-                data_cache = None
-                cache_timestamp = 0
-                locality_map, all_records, kic_map = get_data()
-                
-                if all_records:
-                    response_text = f"✅ Данные успешно обновлены из базы знаний\n\nЗагружено {len(all_records)} записей."
-                else:
-                    response_text = "❌ Не удалось загрузить данные из базы знаний. Проверьте доступ к таблице."
-                
-                keyboard = get_main_keyboard()
-                send_telegram_message(chat_id, response_text, keyboard)
+            for record in all_records:
+                if (record['locality'] and len(record['locality']) < 50 and 
+                    not any(keyword in record['locality'].lower() for keyword in ['function', 'var ', 'return', 'if('])):
+                    real_records += 1
+                    if len(example_records) < 5:
+                        example_records.append(record)
             
-            elif text == "❓ Помощь":
-                response_text = (
-                    "🤖 Помощь по боту поиска КИЦ\n\n"
-                    "• 🔍 Поиск по населенному пункту - найти КИЦ по названию населенного пункта\n"
-                    "• 🏢 Поиск по КИЦ - найти по коду кассово-инкассаторского центра\n"
-                    "• 📍 Популярные населенные пункты - быстрый выбор из списка\n"
-                    "• 📊 Статистика - информация о базе данных\n"
-                    "• 🔄 Обновить данные - обновить данные из базы данных\n\n"
-                    "📝 Данные загружаются из базы данных\n"
-                    "📊 Формат таблицы: Название | Тип | КИЦ | Адрес | ФИО | Телефон | Email\n\n"
-                    "🔍 Примеры поиска:\n"
-                    "• При вводе 'Октябрь' найдет все населенные пункты, содержащие это слово\n"
-                    "• При вводе '8598/0496' найдет все записи с этим кодом КИЦ\n"
-                    "• Можно вводить часть названия: 'окт', 'октя', 'октяб', 'ктя'"
-                )
-                keyboard = get_main_keyboard()
-                send_telegram_message(chat_id, response_text, keyboard)
+            stats_text = (
+                f"<b>📊 Статистика базы данных </b>\n\n"
+                f"• <b>Всего записей:</b> {real_records}\n"
+                f"• <b>Уникальных КИЦ:</b> {len(kic_index)}\n"
+                f"• <b>Источник:</b> {DATA_SOURCE_LABELS.get(source, source)}\n"
+                f"• <b>Обновлено:</b> {time.strftime('%H:%M:%S')}\n"
+                f"• <b>URL таблицы:</b> https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}\n\n"
+            )
             
-            elif text == "📊 Статистика":
-                locality_map, all_records, kic_map = get_data()
-                source = data_cache['source'] if data_cache and 'source' in data_cache else 'unknown'
-                
-                # Считаем только реальные записи
-                real_records = 0
-                example_records = []
-                
-                for record in all_records:
-                    if (record['locality'] and len(record['locality']) < 50 and 
-                        not any(keyword in record['locality'].lower() for keyword in ['function', 'var ', 'return', 'if('])):
-                        real_records += 1
-                        if len(example_records) < 5:
-                            example_records.append(record)
-                
-                stats_text = (
-                    f"<b>📊 Статистика базы данных </b>\n\n"
-                    f"• <b>Всего записей:</b> {real_records}\n"
-                    f"• <b>Уникальных КИЦ:</b> {len(kic_map)}\n"
-                    f"• <b>Источник:</b> Google Sheets\n"
-                    f"• <b>Обновлено:</b> {time.strftime('%H:%M:%S')}\n"
-                    f"• <b>URL таблицы:</b> https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}\n\n"
-                )
-                
-                if example_records:
-                    stats_text += "<b>Примеры населенных пунктов:</b>\n"
-                    for record in example_records:
-                        stats_text += f"• {html.escape(record['locality'])} ({html.escape(record['type'])})\n"
-                else:
-                    stats_text += "❌ <b>Нет данных.</b> Проверьте доступ к Google Sheets таблице."
-                
-                keyboard = get_main_keyboard()
-                send_telegram_message(chat_id, stats_text, keyboard, parse_mode='HTML')
+            if source == 'mock':
+                stats_text += "⚠️ <b>Google Sheets недоступен, показаны тестовые данные.</b>\n\n"
             
+            if example_records:
+                stats_text += "<b>Примеры населенных пунктов:</b>\n"
+                for record in example_records:
+                    stats_text += f"• {html.escape(record['locality'])} ({html.escape(record['type'])})\n"
             else:
-                locality_map, all_records, kic_map = get_data()
-                
-                # Проверяем, является ли ввод кодом КИЦ
-                kic_match = re.search(r'(\d+/\d+)', text)
-                
-                if kic_match:
-                    kic_code = kic_match.group(1)
-                    records = kic_map.get(kic_code, [])
-                    
-                    if records:
-                        if len(records) == 1:
-                            response_text = format_record(records[0])
-                        else:
-                            response_text = f"<b>🔍 Найдено {len(records)} записей для КИЦ {html.escape(kic_code)}:</b>\n\n"
-                            for i, record in enumerate(records, 1):
-                                do_number, kic_name = extract_kic_info(record['kic'])
-                                locality_escaped = html.escape(record['locality'])
-                                type_escaped = html.escape(record['type'])
-                                response_text += f"{i}. {locality_escaped} ({type_escaped})"
-                                if do_number:
-                                    response_text += f" ДО №{do_number}"
-                                if kic_name:
-                                    response_text += f" КИЦ {html.escape(kic_name)}"
-                                response_text += "\n"
-                            response_text += "\n<b>🔍 Уточните поиск, введя полное название населенного пункта.</b>"
-                    else:
-                        response_text = f"❌ <b>КИЦ с кодом {html.escape(kic_code)} не найден в базе знаний.</b>"
-                    
-                    keyboard = get_main_keyboard()
-                    send_telegram_message(chat_id, response_text, keyboard, parse_mode='HTML')
-                
-                else:
-                    # Ищем точное совпадение
-                    locality_lower = text.lower()
-                    record = locality_map.get(locality_lower)
-                    
-                    if record:
-                        response_text = format_record(record)
-                    else:
-                        # Ищем ВСЕ совпадения (включая частичные) В базе знаний
-                        matches = find_all_matches(all_records, text)
-                        
-                        if matches:
-                            if len(matches) == 1:
-                                response_text = format_record(matches[0])
-                            else:
-                                response_text = f"<b>🔍 Найдено {len(matches)} похожих населенных пунктов в базе знаний:</b>\n\n"
-                                for i, match in enumerate(matches, 1):
-                                    do_number, kic_name = extract_kic_info(match['kic'])
-                                    locality_escaped = html.escape(match['locality'])
-                                    type_escaped = html.escape(match['type'])
-                                    response_text += f"{i}. {locality_escaped} ({type_escaped})"
-                                    if do_number:
-                                        response_text += f" ДО №{do_number}"
-                                    if kic_name:
-                                        response_text += f" КИЦ {html.escape(kic_name)}"
-                                    response_text += "\n"
-                                
-                                response_text += "\n<b>🔍 Введите полное и точное название населенного пункта для получения подробной информации.</b>"
-                        else:
-                            # Проверяем, есть ли вообще данные в таблице
-                            if not all_records:
-                                response_text = (
-                                    f"❌ <b>Нет данных в базе знаний.</b>\n\n"
-                                    "<b>Проверьте:</b>\n"
-                                    f"1. Доступ к таблице: https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}\n"
-                                    "2. Что таблица опубликована для общего доступа\n"
-                                    "3. Нажмите '🔄 Обновить данные' для повторной загрузки"
-                                )
-                            else:
-                                text_escaped = html.escape(text)
-                                response_text = (
-                                    f"❌ <b>Населенный пункт «{text_escaped}» не найден в Google Sheets.</b>\n\n"
-                                    f"<b>Всего записей в таблице:</b> {len(all_records)}\n"
-                                    "<b>Попробуйте:</b>\n"
-                                    "• Проверить правильность написания\n"
-                                    "• Использовать часть названия (например, 'окт' вместо 'октябрьское')\n"
-                                    "• Воспользоваться кнопкой '📍 Популярные населенные пункты'\n"
-                                    f"• Проверить данные в таблице: https://docs.google.com/spreadsheets/d/{GOOGLE_SHEET_ID}"
-                                )
-                    
-                    keyboard = get_main_keyboard()
-                    send_telegram_message(chat_id, response_text, keyboard, parse_mode='HTML')
-        
-        return jsonify({"status": "ok"})
+                stats_text += "❌ <b>Нет данных.</b> Проверьте доступ к Google Sheets таблице."
+            
+            keyboard = get_main_keyboard()
+            replies.append(build_message_payload(chat_id, stats_text, keyboard))
+        
+        else:
+            with stage('data'):
+                snapshot = get_snapshot()
+            replies.append(build_message_payload(chat_id, *get_search_reply(text, snapshot)))
+    
+    return replies
+
+@app.route('/webhook', methods=['POST', 'GET'])
+def webhook():
+    if request.method == 'GET':
+        return jsonify({"status": "webhook is active"})
+    
+    try:
+        # Ответы на это обновление: отправляются ответом на webhook или отдельными запросами
+        replies = handle_update(request.get_json())
+        
+        with stage('deliver'):
+            return deliver_replies(replies)
         
     except Exception as e:
         logger.error(f"Ошибка в webhook: {str(e)}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
-def send_telegram_message(chat_id, text, reply_markup=None, parse_mode='HTML'):
-    """Отправка сообщения в Telegram"""
+def build_message_payload(chat_id, text, reply_markup=None, parse_mode='HTML'):
+    """Параметры метода sendMessage"""
+    payload = {
+        "method": "sendMessage",
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": parse_mode,
+        "disable_web_page_preview": True
+    }
+    
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    
+    return payload
+
+def build_inline_answer_payload(inline_query_id, results):
+    """Параметры метода answerInlineQuery"""
+    return {
+        "method": "answerInlineQuery",
+        "inline_query_id": inline_query_id,
+        "results": results,
+        "cache_time": INLINE_CACHE_TIME
+    }
+
+def deliver_replies(replies):
+    """Доставка ответов на обновление.
+    
+    Единственный ответ можно вернуть прямо в теле ответа на webhook -
+    Telegram сам выполнит указанный метод, без второго запроса к API.
+    Остальные ответы отправляются отдельными вызовами.
+    """
+    if WEBHOOK_REPLY_IN_RESPONSE and len(replies) == 1:
+        return jsonify(replies[0])
+    
+    send_replies(replies)
+    return jsonify({"status": "ok"})
+
+def send_replies(replies):
+    """Отправка ответов отдельными вызовами Bot API (или через очередь)"""
+    for payload in replies:
+        if TELEGRAM_SEND_MODE == 'queue':
+            # Отправку выполнят рабочие потоки очереди, обработчик освобождается сразу
+            outbound_queue.enqueue(payload)
+        else:
+            call_telegram_api(payload)
+
+def process_polled_update(update):
+    """Обработка обновления, полученного через getUpdates"""
+    with polled_update_seconds.time(update=get_update_type(update)):
+        send_replies(handle_update(update))
+
+def fetch_updates(offset, limit, timeout):
+    """Вызов getUpdates → список обновлений"""
+    payload = {"method": "getUpdates", "limit": limit, "timeout": timeout,
+               "allowed_updates": ["message", "inline_query", "callback_query"]}
+    if offset is not None:
+        payload["offset"] = offset
+    
+    # Ответ на long polling приходит не раньше timeout секунд
+    response = post_telegram_api(payload, retries=0, timeout=timeout + 10)
+    result = response.json()
+    if not result.get('ok'):
+        raise RuntimeError(f"getUpdates: {result.get('description', response.status_code)}")
+    return result['result']
+
+def run_polling():
+    """Режим long polling: getUpdates вместо webhook"""
+    from update_poller import UpdatePoller
+    
+    # Пока установлен webhook, Telegram не отдает обновления через getUpdates
+    call_telegram_api({"method": "deleteWebhook"})
+    poller = UpdatePoller(fetch_updates, process_polled_update, workers=POLL_WORKERS,
+                          limit=POLL_LIMIT, timeout=POLL_TIMEOUT)
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": parse_mode,
-            "disable_web_page_preview": True
-        }
-        
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        
-        response = requests.post(url, json=payload, timeout=10)
+        poller.run()
+    except KeyboardInterrupt:
+        logger.info(f"Long polling остановлен: {poller.get_stats()}")
+    finally:
+        save_popular()
+
+def post_telegram_api(payload, retries=None, timeout=10):
+    """HTTP-вызов метода Telegram Bot API, указанного в payload['method'] → Response"""
+    method = payload['method']
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+    body = {key: value for key, value in payload.items() if key != 'method'}
+    status = 'error'
+    try:
+        with telegram_request_seconds.time(stage=f"telegram_{method}", method=method):
+            response = http_client.post(url, json=body, timeout=timeout, retries=retries)
+        status = response.status_code
+        return response
+    finally:
+        telegram_responses.inc(method=method, status=status)
+
+def call_telegram_api(payload):
+    """Вызов метода Telegram Bot API, указанного в payload['method']"""
+    method = payload['method']
+    try:
+        response = post_telegram_api(payload)
         
         if response.status_code != 200:
             logger.error(f"Telegram API error: {response.text}")
             
         return response.status_code == 200
     except Exception as e:
-        logger.error(f"Error sending Telegram message: {e}")
+        logger.error(f"Error calling Telegram {method}: {e}")
         return False
 
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/debug')
 def debug():
-    locality_map, all_records, kic_map = get_data()
+    locality_map, all_records, kic_index = get_data()
     source = data_cache['source'] if data_cache and 'source' in data_cache else 'unknown'
     
     return jsonify({
         "bot_token_exists": bool(BOT_TOKEN),
+        "webhook_reply_in_response": WEBHOOK_REPLY_IN_RESPONSE,
+        "http": http_client.http_stats,
+        "telegram_send_mode": TELEGRAM_SEND_MODE,
+        "telegram_queue": outbound_queue.get_stats(),
         "sheet_url": PUBLIC_SHEET_URL,
         "google_sheet_id": GOOGLE_SHEET_ID,
         "gid": GOOGLE_SHEET_GID,
         "all_records_count": len(all_records),
         "locality_map_count": len(locality_map),
-        "kic_count": len(kic_map),
+        "kic_count": len(kic_index),
+        "memory": get_memory_report(),
         "cache_age_seconds": int(time.time() - cache_timestamp) if data_cache else None,
         "data_source": source,
-        "first_10_records": [{"locality": r['locality'], "type": r['type'], "kic": r['kic']} for r in all_records[:10]] if all_records else [],
+        "snapshot": {
+            "path": SNAPSHOT_PATH,
+            "exists": bool(SNAPSHOT_PATH) and os.path.exists(SNAPSHOT_PATH),
+            "size_bytes": os.path.getsize(SNAPSHOT_PATH) if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH) else None
+        },
+        "shared_snapshot": {
+            "path": SHARED_SNAPSHOT_PATH or None,
+            "check_interval_seconds": SHARED_SNAPSHOT_CHECK_INTERVAL,
+            **shared_state
+        },
+        "startup": startup.profile,
+        "result_cache": result_cache.get_stats(),
+        "reply_cache": reply_cache.get_stats(),
+        "popular_localities": popular_localities.get_stats(),
+        "ingest": ingest_stats,
+        "webhook_timing": {
+            "sample_rate": WEBHOOK_TIMING_SAMPLE_RATE,
+            "recent": list(webhook_timings)
+        },
+        "reload": {
+            "incremental": INCREMENTAL_RELOAD,
+            "max_change_ratio": INCREMENTAL_MAX_CHANGE_RATIO,
+            "changelog": list(reload_changelog)
+        },
+        "cache_refresh": {
+            "mode": CACHE_REFRESH_MODE,
+            "soft_ttl_seconds": CACHE_SOFT_TTL,
+            "hard_ttl_seconds": CACHE_HARD_TTL,
+            **refresh_status
+        },
+        "sheet_fetch": {
+            **fetch_stats,
+            "etag": sheet_validators['etag'],
+            "last_modified": sheet_validators['last_modified'],
+            "content_hash": sheet_validators['content_hash'][:16] if sheet_validators['content_hash'] else None
+        },
+        "first_10_records": [{"locality": r['locality'], "type": r['type'], "kic": r['kic']} for r in sheet_records(data_cache)[:10]] if all_records else [],
         "status": "running"
     })
 
@@ -716,7 +1995,7 @@ def debug():
 def test_sheet():
     """Тестирование подключения к базе знаний"""
     try:
-        response = requests.get(PUBLIC_SHEET_URL, timeout=10)
+        response = http_client.get(PUBLIC_SHEET_URL, timeout=10, retries=0)
         return jsonify({
             "status_code": response.status_code,
             "content_type": response.headers.get('Content-Type'),
@@ -730,14 +2009,14 @@ def test_sheet():
 @app.route('/search_test')
 def search_test():
     """Тестирование поиска"""
-    locality_map, all_records, kic_map = get_data()
+    locality_map, all_records, kic_index = get_data()
     
     # Тестируем поиск разных вариантов
     test_searches = ['октябрь', 'окт', 'ктя', 'путь октября']
     results = {}
     
     for search in test_searches:
-        matches = find_all_matches(all_records, search)
+        matches = find_all_matches(all_records, search, get_search_index())
         results[search] = {
             "count": len(matches),
             "matches": [{"locality": r['locality'], "type": r['type'], "kic": r['kic']} for r in matches[:5]]
@@ -752,15 +2031,19 @@ def search_test():
 @app.route('/refresh_cache')
 def refresh_cache():
     """Принудительное обновление кэша"""
-    global data_cache, cache_timestamp
-    data_cache = None
-    cache_timestamp = 0
-    get_data()
-    return jsonify({"status": "cache refreshed"})
+    if refresh_data():
+        return jsonify({"status": "cache refreshed"})
+    return jsonify({"status": "refresh failed, using previous data", "error": refresh_status['last_error']})
+
+load_popular()
+startup.mark('module_loaded')
 
 if __name__ == '__main__':
     # Предварительная загрузка данных при запуске
     logger.info("Запуск бота...")
     logger.info(f"Используется база знаний ID: {GOOGLE_SHEET_ID}")
     get_data()
-    app.run(host='0.0.0.0', port=3000, debug=False)
+    if BOT_MODE == 'polling':
+        run_polling()
+    else:
+        app.run(host='0.0.0.0', port=3000, debug=False)
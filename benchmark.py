@@ -0,0 +1,309 @@
+"""Нагрузочные замеры разбора таблицы, построения индексов и поиска.
+
+Таблица "Общий" генерируется синтетически (детерминированно по --seed),
+Google Sheets и Telegram не нужны. Результат - JSON с p50/p99 по каждому
+замеру и пиковой памятью, его можно сохранить и сравнить со следующим прогоном:
+
+    python benchmark.py --sizes 1000,10000,100000 --output bench.json
+    python benchmark.py --sizes 1000,10000,100000 --compare bench.json
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Настройки приложения по умолчанию, без снимка на диске и сетевых вызовов
+os.environ.setdefault('SNAPSHOT_PATH', '')
+
+import app
+from records import RECORD_FIELDS
+from rendering import format_record
+from sheet_ingest import peak_memory_kb
+
+DEFAULT_SIZES = '1000,10000,100000'
+# Сколько раз повторять разовые операции (разбор, построение индексов)
+DEFAULT_REPEAT = 3
+# Сколько запросов на каждый вид поиска
+DEFAULT_QUERIES = 500
+# Допустимое замедление p50 относительно прошлого прогона (--compare)
+DEFAULT_TOLERANCE = 0.2
+# Примерно столько населенных пунктов на один КИЦ
+ROWS_PER_KIC = 40
+
+HEADER = ['Населенный пункт', 'Тип', 'КИЦ', 'Адрес КИЦ', 'ФИО РКИЦ', 'Телефон РКИЦ', 'Email РКИЦ']
+NAME_PREFIXES = ['', '', '', 'Новая ', 'Старый ', 'Верхний ', 'Нижняя ', 'Малая ', 'Большое ', 'Красный ']
+NAME_ROOTS = ['Берёз', 'Сосн', 'Октябр', 'Камен', 'Ольх', 'Лип', 'Дубр', 'Ключ', 'Рябин', 'Покров',
+              'Троиц', 'Никол', 'Михайл', 'Алексе', 'Богородиц', 'Журавл', 'Озёр', 'Полян', 'Светл', 'Ясн']
+NAME_SUFFIXES = ['овка', 'ово', 'ское', 'ск', 'ино', 'ки', 'евка', 'ый Яр', 'ец', 'ица', 'ищи', 'ань']
+LOCALITY_TYPES = ['село', 'деревня', 'посёлок', 'город', 'хутор', 'станица', 'рабочий посёлок']
+STREETS = ['Ленина', 'Советская', 'Мира', 'Центральная', 'Школьная', 'Садовая', 'Молодёжная']
+SURNAMES = ['Иванова', 'Петров', 'Смирнова', 'Кузнецов', 'Соколова', 'Попов', 'Лебедева', 'Козлов']
+FIRST_NAMES = ['Анна', 'Иван', 'Мария', 'Сергей', 'Елена', 'Дмитрий', 'Ольга', 'Алексей']
+
+
+def generate_rows(count, seed):
+    """Строки синтетической таблицы (первая - заголовок)"""
+    rng = random.Random(seed)
+    kic_count = max(1, count // ROWS_PER_KIC)
+    kics = []
+    for number in range(kic_count):
+        bank = rng.choice([8598, 8598, 8598, 8369, 8647])
+        city = rng.choice(NAME_ROOTS) + rng.choice(NAME_SUFFIXES)
+        kics.append([
+            f"ДО №{bank}/{number % 10000:04d} КИЦ {city}",
+            f"г. {city}, ул. {rng.choice(STREETS)}, д. {rng.randint(1, 120)}",
+            f"{rng.choice(SURNAMES)} {rng.choice(FIRST_NAMES)}",
+            f"8 ({rng.randint(900, 999)}) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}",
+            f"kic{number}@example.ru",
+        ])
+
+    rows = [HEADER]
+    for number in range(count):
+        name = rng.choice(NAME_PREFIXES) + rng.choice(NAME_ROOTS) + rng.choice(NAME_SUFFIXES)
+        if rng.random() < 0.5:
+            # Одинаковые названия в разных районах встречаются, но не у каждого
+            name = f"{name} {number % 997}"
+        rows.append([name, rng.choice(LOCALITY_TYPES)] + rng.choice(kics))
+    return rows
+
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(samples, **extra):
+    """p50/p99/среднее в миллисекундах"""
+    return {
+        'runs': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 4),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 4),
+        **extra
+    }
+
+
+def time_calls(function, arguments):
+    """Время каждого вызова function(argument)"""
+    samples = []
+    for argument in arguments:
+        started = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def time_repeated(function, repeat, measure_memory):
+    """Время разовой операции (repeat раз) и пиковая память Python-объектов при одном вызове"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - started)
+
+    extra = {}
+    if measure_memory:
+        tracemalloc.start()
+        function()
+        extra['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+
+    return samples, extra, result
+
+
+def make_queries(rng, records, count):
+    """Поисковые запросы: точные названия, начала и части названий, промахи"""
+    queries = []
+    for _ in range(count):
+        locality = rng.choice(records)['locality']
+        kind = rng.random()
+        if kind < 0.3:
+            queries.append(locality)
+        elif kind < 0.6:
+            queries.append(locality[:rng.randint(3, max(3, len(locality)))])
+        elif kind < 0.9:
+            start = rng.randint(0, max(0, len(locality) - 4))
+            queries.append(locality[start:start + 4])
+        else:
+            queries.append(rng.choice(NAME_ROOTS) + 'щщ')
+    return queries
+
+
+def make_kic_queries(rng, records, count):
+    """Запросы кодов КИЦ: точный код, все отделения банка, начало номера отделения"""
+    queries = []
+    for _ in range(count):
+        code = records[rng.randrange(len(records))]['kic'].split('№')[1].split()[0]
+        bank, branch = code.split('/')
+        kind = rng.random()
+        if kind < 0.7:
+            queries.append(code)
+        elif kind < 0.8:
+            queries.append(bank)
+        else:
+            queries.append(f"{bank}/{branch[:2]}")
+    return queries
+
+
+def bench_size(size, args):
+    """Все замеры для таблицы из size строк"""
+    rng = random.Random(args.seed + size)
+    rows = generate_rows(size, args.seed + size)
+    csv_text = rows_to_csv(rows)
+    csv_bytes = csv_text.encode('utf-8')
+    result = {'rows': size, 'csv_bytes': len(csv_bytes)}
+
+    samples, extra, data = time_repeated(
+        lambda: app.process_csv_rows(csv.reader(io.StringIO(csv_text))), args.repeat, args.memory)
+    result['process_csv_rows'] = summarize(samples, records=len(data), **extra)
+
+    samples, extra, _ = time_repeated(lambda: app.parse_csv_simple(csv_text), args.repeat, args.memory)
+    result['parse_csv_simple'] = summarize(samples, **extra)
+
+    chunks = [csv_bytes[i:i + 64 * 1024] for i in range(0, len(csv_bytes), 64 * 1024)]
+    samples, extra, _ = time_repeated(
+        lambda: app.parse_sheet_stream(iter(chunks), chunks, 'text/csv'), args.repeat, args.memory)
+    result['parse_sheet_stream'] = summarize(samples, **extra)
+
+    # Построение индексов - то, что делает get_data() при загрузке данных
+    samples, extra, cache = time_repeated(
+        lambda: app.build_data_cache(data, time.time()), args.repeat, args.memory)
+    result['build_data_cache'] = summarize(samples, records=len(cache['all_records']), **extra)
+
+    # Перезагрузка после правки 0.1% строк
+    changed = [dict(record) for record in data]
+    for _ in range(max(1, size // 1000)):
+        changed[rng.randrange(len(changed))]['phone'] = f"8 (900) {rng.randint(1000000, 9999999)}"
+    app.data_cache = cache
+    samples, extra, _ = time_repeated(
+        lambda: app.reload_data_cache(changed, time.time()), args.repeat, args.memory)
+    result['reload_incremental'] = summarize(samples, **extra)
+    app.data_cache = cache
+
+    all_records = cache['all_records']
+    queries = make_queries(rng, all_records, args.queries)
+    index = cache['trigram_index']
+    result['find_all_matches'] = summarize(time_calls(
+        lambda query: app.find_all_matches(all_records, query, index), queries))
+    result['find_top_matches'] = summarize(time_calls(
+        lambda query: app.find_all_match_ids(all_records, query, index, cache['prefix_index'],
+                                             app.SEARCH_RESULTS_LIMIT), queries))
+    result['find_all_matches_scan'] = summarize(time_calls(
+        lambda query: app.find_all_matches(all_records, query), queries[:max(10, args.queries // 10)]))
+    # Словари нечеткого поиска строятся при первом поиске - замеряем это отдельно
+    samples, extra, _ = time_repeated(
+        lambda: app.FuzzyIndex(all_records, max_distance=app.FUZZY_MAX_DISTANCE).search(queries[0]),
+        args.repeat, args.memory)
+    result['fuzzy_build'] = summarize(samples, **extra)
+    result['fuzzy_search'] = summarize(time_calls(cache['fuzzy_index'].search, queries))
+    result['prefix_search'] = summarize(time_calls(
+        lambda query: cache['prefix_index'].search(query.lower()), queries))
+
+    kic_queries = make_kic_queries(rng, all_records, args.queries)
+    result['kic_lookup'] = summarize(time_calls(cache['kic_index'].lookup, kic_queries))
+
+    sample_ids = [rng.randrange(len(all_records)) for _ in range(args.queries)]
+    result['format_record'] = summarize(time_calls(
+        lambda record_id: format_record(all_records[record_id]), sample_ids))
+    result['message_card'] = summarize(time_calls(cache['messages'].card, sample_ids))
+
+    app.data_cache = None
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """Замеры, у которых p50 вырос больше чем на tolerance относительно baseline"""
+    regressions = []
+    old_sizes = {str(entry['rows']): entry for entry in baseline.get('results', [])}
+    for entry in report['results']:
+        old_entry = old_sizes.get(str(entry['rows']))
+        if not old_entry:
+            continue
+        for name, stats in entry.items():
+            old_stats = old_entry.get(name)
+            if not isinstance(stats, dict) or not isinstance(old_stats, dict) or not old_stats.get('p50_ms'):
+                continue
+            ratio = stats['p50_ms'] / old_stats['p50_ms']
+            if ratio > 1 + tolerance:
+                regressions.append({'rows': entry['rows'], 'benchmark': name,
+                                    'baseline_p50_ms': old_stats['p50_ms'], 'p50_ms': stats['p50_ms'],
+                                    'ratio': round(ratio, 2)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры производительности бота на синтетической таблице')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='размеры таблиц через запятую (до 500000)')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора данных')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='повторы разовых операций')
+    parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help='запросов на каждый вид поиска')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='не замерять память (быстрее)')
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию - stdout)')
+    parser.add_argument('--compare', help='JSON-отчет прошлого прогона для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='допустимый рост p50 при сравнении (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    # Логи приложения на каждую загрузку данных исказили бы замеры
+    logging.disable(logging.INFO)
+
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'queries': args.queries,
+        'record_fields': list(RECORD_FIELDS),
+        'results': []
+    }
+
+    for size in [int(size) for size in args.sizes.split(',') if size.strip()]:
+        print(f"Таблица на {size} строк ...", file=sys.stderr)
+        report['results'].append(bench_size(size, args))
+
+    report['peak_rss_kb'] = peak_memory_kb()
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+        for regression in report['regressions']:
+            print(f"Регрессия: {regression}", file=sys.stderr)
+        exit_code = 1 if report['regressions'] else 0
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,19 @@
 import os
+import ast
+import json
 import logging
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import threading
+
+import http_client
+
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+# Маска полей ответа batchGet: только значения ячеек, без метаданных диапазонов
+BATCH_GET_FIELDS = 'valueRanges(values)'
+
+# Клиент создается один раз и переиспользуется (токен обновляется самой сессией)
+_client = None
+_client_lock = threading.Lock()
 
 logger = logging.getLogger(__name__)
 
@@ -30,43 +42,92 @@ MOCK_DATA = {
 }
 
 
+def mock_sheet_rows():
+    """Мок-данные строками таблицы (столбцы как в выгрузке: пункт, тип, КИЦ, адрес, ФИО, телефон, email)"""
+    return [[record["location"], "", record["kic"], record["address"], record["fio"], record["phone"], record["email"]]
+            for records in MOCK_DATA.values() for record in records]
+
+
+def parse_credentials(creds_json):
+    """Ключ сервисного аккаунта из переменной окружения (JSON или литерал словаря Python)"""
+    try:
+        return json.loads(creds_json)
+    except ValueError:
+        # Старый формат переменной - словарь Python с одинарными кавычками
+        return ast.literal_eval(creds_json)
+
+
 def init_gsheets():
-    """Инициализация клиента Google Sheets"""
+    """Инициализация клиента Google Sheets (авторизованная сессия на общем пуле соединений)"""
     creds_json = os.environ.get('GOOGLE_CREDENTIALS')
     if not creds_json:
         logger.error("GOOGLE_CREDENTIALS not set")
         return None
 
     try:
-        creds = Credentials.from_service_account_info(
-            eval(creds_json),
-            scopes=['https://www.googleapis.com/auth/spreadsheets.readonly']
-        )
-        return build('sheets', 'v4', credentials=creds)
+        # google-auth нужен только для этого источника данных
+        from google.oauth2.service_account import Credentials
+        from google.auth.transport.requests import AuthorizedSession, Request
+    except ImportError:
+        logger.error("google-auth не установлен, Sheets API недоступен")
+        return None
+
+    try:
+        creds = Credentials.from_service_account_info(parse_credentials(creds_json), scopes=SHEETS_SCOPES)
+        # Запросы к API и обновление токена идут через keep-alive пулы http_client
+        session = AuthorizedSession(creds, auth_request=Request(session=http_client.get_session()))
+        return http_client.share_pools(session)
     except Exception as e:
         logger.error(f"Error initializing Google Sheets: {e}")
         return None
 
 
-def load_data_from_sheets():
-    """Загрузка данных из Google Sheets → возвращает (None, location_map)"""
+def get_client():
+    """Клиент Google Sheets, созданный при первом обращении (None, если недоступен)"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = init_gsheets()
+    return _client
+
+
+def batch_get_values(spreadsheet_id, ranges, client=None):
+    """Значения нескольких диапазонов одним запросом values:batchGet → список таблиц (по диапазону) или None"""
+    client = client or get_client()
+    if not client:
+        return None
+
+    params = [('ranges', value_range) for value_range in ranges]
+    params += [('majorDimension', 'ROWS'), ('fields', BATCH_GET_FIELDS)]
+    response = http_client.get(
+        f"{SHEETS_API_URL}/{spreadsheet_id}/values:batchGet",
+        params=params,
+        session=client,
+        timeout=15
+    )
     try:
-        client = init_gsheets()
-        if not client:
+        if response.status_code != 200:
+            logger.error(f"Sheets API error {response.status_code}: {response.text[:500]}")
             return None
+        return [value_range.get('values', []) for value_range in response.json().get('valueRanges', [])]
+    finally:
+        response.close()
 
+
+def load_data_from_sheets():
+    """Загрузка данных из Google Sheets → возвращает (None, location_map)"""
+    try:
         SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID')
         if not SPREADSHEET_ID:
             logger.error("SPREADSHEET_ID not set")
             return None
 
-        sheet = client.spreadsheets()
-        result = sheet.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range="Общий"
-        ).execute()
+        tables = batch_get_values(SPREADSHEET_ID, ['Общий'])
+        if tables is None:
+            return None
 
-        values = result.get('values', [])
+        values = tables[0] if tables else []
         if not values or len(values) < 2:
             logger.warning("No data in sheet")
             return None
@@ -0,0 +1,177 @@
+import os
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+# requests импортируется при создании сессии: процессу, который еще ничего
+# не запрашивал (холодный старт, проверка доступности), он не нужен
+requests = None
+
+logger = logging.getLogger(__name__)
+
+# Размеры пулов keep-alive соединений по хостам
+HTTP_POOL_SIZES = {
+    'api.telegram.org': int(os.environ.get('HTTP_POOL_TELEGRAM', 20)),
+    'docs.google.com': int(os.environ.get('HTTP_POOL_GOOGLE', 4)),
+    'sheets.googleapis.com': int(os.environ.get('HTTP_POOL_GOOGLE', 4)),
+    'oauth2.googleapis.com': 2,
+}
+HTTP_DEFAULT_POOL_SIZE = 4
+
+# Таймауты: на установку соединения и на чтение ответа (секунды)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+
+# Повторы при 429/5xx и сетевых ошибках
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', 0.5))
+# Дольше этого не ждем: отдаем ответ вызывающему коду как есть
+HTTP_BACKOFF_MAX = float(os.environ.get('HTTP_BACKOFF_MAX', 10))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Неидемпотентный запрос (POST sendMessage) после 5xx мог уже выполниться -
+# повторяем его только при 429, когда сервер точно его не обработал
+NON_IDEMPOTENT_RETRY_STATUSES = {429}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+_session = None
+_session_lock = threading.Lock()
+_stats_lock = threading.Lock()
+
+# Счетчики по хостам (отдаются в /debug)
+http_stats = {}
+
+
+def mount_pools(session):
+    """Подключение адаптеров с пулами соединений нужного размера к сессии"""
+    from requests.adapters import HTTPAdapter
+
+    default_adapter = HTTPAdapter(pool_connections=len(HTTP_POOL_SIZES) + 1,
+                                  pool_maxsize=HTTP_DEFAULT_POOL_SIZE)
+    session.mount('https://', default_adapter)
+    session.mount('http://', default_adapter)
+
+    for host, pool_size in HTTP_POOL_SIZES.items():
+        session.mount(f'https://{host}/', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    return session
+
+
+def share_pools(session):
+    """Подключение к другой сессии (например, авторизованной) тех же пулов соединений"""
+    for prefix, adapter in get_session().adapters.items():
+        session.mount(prefix, adapter)
+    return session
+
+
+def get_session():
+    """Общая сессия с keep-alive соединениями.
+
+    Одна сессия используется всеми потоками: пулы urllib3 потокобезопасны,
+    а соединения к api.telegram.org и docs.google.com переиспользуются
+    без повторного TCP/TLS рукопожатия.
+    """
+    global _session, requests
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                _session = mount_pools(requests.Session())
+    return _session
+
+
+def _count(host, key):
+    with _stats_lock:
+        host_stats = http_stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0})
+        host_stats[key] += 1
+
+
+def retry_after_seconds(response):
+    """Сколько ждать перед повтором по ответу сервера (None - не указано)"""
+    # Telegram сообщает паузу в теле ответа: {"parameters": {"retry_after": N}}
+    try:
+        retry_after = response.json().get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            return float(retry_after)
+    except Exception:
+        pass
+
+    header = response.headers.get('Retry-After')
+    if header and header.strip().isdigit():
+        return float(header)
+
+    return None
+
+
+def is_connect_error(error):
+    """Ошибка requests при установке соединения - запрос до сервера не дошел"""
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    # requests оборачивает MaxRetryError из urllib3, причина - в reason
+    reason = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+def request(method, url, timeout=None, retries=None, session=None, **kwargs):
+    """HTTP-запрос через общий пул с повторами для 429/5xx (POST - только для 429).
+
+    timeout - таймаут чтения (или кортеж (connect, read)), retries - число повторов.
+    Возвращает последний полученный ответ; исключение пробрасывается,
+    если ответа так и не было.
+    """
+    # Общая сессия нужна и для чужой session: вместе с ней импортируется requests
+    shared_session = get_session()
+    session = session or shared_session
+    retries = HTTP_MAX_RETRIES if retries is None else retries
+    if timeout is None:
+        timeout = HTTP_READ_TIMEOUT
+    if not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+
+    host = urlsplit(url).hostname or ''
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_statuses = RETRY_STATUSES if idempotent else NON_IDEMPOTENT_RETRY_STATUSES
+    attempt = 0
+
+    while True:
+        _count(host, 'requests')
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _count(host, 'errors')
+            # Повторяем только если запрос точно не ушел (соединение не установлено:
+            # отказ, сброс или таймаут при подключении, ошибка DNS) или он идемпотентный
+            retriable = idempotent or is_connect_error(e)
+            if not retriable or attempt >= retries:
+                raise
+            delay = min(HTTP_BACKOFF_BASE * (2 ** attempt), HTTP_BACKOFF_MAX)
+            logger.warning(f"{method} {host}: {e}, повтор через {delay:.1f} с")
+        else:
+            if response.status_code not in retry_statuses or attempt >= retries:
+                return response
+
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = HTTP_BACKOFF_BASE * (2 ** attempt)
+            if delay > HTTP_BACKOFF_MAX:
+                logger.warning(f"{method} {host}: {response.status_code}, пауза {delay:.0f} с слишком большая - не повторяем")
+                return response
+            # Возвращаем соединение в пул (важно для stream=True)
+            response.close()
+            logger.warning(f"{method} {host}: {response.status_code}, повтор через {delay:.1f} с")
+
+        attempt += 1
+        _count(host, 'retries')
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
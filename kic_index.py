@@ -0,0 +1,192 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Код КИЦ в строке таблицы: сначала ищем "№ 8598/0496", затем просто "8598/0496"
+KIC_CODE_RE = re.compile(r'№\s*(\d+)/(\d+)')
+KIC_CODE_ALT_RE = re.compile(r'(\d+)/(\d+)')
+
+# Запросы пользователя: диапазон "8598/0400-0499" или "8598/0400-8598/0499",
+# код или его начало "8598/0496", "8598/04", "8598/" и номер банка "8598"
+KIC_RANGE_QUERY_RE = re.compile(r'(\d+)\s*/\s*(\d+)\s*[-–—]\s*(?:(\d+)\s*/\s*)?(\d+)')
+KIC_CODE_QUERY_RE = re.compile(r'(\d+)\s*/\s*(\d*)')
+KIC_BANK_QUERY_RE = re.compile(r'^\s*№?\s*(\d{3,})\s*$')
+
+# Код хранится одним числом: (банк * KIC_WIDTH_BASE + число цифр отделения) * KIC_BRANCH_BASE
+# + номер отделения. Число цифр входит в код, поэтому "8369/018" и "8369/0018" - разные коды
+KIC_BRANCH_BASE = 10 ** 6
+KIC_WIDTH_BASE = 10
+
+
+def parse_kic_code(kic_text):
+    """Код КИЦ из строки таблицы → (банк, отделение, число цифр отделения) или None"""
+    match = KIC_CODE_RE.search(kic_text) or KIC_CODE_ALT_RE.search(kic_text)
+    if not match:
+        return None
+    branch = match.group(2)
+    if int(branch) >= KIC_BRANCH_BASE or len(branch) >= KIC_WIDTH_BASE:
+        return None
+    return int(match.group(1)), int(branch), len(branch)
+
+
+def encode_code(bank, branch, width):
+    return (bank * KIC_WIDTH_BASE + width) * KIC_BRANCH_BASE + branch
+
+
+class KicIndex:
+    """Индекс кодов КИЦ "банк/отделение".
+
+    Коды разобраны в числа и лежат в отсортированном массиве вместе
+    с номерами записей, поэтому точный код, все отделения банка и
+    диапазон отделений ищутся бинарным поиском: O(log n + k).
+    Внутри банка коды упорядочены по числу цифр номера, затем по номеру.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        entries = []
+        # Сколько цифр бывает в номере отделения (для поиска по началу номера)
+        self.branch_widths = set()
+
+        for record_id, record in enumerate(records):
+            code = parse_kic_code(record['kic'])
+            if code:
+                entries.append((encode_code(*code), record_id))
+                self.branch_widths.add(code[2])
+
+        entries.sort()
+        self.codes = array('Q', [code for code, _ in entries])
+        self.ids = array('I', [record_id for _, record_id in entries])
+
+    @classmethod
+    def from_arrays(cls, records, codes, ids, branch_widths):
+        """Индекс по готовым отсортированным массивам (например, из общего снимка)"""
+        index = object.__new__(cls)
+        index.records = records
+        index.codes = codes
+        index.ids = ids
+        index.branch_widths = set(branch_widths)
+        return index
+
+    def __len__(self):
+        """Число разных кодов КИЦ"""
+        return len(set(self.codes))
+
+    def copy(self, records):
+        """Новая версия индекса для измененных записей (исходный не меняется)"""
+        clone = object.__new__(KicIndex)
+        clone.records = records
+        clone.branch_widths = set(self.branch_widths)
+        clone.codes = array('Q', self.codes)
+        clone.ids = array('I', self.ids)
+        return clone
+
+    def _position(self, code, record_id):
+        position = bisect_left(self.codes, code)
+        while position < len(self.codes) and self.codes[position] == code and self.ids[position] < record_id:
+            position += 1
+        return position
+
+    def add(self, record_id, kic_text):
+        """Добавление записи по строке КИЦ"""
+        code = parse_kic_code(kic_text)
+        if code:
+            self.branch_widths.add(code[2])
+            code = encode_code(*code)
+            position = self._position(code, record_id)
+            self.codes.insert(position, code)
+            self.ids.insert(position, record_id)
+
+    def remove(self, record_id, kic_text):
+        """Удаление записи; kic_text - строка КИЦ, с которой она была добавлена"""
+        code = parse_kic_code(kic_text)
+        if code:
+            code = encode_code(*code)
+            position = self._position(code, record_id)
+            if position < len(self.codes) and self.codes[position] == code and self.ids[position] == record_id:
+                del self.codes[position]
+                del self.ids[position]
+
+    def _collect(self, spans, order):
+        """Номера записей с кодами из интервалов spans (отсортированных и непересекающихся)"""
+        codes = []
+        ids = []
+        for low, high in spans:
+            start = bisect_left(self.codes, low)
+            end = bisect_right(self.codes, high)
+            codes.extend(self.codes[start:end])
+            ids.extend(self.ids[start:end])
+        if order is None:
+            return ids
+        return [record_id for _, _, record_id in sorted(zip(codes, map(order, ids), ids))]
+
+    def range(self, low, high, order=None):
+        """Номера записей с кодами от low до high включительно; low, high - (банк, отделение).
+
+        Номера отделений сравниваются как числа, при любом числе цифр.
+        Записи с одинаковым кодом идут по номеру или по order(record_id), если он задан.
+        """
+        (low_bank, low_branch), (high_bank, high_branch) = low, high
+        spans = []
+        for width in self.branch_widths:
+            if low_bank == high_bank:
+                spans.append((encode_code(low_bank, low_branch, width), encode_code(high_bank, high_branch, width)))
+            else:
+                spans.append((encode_code(low_bank, low_branch, width),
+                              encode_code(low_bank, KIC_BRANCH_BASE - 1, width)))
+                spans.append((encode_code(high_bank, 0, width), encode_code(high_bank, high_branch, width)))
+        if high_bank - low_bank > 1:
+            # Банки между крайними - целиком
+            spans.append((encode_code(low_bank + 1, 0, 0),
+                          encode_code(high_bank - 1, KIC_BRANCH_BASE - 1, KIC_WIDTH_BASE - 1)))
+        return self._collect(sorted(spans), order)
+
+    def exact(self, bank, branch, width, order=None):
+        """Номера записей с кодом bank/branch из width цифр"""
+        code = encode_code(bank, branch, width)
+        return self._collect([(code, code)], order)
+
+    def bank(self, bank, order=None):
+        """Номера записей всех отделений банка"""
+        return self._collect([(encode_code(bank, 0, 0),
+                               encode_code(bank, KIC_BRANCH_BASE - 1, KIC_WIDTH_BASE - 1))], order)
+
+    def branch_prefix(self, bank, digits, order=None):
+        """Номера записей отделений банка, номер которых начинается с digits ("04" → 0400-0499)"""
+        # Диапазон номеров для каждой встречающейся длины номера, длиннее digits
+        spans = []
+        for width in self.branch_widths:
+            if width > len(digits):
+                scale = 10 ** (width - len(digits))
+                spans.append((encode_code(bank, int(digits) * scale, width),
+                              encode_code(bank, (int(digits) + 1) * scale - 1, width)))
+        return self._collect(sorted(spans), order)
+
+    def lookup(self, text, order=None):
+        """Поиск по тексту запроса → (номера записей, найденный в тексте код) или None, если это не код КИЦ
+
+        order(record_id) - порядок записей с одинаковым кодом (по умолчанию - номер).
+        """
+        match = KIC_RANGE_QUERY_RE.search(text)
+        if match:
+            bank = int(match.group(1))
+            high_bank = int(match.group(3)) if match.group(3) else bank
+            low, high = (bank, int(match.group(2))), (high_bank, int(match.group(4)))
+            return self.range(min(low, high), max(low, high), order), match.group(0)
+
+        match = KIC_CODE_QUERY_RE.search(text)
+        if match:
+            bank, digits = int(match.group(1)), match.group(2)
+            if not digits:
+                return self.bank(bank, order), match.group(0)
+            # Номер встречающейся длины - точный код (с теми же нулями впереди),
+            # иначе - начало более длинных номеров ("04" → 0400-0499)
+            if len(digits) in self.branch_widths:
+                return self.exact(bank, int(digits), len(digits), order), match.group(0)
+            return self.branch_prefix(bank, digits, order), match.group(0)
+
+        match = KIC_BANK_QUERY_RE.match(text)
+        if match:
+            return self.bank(int(match.group(1)), order), match.group(1)
+
+        return None
@@ -0,0 +1,202 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Границы корзин для размеров (байты)
+SIZE_BUCKETS = (1024, 10240, 102400, 512000, 1048576, 5242880, 10485760, 52428800)
+
+_registry = []
+_local = threading.local()
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Базовый класс метрики: значения по наборам меток"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    """Счетчик (только растет)"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение; callback() вызывается при каждом чтении метрик"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def render(self):
+        if self.callback is not None:
+            value = self.callback()
+            with self.lock:
+                self.values = {} if value is None else {(): value}
+        return super().render()
+
+
+class Histogram(Metric):
+    """Гистограмма: число наблюдений по корзинам, их сумма и количество"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Счетчики по корзинам (последняя - +Inf), сумма, количество
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][position] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, stage=None, **labels):
+        """Замер времени блока; stage - имя этапа в разбивке времени запроса"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(elapsed, **labels)
+            if stage:
+                record_stage(stage, elapsed)
+
+    def _render_value(self, label_values, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = format_labels(self.label_names, label_values, [('le', format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTiming:
+    """Разбивка времени одного запроса по этапам"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {
+            'request': self.name,
+            'total_ms': round(self.total() * 1000, 3),
+            'stages_ms': [[stage, round(seconds * 1000, 3)] for stage, seconds in self.stages]
+        }
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing"""
+        parts = [f"{stage.replace(' ', '_')};dur={seconds * 1000:.3f}" for stage, seconds in self.stages]
+        parts.append(f"total;dur={self.total() * 1000:.3f}")
+        return ', '.join(parts)
+
+
+def start_request_timing(name, sample_rate):
+    """Начало разбивки времени для текущего потока (с вероятностью sample_rate)"""
+    timing = RequestTiming(name) if sample_rate and random.random() < sample_rate else None
+    _local.timing = timing
+    return timing
+
+
+def finish_request_timing():
+    timing = getattr(_local, 'timing', None)
+    _local.timing = None
+    return timing
+
+
+def record_stage(stage, seconds):
+    """Добавление этапа в разбивку текущего запроса (если она ведется)"""
+    timing = getattr(_local, 'timing', None)
+    if timing is not None:
+        timing.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Замер этапа только для разбивки времени текущего запроса (без метрики)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
@@ -0,0 +1,93 @@
+import heapq
+import threading
+
+
+class SpaceSaving:
+    """Самые частые ключи потока (алгоритм Space-Saving) в ограниченной памяти.
+
+    Хранится не больше capacity счетчиков. Новый ключ при заполненной таблице
+    занимает счетчик самого редкого: получает его значение + 1, а это значение
+    запоминается как возможная переоценка (error). Ключи с частотой больше
+    n / capacity (n - всего событий) гарантированно остаются в таблице.
+
+    Первые top_n ключей пересчитываются только когда учтенный ключ может
+    изменить их состав или порядок; при изменении растет version.
+    """
+
+    def __init__(self, capacity=200, top_n=12):
+        self.capacity = capacity
+        self.top_n = top_n
+        self.counts = {}  # ключ → счетчик
+        self.errors = {}  # ключ → возможная переоценка счетчика
+        self.total = 0
+        self.top = []
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        """Учет события; True, если изменились первые top_n ключей"""
+        with self.lock:
+            self.total += 1
+            counts = self.counts
+            replaced = None
+            if key in counts:
+                counts[key] += 1
+            elif len(counts) < self.capacity:
+                counts[key] = 1
+                self.errors[key] = 0
+            else:
+                # Поиск самого редкого - O(capacity), но только для ключа не из таблицы
+                replaced = min(counts, key=counts.get)
+                count = counts.pop(replaced)
+                del self.errors[replaced]
+                counts[key] = count + 1
+                self.errors[key] = count
+
+            top = self.top
+            if (len(top) < self.top_n or key in top or replaced in top
+                    or counts[key] >= counts[top[-1]]):
+                return self._update_top()
+            return False
+
+    def _update_top(self):
+        top = [key for key, _ in heapq.nsmallest(self.top_n, self.counts.items(),
+                                                 key=lambda item: (-item[1], item[0]))]
+        if top == self.top:
+            return False
+        self.top = top
+        self.version += 1
+        return True
+
+    def get_top(self):
+        """Первые top_n ключей → (version, [(ключ, счетчик), ...])"""
+        with self.lock:
+            return self.version, [(key, self.counts[key]) for key in self.top]
+
+    def to_state(self):
+        """Состояние для сохранения в файл"""
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'total': self.total,
+                'counters': [[key, count, self.errors[key]] for key, count in self.counts.items()],
+            }
+
+    def load_state(self, state):
+        """Восстановление из to_state(); при меньшей емкости остаются самые частые"""
+        counters = sorted(state['counters'], key=lambda counter: -counter[1])[:self.capacity]
+        with self.lock:
+            self.counts = {key: count for key, count, _ in counters}
+            self.errors = {key: error for key, _, error in counters}
+            self.total = state.get('total', sum(self.counts.values()))
+            self._update_top()
+
+    def get_stats(self):
+        """Счетчики для /debug"""
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'tracked': len(self.counts),
+                'total': self.total,
+                'version': self.version,
+                'top': [[key, self.counts[key], self.errors[key]] for key in self.top],
+            }
@@ -0,0 +1,116 @@
+import sys
+from operator import attrgetter, itemgetter
+
+# Поля записи в порядке столбцов таблицы
+RECORD_FIELDS = ('locality', 'type', 'kic', 'address', 'fio', 'phone', 'email')
+
+
+class Record:
+    """Компактная запись таблицы.
+
+    __slots__ вместо словаря на каждую строку, а повторяющиеся строки
+    (КИЦ, адрес, ФИО, телефон, email) - общие объекты из StringPool.
+    Доступ record['field'] оставлен для совместимости с кодом, работавшим со словарями.
+    """
+
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, locality='', type='', kic='', address='', fio='', phone='', email=''):
+        self.locality = locality
+        self.type = type
+        self.kic = kic
+        self.address = address
+        self.fio = fio
+        self.phone = phone
+        self.email = email
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __repr__(self):
+        return f"Record({self.locality!r}, {self.type!r}, {self.kic!r})"
+
+    def to_row(self):
+        """Значения полей списком (для снимка на диске)"""
+        return [getattr(self, field) for field in RECORD_FIELDS]
+
+
+class StringPool:
+    """Словарь строк: одинаковые значения хранятся одним объектом"""
+
+    def __init__(self):
+        self.strings = {}
+
+    def get(self, value):
+        return self.strings.setdefault(value, value)
+
+
+_row_getter = itemgetter(*RECORD_FIELDS)
+# Значения полей записи кортежем
+record_values = attrgetter(*RECORD_FIELDS)
+
+
+def row_values(data):
+    """Очищенные значения полей строки из словаря (кортежем)"""
+    return tuple(map(str.strip, _row_getter(data)))
+
+
+def make_record(data, pool):
+    """Запись из словаря (или другой записи) с общими строками из пула"""
+    return Record(*map(pool.get, row_values(data)))
+
+
+def memory_report(records, pool, indexes):
+    """Оценка памяти, занимаемой записями и индексами (байты)"""
+    records_bytes = sum(sys.getsizeof(record) for record in records)
+    strings_bytes = sum(sys.getsizeof(value) for value in pool.strings)
+
+    # Сколько заняли бы те же данные словарями без общих строк
+    sample_dict = dict.fromkeys(RECORD_FIELDS, '')
+    dict_bytes = sys.getsizeof(sample_dict) * len(records) + sum(
+        sys.getsizeof(record[field]) for record in records for field in RECORD_FIELDS)
+
+    report = {
+        'records': len(records),
+        'unique_strings': len(pool.strings),
+        'records_bytes': records_bytes,
+        'strings_bytes': strings_bytes,
+        'dict_rows_equivalent_bytes': dict_bytes,
+        'indexes_bytes': {},
+    }
+
+    for name, index in indexes.items():
+        report['indexes_bytes'][name] = estimate_size(index)
+
+    report['total_bytes'] = records_bytes + strings_bytes + sum(report['indexes_bytes'].values())
+    return report
+
+
+def estimate_size(obj, depth=3):
+    """Грубая оценка размера объекта вместе с вложенными контейнерами.
+
+    Строки внутри списков и записи не считаются: они общие с записями.
+    """
+    size = sys.getsizeof(obj)
+    if depth == 0 or isinstance(obj, (str, Record)):
+        return size
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(key, str):
+                size += sys.getsizeof(key)
+            if not isinstance(value, (str, Record)):
+                size += estimate_size(value, depth - 1)
+    elif isinstance(obj, (list, set, tuple)):
+        for value in obj:
+            if isinstance(value, (dict, list, set, tuple)):
+                size += estimate_size(value, depth - 1)
+    elif hasattr(obj, '__dict__'):
+        for name, value in vars(obj).items():
+            if name != 'records' and isinstance(value, (dict, list, set, tuple)):
+                size += estimate_size(value, depth - 1)
+
+    return size
@@ -0,0 +1,264 @@
+import logging
+import random
+import re
+import html
+
+logger = logging.getLogger(__name__)
+
+# Доля отрисовок, попадающих в отладочный лог (вместо логирования каждой записи)
+RENDER_LOG_SAMPLE_RATE = 0.01
+
+
+def extract_kic_info(kic_text):
+    """Извлекает информацию о КИЦ из строки"""
+    # Ищем номер ДО
+    do_match = re.search(r'ДО\s*№\s*(\d+/\d+)', kic_text)
+    do_number = do_match.group(1) if do_match else ""
+
+    # Ищем название КИЦ (всё после "КИЦ")
+    kic_name_match = re.search(r'КИЦ\s*(.+)', kic_text)
+    if kic_name_match:
+        kic_name = kic_name_match.group(1).strip()
+    else:
+        # Если нет "КИЦ", используем всю строку
+        kic_name = kic_text.strip()
+
+    return do_number, kic_name
+
+
+def clean_phone_number(phone):
+    """Очищает номер телефона для ссылки tel:"""
+    if not phone:
+        return ""
+
+    # Убираем все символы, кроме цифр и плюса
+    cleaned = re.sub(r'[^\d+]', '', phone)
+
+    # Если номер начинается с 8 и имеет 11 цифр, заменяем 8 на 7
+    if len(cleaned) == 11 and cleaned.startswith('8'):
+        cleaned = '7' + cleaned[1:]
+
+    # Если номер имеет 10 цифр (без кода страны), добавляем 7
+    elif len(cleaned) == 10:
+        cleaned = '7' + cleaned
+
+    # Если нет плюса в начале, добавляем его
+    if cleaned and not cleaned.startswith('+'):
+        if cleaned.startswith('7'):
+            cleaned = '+' + cleaned
+        else:
+            cleaned = '+7' + cleaned
+
+    # Убираем все символы, кроме цифр и плюса в начале
+    if cleaned.startswith('+'):
+        country_code = '+'
+        digits = cleaned[1:]
+    else:
+        country_code = ''
+        digits = cleaned
+
+    # Оставляем только цифры
+    digits = re.sub(r'\D', '', digits)
+
+    return country_code + digits
+
+
+def format_record_title(record):
+    """Населенный пункт и его тип (с экранированием HTML)"""
+    return f"{html.escape(record['locality'])} ({html.escape(record['type'])})"
+
+
+def format_record_header(record):
+    """Заголовок карточки: населенный пункт и его тип"""
+    return f"<b>📍 Населенный пункт:</b> {format_record_title(record)}\n\n"
+
+
+def format_record_body(record):
+    """Тело карточки: КИЦ и контакты РКИЦ с кликабельными ссылками.
+
+    Зависит только от полей КИЦ, поэтому одинаково для всех
+    населенных пунктов одного КИЦ.
+    """
+    do_number, kic_name = extract_kic_info(record['kic'])
+
+    kic_display = record['kic']
+    if do_number and kic_name:
+        kic_display = f"ДО №{do_number} КИЦ {kic_name}"
+
+    # Очищаем номер телефона для ссылки
+    phone_cleaned = clean_phone_number(record['phone'])
+
+    # Экранируем HTML-сущности в тексте (кроме ссылок)
+    kic_display_escaped = html.escape(kic_display)
+    address_escaped = html.escape(record['address'])
+    fio_escaped = html.escape(record['fio'])
+    phone_display = html.escape(record['phone']) if record['phone'] else ""
+    email_display = html.escape(record['email']) if record['email'] else ""
+
+    # Формируем HTML-сообщение с кликабельными ссылками
+    html_message = (
+        f"<b>🏢 КИЦ:</b> {kic_display_escaped}\n"
+        f"<b>📫 Адрес КИЦ:</b> {address_escaped}\n\n"
+        f"<b>👤 РКИЦ:</b> {fio_escaped}\n"
+    )
+
+    # Добавляем кликабельный телефон с правильным форматом
+    if phone_cleaned and record['phone']:
+        # Для телефона используем формат +79991234567
+        # Убедимся, что номер начинается с +
+        if not phone_cleaned.startswith('+'):
+            phone_cleaned = '+' + phone_cleaned
+
+        html_message += f'<b>📞 Телефон:</b> <a href="tel:{phone_cleaned}">{phone_display}</a>\n'
+    elif record['phone']:
+        html_message += f"<b>📞 Телефон:</b> {phone_display}\n"
+
+    # Добавляем кликабельный email
+    if record['email']:
+        # Очищаем email от лишних пробелов
+        email_clean = record['email'].strip()
+        html_message += f'<b>📧 Email:</b> <a href="mailto:{email_clean}">{email_display}</a>\n'
+
+    html_message += (
+        f"\n<b>📊 Источник:</b> база знаний\n"
+        f"<i>🔄 Для нового поиска используйте кнопки ниже</i>"
+    )
+
+    return html_message
+
+
+def format_record(record):
+    """Форматирование записи для отображения с кликабельными ссылками"""
+    return format_record_header(record) + format_record_body(record)
+
+
+def format_kic_suffix(kic_text):
+    """Номер ДО и название КИЦ для строки списка совпадений"""
+    do_number, kic_name = extract_kic_info(kic_text)
+    suffix = ""
+    if do_number:
+        suffix += f" ДО №{do_number}"
+    if kic_name:
+        suffix += f" КИЦ {html.escape(kic_name)}"
+    return suffix
+
+
+def format_record_line(record):
+    """Строка записи для списка совпадений (без номера)"""
+    return format_record_title(record) + format_kic_suffix(record['kic'])
+
+
+def record_body_key(record):
+    return (record['kic'], record['address'], record['fio'], record['phone'], record['email'])
+
+
+class MessageCache:
+    """Готовые тексты ответов по номеру записи.
+
+    Заполняется при построении индексов. Тело карточки (КИЦ и контакты)
+    и хвост строки списка зависят только от КИЦ, поэтому хранятся одним
+    объектом на КИЦ; у записи - только свой заголовок и ссылки на общие части.
+    Общие части из предыдущего кэша переиспользуются по содержимому:
+    регулярные выражения и экранирование выполняются заново только
+    для изменившихся КИЦ. Части, которые больше не нужны ни одной записи,
+    убираются prune_memo() после изменений по месту.
+    """
+
+    def __init__(self, records, previous=None):
+        self.records = records
+        self.titles = []
+        self.bodies = []
+        self.suffixes = []
+        self.rendered = 0  # сколько общих частей пришлось отрисовать заново
+
+        self.body_memo = {}
+        self.suffix_memo = {}
+        self.memo_added = 0
+        old_bodies = previous.body_memo if previous is not None else {}
+        old_suffixes = previous.suffix_memo if previous is not None else {}
+
+        for record in records:
+            self.append(record, old_bodies, old_suffixes)
+        # Сколько общих частей добавлено после последней очистки (prune_memo)
+        self.memo_added = 0
+
+    def copy(self, records):
+        """Новая версия кэша для измененных записей (исходный не меняется)"""
+        clone = object.__new__(MessageCache)
+        clone.records = records
+        clone.titles = list(self.titles)
+        clone.bodies = list(self.bodies)
+        clone.suffixes = list(self.suffixes)
+        clone.rendered = 0
+        clone.body_memo = dict(self.body_memo)
+        clone.suffix_memo = dict(self.suffix_memo)
+        clone.memo_added = self.memo_added
+        return clone
+
+    def append(self, record, old_bodies=None, old_suffixes=None):
+        """Тексты для следующей записи"""
+        self.set(len(self.titles), record, old_bodies, old_suffixes)
+
+    def set(self, record_id, record, old_bodies=None, old_suffixes=None):
+        """Тексты для записи с номером record_id (новой, если номер равен числу записей)"""
+        body_key = record_body_key(record)
+        body = self.body_memo.get(body_key)
+        if body is None:
+            body = old_bodies.get(body_key) if old_bodies else None
+            if body is None:
+                body = format_record_body(record)
+                self.rendered += 1
+            self.body_memo[body_key] = body
+            self.memo_added += 1
+
+        kic = record['kic']
+        suffix = self.suffix_memo.get(kic)
+        if suffix is None:
+            suffix = old_suffixes.get(kic) if old_suffixes else None
+            if suffix is None:
+                suffix = format_kic_suffix(kic)
+                self.rendered += 1
+            self.suffix_memo[kic] = suffix
+            self.memo_added += 1
+
+        title = format_record_title(record)
+        if record_id == len(self.titles):
+            self.titles.append(title)
+            self.bodies.append(body)
+            self.suffixes.append(suffix)
+        else:
+            self.titles[record_id] = title
+            self.bodies[record_id] = body
+            self.suffixes[record_id] = suffix
+
+    def prune_memo(self, ratio=0.1):
+        """Удаление общих частей, не нужных ни одной записи.
+
+        Проход по всем записям выполняется, только когда после прошлой очистки
+        добавилось больше ratio от размера словарей, поэтому в среднем он
+        стоит пропорционально числу изменений.
+        """
+        if self.memo_added <= max(len(self.body_memo), len(self.suffix_memo)) * ratio:
+            return
+        used_bodies = {record_body_key(record) for record in self.records}
+        used_suffixes = {record['kic'] for record in self.records}
+        self.body_memo = {key: body for key, body in self.body_memo.items() if key in used_bodies}
+        self.suffix_memo = {kic: suffix for kic, suffix in self.suffix_memo.items() if kic in used_suffixes}
+        self.memo_added = 0
+
+    def pop(self):
+        """Удаление текстов последней записи"""
+        self.titles.pop()
+        self.bodies.pop()
+        self.suffixes.pop()
+
+    def card(self, record_id):
+        """Полная карточка записи"""
+        if RENDER_LOG_SAMPLE_RATE and logger.isEnabledFor(logging.DEBUG) and random.random() < RENDER_LOG_SAMPLE_RATE:
+            record = self.records[record_id]
+            logger.debug(f"Карточка записи {record_id}: {record['locality']}, телефон '{record['phone']}', email '{record['email']}'")
+        return f"<b>📍 Населенный пункт:</b> {self.titles[record_id]}\n\n{self.bodies[record_id]}"
+
+    def line(self, record_id):
+        """Строка записи для списка совпадений"""
+        return self.titles[record_id] + self.suffixes[record_id]
@@ -0,0 +1,147 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Найденные наборы результатов по короткому ключу (для листания страниц).
+
+    Набор сохраняется один раз при поиске, а кнопки "◀/▶" передают только
+    ключ и номер страницы, поэтому перелистывание не повторяет поиск.
+    Размер ограничен max_size (вытесняются самые старые), записи живут ttl секунд.
+    """
+
+    def __init__(self, max_size=1000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # ключ → (время сохранения, набор)
+        self.lock = threading.Lock()
+        self.stats = {
+            'stored': 0,
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
+
+    def put(self, value):
+        """Сохранение набора → ключ (8 символов, помещается в callback_data)"""
+        token = secrets.token_urlsafe(6)
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            self.entries[token] = (now, value)
+            self.stats['stored'] += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evicted'] += 1
+        return token
+
+    def get(self, token):
+        """Набор по ключу или None, если его нет или он устарел"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if now - entry[0] > self.ttl:
+                del self.entries[token]
+                self.stats['expired'] += 1
+                return None
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def has(self, token):
+        """Есть ли еще набор с таким ключом (без учета в счетчиках)"""
+        with self.lock:
+            entry = self.entries.get(token)
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl
+
+    def _expire(self, now):
+        # Записи упорядочены по времени сохранения - устаревшие в начале
+        while self.entries:
+            token, (stored, _) = next(iter(self.entries.items()))
+            if now - stored <= self.ttl:
+                break
+            del self.entries[token]
+            self.stats['expired'] += 1
+
+    def get_stats(self):
+        """Счетчики для /debug"""
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl_seconds': self.ttl, **self.stats}
+
+
+class ReplyCache:
+    """Готовые ответы (текст и клавиатура) по нормализованному запросу.
+
+    Ответ зависит только от текста запроса и данных, поэтому хранится вместе
+    с версией данных: при первом обращении с более новой версией кэш очищается
+    целиком, а запросы, еще работающие со старой версией, его не трогают.
+    Размер ограничен max_size, вытесняются давно не запрашивавшиеся ответы (LRU).
+    """
+
+    def __init__(self, max_size=2000):
+        self.max_size = max_size
+        self.version = None
+        self.entries = OrderedDict()  # запрос → ответ
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evicted': 0,
+            'invalidated': 0,
+        }
+
+    def _check_version(self, version):
+        """Переход на новую версию данных; False - версия старше текущей"""
+        if self.version is not None and version < self.version:
+            return False
+        if version != self.version:
+            self.stats['invalidated'] += len(self.entries)
+            self.entries.clear()
+            self.version = version
+        return True
+
+    def get(self, query, version, valid=None):
+        """Ответ на запрос для версии данных version или None
+
+        valid(reply) - дополнительная проверка ответа; непрошедший ее удаляется.
+        """
+        with self.lock:
+            reply = self.entries.get(query) if self._check_version(version) else None
+            if reply is not None and valid is not None and not valid(reply):
+                del self.entries[query]
+                reply = None
+            if reply is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(query)
+            self.stats['hits'] += 1
+            return reply
+
+    def put(self, query, version, reply):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if not self._check_version(version):
+                return
+            self.entries[query] = reply
+            self.entries.move_to_end(query)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def get_stats(self):
+        """Счетчики для /debug"""
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'data_version': self.version,
+                'hit_ratio': round(self.stats['hits'] / lookups, 3) if lookups else None,
+                **self.stats,
+            }
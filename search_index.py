@@ -0,0 +1,552 @@
+import heapq
+import logging
+import threading
+from array import array
+from bisect import bisect_left, insort
+
+logger = logging.getLogger(__name__)
+
+# Длина n-граммы для индекса подстрок
+NGRAM_SIZE = 3
+# Сколько подсказок отдавать по префиксу
+PREFIX_RESULTS_LIMIT = 10
+
+
+def iter_ngrams(text, n=NGRAM_SIZE):
+    """Все n-граммы строки (без повторов)"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class TrigramIndex:
+    """Инвертированный индекс триграмм по названиям населенных пунктов.
+
+    Для каждой триграммы хранит отсортированный массив номеров записей
+    (позиции в records), в названии которых она встречается. Поиск подстроки
+    берет самый короткий из списков триграмм запроса и проверяет только его.
+    Массивы array('I') занимают 4 байта на номер вместо объекта int в множестве.
+    """
+
+    def __init__(self, records, keys=None):
+        self.records = records
+        # Названия в нижнем регистре, чтобы не вызывать lower() на каждом запросе
+        self.keys = keys if keys is not None else [record['locality'].lower() for record in records]
+        postings = {}
+
+        for record_id, key in enumerate(self.keys):
+            for gram in iter_ngrams(key):
+                ids = postings.get(gram)
+                if ids is None:
+                    postings[gram] = [record_id]
+                else:
+                    ids.append(record_id)
+
+        # Номера добавлялись по возрастанию, списки уже отсортированы
+        self.postings = {gram: array('I', ids) for gram, ids in postings.items()}
+        # Триграммы, массивы которых принадлежат только этой версии индекса
+        self.owned = set()
+
+        logger.info(f"Индекс триграмм построен: {len(self.keys)} записей, {len(self.postings)} триграмм")
+
+    @classmethod
+    def from_postings(cls, records, keys, postings):
+        """Индекс по готовым спискам триграмм (например, из общего снимка)"""
+        index = object.__new__(cls)
+        index.records = records
+        index.keys = keys
+        index.postings = postings
+        index.owned = set()
+        return index
+
+    def copy(self, records, keys):
+        """Новая версия индекса для измененных записей.
+
+        Массивы общие с исходным индексом, пока их не изменят (копирование
+        при записи), поэтому исходный индекс остается корректным для читателей.
+        """
+        clone = object.__new__(TrigramIndex)
+        clone.records = records
+        clone.keys = keys
+        clone.postings = dict(self.postings)
+        clone.owned = set()
+        return clone
+
+    def _writable(self, gram):
+        ids = self.postings.get(gram)
+        if gram not in self.owned:
+            ids = array('I', ids) if ids is not None else array('I')
+            self.postings[gram] = ids
+            self.owned.add(gram)
+        return ids
+
+    def add(self, record_id, key):
+        """Добавление записи с названием key (в нижнем регистре)"""
+        for gram in iter_ngrams(key):
+            ids = self._writable(gram)
+            ids.insert(bisect_left(ids, record_id), record_id)
+
+    def remove(self, record_id, key):
+        """Удаление записи; key - название, с которым она была добавлена"""
+        for gram in iter_ngrams(key):
+            ids = self._writable(gram)
+            position = bisect_left(ids, record_id)
+            if position < len(ids) and ids[position] == record_id:
+                del ids[position]
+            if not ids:
+                del self.postings[gram]
+                self.owned.discard(gram)
+
+    def candidate_ids(self, search_lower):
+        """Номера записей, которые могут содержать подстроку (в порядке таблицы)"""
+        if len(search_lower) < NGRAM_SIZE:
+            # Короткий запрос - триграмм нет, проверяем все названия
+            return range(len(self.keys))
+
+        shortest = None
+        for gram in iter_ngrams(search_lower):
+            ids = self.postings.get(gram)
+            if not ids:
+                return []
+            if shortest is None or len(ids) < len(shortest):
+                shortest = ids
+
+        return shortest
+
+    def search(self, search_lower):
+        """Номера записей, название которых содержит подстроку (в порядке таблицы)"""
+        keys = self.keys
+        return [record_id for record_id in self.candidate_ids(search_lower)
+                if search_lower in keys[record_id]]
+
+
+class PrefixIndex:
+    """Отсортированный массив названий для поиска по префиксу.
+
+    Поиск - бинарный поиск начала диапазона и проход по первым limit
+    подходящим названиям: O(len(prefix) * log n + k), без обхода всех записей.
+    """
+
+    def __init__(self, records, keys=None):
+        self.records = records
+        if keys is None:
+            keys = [record['locality'].lower() for record in records]
+        entries = sorted((key, record_id) for record_id, key in enumerate(keys))
+        self.keys = [key for key, _ in entries]
+        self.ids = [record_id for _, record_id in entries]
+
+    @classmethod
+    def from_order(cls, records, keys, ids):
+        """Индекс по готовому порядку записей (номера, отсортированные по названию)"""
+        index = object.__new__(cls)
+        index.records = records
+        index.keys = [keys[record_id] for record_id in ids]
+        index.ids = ids
+        return index
+
+    def copy(self, records):
+        """Новая версия индекса для измененных записей"""
+        clone = object.__new__(PrefixIndex)
+        clone.records = records
+        clone.keys = list(self.keys)
+        clone.ids = list(self.ids)
+        return clone
+
+    def _position(self, key, record_id):
+        """Позиция пары (название, номер) в отсортированных массивах"""
+        keys = self.keys
+        position = bisect_left(keys, key)
+        while position < len(keys) and keys[position] == key and self.ids[position] < record_id:
+            position += 1
+        return position
+
+    def add(self, record_id, key):
+        """Добавление записи с названием key (в нижнем регистре)"""
+        position = self._position(key, record_id)
+        self.keys.insert(position, key)
+        self.ids.insert(position, record_id)
+
+    def remove(self, record_id, key):
+        """Удаление записи; key - название, с которым она была добавлена"""
+        position = self._position(key, record_id)
+        if position < len(self.keys) and self.keys[position] == key and self.ids[position] == record_id:
+            del self.keys[position]
+            del self.ids[position]
+
+    def exact(self, key):
+        """Номера записей с точно таким названием (по возрастанию)"""
+        keys = self.keys
+        position = bisect_left(keys, key)
+        result = []
+        while position < len(keys) and keys[position] == key:
+            result.append(self.ids[position])
+            position += 1
+        return result
+
+    def search(self, prefix_lower, limit=PREFIX_RESULTS_LIMIT, order=None):
+        """Номера записей, название которых начинается с префикса (по алфавиту).
+
+        order(record_id) - порядок записей с одинаковым названием (по умолчанию - номер).
+        """
+        if not prefix_lower:
+            return []
+
+        keys = self.keys
+        start = position = bisect_left(keys, prefix_lower)
+        end = min(position + limit, len(keys))
+        if order is not None and end > start:
+            # Последнее название могут делить и следующие записи - берем их всех
+            while end < len(keys) and keys[end] == keys[end - 1]:
+                end += 1
+
+        result = []
+        while position < end and keys[position].startswith(prefix_lower):
+            result.append(self.ids[position])
+            position += 1
+
+        if order is not None:
+            result = [record_id for _, _, record_id in
+                      sorted((keys[start + i], order(record_id), record_id) for i, record_id in enumerate(result))]
+        return result[:limit]
+
+    def iter_prefix(self, prefix_lower):
+        """Все номера записей, название которых начинается с префикса (по алфавиту)"""
+        keys = self.keys
+        position = bisect_left(keys, prefix_lower)
+        while position < len(keys) and keys[position].startswith(prefix_lower):
+            yield self.ids[position]
+            position += 1
+
+
+# Уровни релевантности совпадения (меньше - лучше)
+TIER_EXACT = 0  # название совпадает с запросом
+TIER_WORD_PREFIX = 1  # название начинается с запроса целым словом ("новый" → "новый уренгой")
+TIER_PREFIX = 2  # название начинается с запроса
+TIER_INNER_WORD = 3  # с запроса начинается слово внутри названия ("уренг" → "новый уренгой")
+TIER_SUBSTRING = 4  # запрос внутри слова
+
+# Порядок типов населенных пунктов при одинаковой релевантности (остальные - после них)
+LOCALITY_TYPE_ORDER = ('город', 'поселок городского типа', 'пгт', 'рабочий поселок', 'поселок',
+                       'село', 'станица', 'деревня', 'хутор')
+_type_ranks = {}
+
+
+def type_rank(locality_type):
+    """Место типа населенного пункта в LOCALITY_TYPE_ORDER"""
+    rank = _type_ranks.get(locality_type)
+    if rank is None:
+        name = normalize_name(locality_type)
+        rank = LOCALITY_TYPE_ORDER.index(name) if name in LOCALITY_TYPE_ORDER else len(LOCALITY_TYPE_ORDER)
+        _type_ranks[locality_type] = rank
+    return rank
+
+
+def match_tier(key, query):
+    """Уровень совпадения названия key с запросом (оба в нижнем регистре) или None"""
+    if key.startswith(query):
+        if len(key) == len(query):
+            return TIER_EXACT
+        return TIER_PREFIX if key[len(query)].isalnum() else TIER_WORD_PREFIX
+
+    position = key.find(query, 1)
+    if position < 0:
+        return None
+    while position > 0:
+        if not key[position - 1].isalnum():
+            return TIER_INNER_WORD
+        position = key.find(query, position + 1)
+    return TIER_SUBSTRING
+
+
+def rank_matches(records, keys, candidate_ids, query, limit, accept=None, positions=None):
+    """Лучшие limit совпадений среди кандидатов → номера записей по релевантности.
+
+    Порядок: уровень совпадения, тип населенного пункта, длина названия,
+    порядок в таблице (positions - позиции записей, None - совпадает с номером).
+    В куче хранятся только limit лучших; если номера идут в порядке таблицы,
+    просмотр прекращается, когда все они - точные совпадения лучшего типа
+    (кандидаты идут по возрастанию номера или по алфавиту, лучше уже не будет).
+    accept(record_id, key) - дополнительный фильтр кандидатов.
+    """
+    if limit is not None and limit <= 0:
+        return []
+
+    heap = []  # (-уровень, -тип, -длина, -позиция, номер): на вершине худший из отобранных
+    for record_id in candidate_ids:
+        key = keys[record_id]
+        tier = match_tier(key, query)
+        if tier is None:
+            continue
+
+        position = positions[record_id] if positions is not None else record_id
+        entry = (-tier, -type_rank(records[record_id]['type']), -len(key), -position, record_id)
+        full = limit is not None and len(heap) == limit
+        # Фильтр - только для тех, кто попадет в кучу (порог со временем только растет)
+        if (full and entry <= heap[0]) or (accept is not None and not accept(record_id, key)):
+            continue
+
+        if full:
+            heapq.heapreplace(heap, entry)
+        else:
+            heapq.heappush(heap, entry)
+
+        if (positions is None and limit is not None and len(heap) == limit
+                and heap[0][:2] == (-TIER_EXACT, 0)):
+            break
+
+    return [entry[4] for entry in sorted(heap, reverse=True)]
+
+
+# Раскладка: латинская клавиша → русская буква на той же клавише (ЙЦУКЕН)
+LATIN_LAYOUT = "qwertyuiop[]asdfghjkl;'zxcvbnm,.`"
+CYRILLIC_LAYOUT = "йцукенгшщзхъфывапролджэячсмитьбюё"
+LAYOUT_TABLE = str.maketrans(LATIN_LAYOUT, CYRILLIC_LAYOUT)
+
+# Нечеткий поиск: максимальное расстояние правки и длина индексируемого префикса
+FUZZY_MAX_DISTANCE = 2
+FUZZY_PREFIX_LENGTH = 7
+FUZZY_RESULTS_LIMIT = 5
+FUZZY_MIN_QUERY_LENGTH = 3
+
+
+def normalize_name(text):
+    """Нормализация названия для нечеткого поиска: нижний регистр, ё → е, без лишних пробелов"""
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+def switch_keyboard_layout(text):
+    """Перевод текста, набранного в латинской раскладке, в русскую"""
+    return text.lower().translate(LAYOUT_TABLE)
+
+
+def has_latin_letters(text):
+    """Есть ли в тексте латинские буквы (признак неверной раскладки)"""
+    return any('a' <= char <= 'z' for char in text.lower())
+
+
+def iter_deletes(text, max_distance):
+    """Все строки, получаемые из text удалением не более max_distance символов"""
+    deletes = {text}
+    frontier = {text}
+    for _ in range(max_distance):
+        next_frontier = set()
+        for word in frontier:
+            for i in range(len(word)):
+                next_frontier.add(word[:i] + word[i + 1:])
+        next_frontier -= deletes
+        deletes |= next_frontier
+        frontier = next_frontier
+    return deletes
+
+
+def edit_distance(a, b, max_distance):
+    """Расстояние Дамерау-Левенштейна (с перестановками соседних букв).
+
+    Возвращает max_distance + 1, если расстояние больше max_distance.
+    Считается только полоса |i - j| <= max_distance: ячейки вне ее
+    заведомо больше max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if a == b:
+        return 0
+
+    too_far = max_distance + 1
+    previous_previous = None
+    previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [too_far] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        row_min = current[0]
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost, too_far)
+            if (previous_previous is not None and j > 1 and
+                    a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                value = min(value, previous_previous[j - 2] + 1)
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > max_distance:
+            return too_far
+        previous_previous, previous = previous, current
+
+    return previous[len(b)]
+
+
+class FuzzyIndex:
+    """Словарь удалений (SymSpell) по нормализованным названиям.
+
+    При построении для префикса и для окончания каждого названия сохраняются
+    все варианты с удаленными символами. Запрос порождает такие же варианты
+    своих префикса и окончания; кандидаты - названия, найденные по обоим
+    словарям, и точное расстояние считается только для них. Одного префикса
+    мало: у названий вроде "Новая Б..." он общий у тысяч записей.
+
+    Словари строятся при первом нечетком поиске, а не при загрузке данных:
+    до него большинство версий данных не доживает. Названия в словарях
+    хранятся номерами (array('I')), сами названия - в общем списке name_list.
+    """
+
+    def __init__(self, records, max_distance=FUZZY_MAX_DISTANCE, prefix_length=FUZZY_PREFIX_LENGTH):
+        self.records = records
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.build_lock = threading.Lock()
+        # Нормализованное название → номера записей (None - словари еще не построены)
+        self.names = None
+        # Номер названия → название и обратно. Номера только добавляются,
+        # поэтому копии индекса используют эти структуры совместно
+        self.name_list = None
+        self.name_ids = None
+        # Вариант префикса с удалениями → номера названий
+        self.deletes = None
+        # То же для окончания названия
+        self.suffix_deletes = None
+
+    def _build(self):
+        names = {}
+        for record_id, record in enumerate(self.records):
+            name = normalize_name(record['locality'])
+            ids = names.get(name)
+            if ids is None:
+                names[name] = [record_id]
+            else:
+                ids.append(record_id)
+
+        self.name_list = list(names)
+        self.name_ids = {name: name_id for name_id, name in enumerate(self.name_list)}
+        self.deletes = {}
+        self.suffix_deletes = {}
+        for name_id, name in enumerate(self.name_list):
+            for deletes, part in self._parts(name):
+                for delete in iter_deletes(part, self.max_distance):
+                    name_ids = deletes.get(delete)
+                    if name_ids is None:
+                        deletes[delete] = [name_id]
+                    else:
+                        name_ids.append(name_id)
+
+        for deletes in (self.deletes, self.suffix_deletes):
+            for delete, name_ids in deletes.items():
+                deletes[delete] = array('I', name_ids)
+
+        # Последним: по names другие потоки понимают, что словари готовы
+        self.names = names
+        logger.info(f"Индекс нечеткого поиска построен: {len(names)} названий, "
+                    f"{len(self.deletes) + len(self.suffix_deletes)} вариантов")
+
+    def _ensure_built(self):
+        if self.names is None:
+            with self.build_lock:
+                if self.names is None:
+                    self._build()
+
+    def _parts(self, name):
+        """Префикс и окончание названия вместе с их словарями удалений"""
+        return (self.deletes, name[:self.prefix_length]), (self.suffix_deletes, name[-self.prefix_length:])
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.name_list)
+            self.name_list.append(name)
+        return name_id
+
+    def copy(self, records):
+        """Новая версия индекса для измененных записей.
+
+        Списки и массивы не изменяются на месте, а заменяются новыми,
+        поэтому словари достаточно скопировать поверхностно. Если словари
+        еще не построены, копия построит свои по своим записям.
+        """
+        clone = FuzzyIndex(records, self.max_distance, self.prefix_length)
+        names = self.names
+        if names is not None:
+            clone.name_list = self.name_list
+            clone.name_ids = self.name_ids
+            clone.deletes = dict(self.deletes)
+            clone.suffix_deletes = dict(self.suffix_deletes)
+            clone.names = dict(names)
+        return clone
+
+    def add(self, record_id, key):
+        """Добавление записи с названием key (в нижнем регистре)"""
+        if self.names is None:
+            return
+        name = normalize_name(key)
+        ids = self.names.get(name)
+        if ids is not None:
+            ids = list(ids)
+            insort(ids, record_id)
+            self.names[name] = ids
+            return
+        self.names[name] = [record_id]
+
+        name_id = self._name_id(name)
+        for deletes, part in self._parts(name):
+            for delete in iter_deletes(part, self.max_distance):
+                name_ids = deletes.get(delete)
+                deletes[delete] = array('I', [name_id]) if name_ids is None else name_ids + array('I', [name_id])
+
+    def remove(self, record_id, key):
+        """Удаление записи; key - название, с которым она была добавлена"""
+        if self.names is None:
+            return
+        name = normalize_name(key)
+        ids = [other_id for other_id in self.names.get(name, ()) if other_id != record_id]
+        if ids:
+            self.names[name] = ids
+            return
+        self.names.pop(name, None)
+
+        name_id = self.name_ids[name]
+        for deletes, part in self._parts(name):
+            for delete in iter_deletes(part, self.max_distance):
+                name_ids = array('I', [other for other in deletes.get(delete, ()) if other != name_id])
+                if name_ids:
+                    deletes[delete] = name_ids
+                else:
+                    deletes.pop(delete, None)
+
+    def query_variants(self, query):
+        """Нормализованные варианты запроса (с учетом неверной раскладки)"""
+        variants = [normalize_name(query)]
+        if has_latin_letters(query):
+            variants.append(normalize_name(switch_keyboard_layout(query)))
+        return variants
+
+    def search(self, query, limit=FUZZY_RESULTS_LIMIT, order=None):
+        """Номера записей с ближайшими названиями → [(расстояние, record_id), ...]
+
+        order(record_id) - порядок записей с одинаковым названием (по умолчанию - номер).
+        """
+        self._ensure_built()
+        found = {}
+
+        for variant in self.query_variants(query):
+            if len(variant) < FUZZY_MIN_QUERY_LENGTH:
+                continue
+
+            # Для коротких слов допускаем меньше опечаток
+            max_distance = min(self.max_distance, 1 if len(variant) <= 4 else self.max_distance)
+
+            if variant in self.names:
+                found[variant] = 0
+                continue
+
+            # Кандидат должен быть близок к запросу и началом, и окончанием
+            candidates = None
+            for deletes, part in self._parts(variant):
+                names = set()
+                for delete in iter_deletes(part, max_distance):
+                    names.update(deletes.get(delete, ()))
+                candidates = names if candidates is None else candidates & names
+
+            for name_id in candidates:
+                name = self.name_list[name_id]
+                distance = edit_distance(variant, name, max_distance)
+                if distance <= max_distance and distance < found.get(name, max_distance + 1):
+                    found[name] = distance
+
+        best = sorted(found.items(), key=lambda item: (item[1], item[0]))[:limit]
+        return [(distance, record_id) for name, distance in best
+                for record_id in (sorted(self.names[name], key=order) if order else self.names[name])]
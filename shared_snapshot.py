@@ -0,0 +1,214 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from records import RECORD_FIELDS, Record, record_values
+
+logger = logging.getLogger(__name__)
+
+SHARED_SNAPSHOT_MAGIC = b'KICSNAP2'
+# Начало файла: сигнатура и длина JSON-заголовка, дальше заголовок и секции-массивы
+PREFIX = struct.Struct('<8sQ')
+# Выравнивание секций, чтобы массивы можно было читать прямо из отображенной памяти
+SECTION_ALIGN = 8
+
+
+def _align(offset):
+    return (offset + SECTION_ALIGN - 1) // SECTION_ALIGN * SECTION_ALIGN
+
+
+def write_shared_snapshot(path, cache, version, meta=None):
+    """Запись записей и индексов в общий файл снимка (атомарно).
+
+    Все строки лежат одной таблицей, а записи, списки триграмм, порядок
+    префиксного индекса и коды КИЦ - массивами номеров. Такой файл
+    процессы отображают в память только для чтения и не разбирают заново.
+    """
+    string_ids = {}
+    strings = []
+
+    def string_id(value):
+        sid = string_ids.get(value)
+        if sid is None:
+            sid = string_ids[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    records = array('I')
+    for record in cache['all_records']:
+        records.extend(string_id(value) for value in record_values(record))
+
+    trigram = cache['trigram_index']
+    grams = sorted(trigram.postings)
+    gram_ids = array('I', (string_id(gram) for gram in grams))
+    gram_offsets = array('I', [0])
+    postings = array('I')
+    for gram in grams:
+        postings.extend(trigram.postings[gram])
+        gram_offsets.append(len(postings))
+
+    encoded = [value.encode('utf-8') for value in strings]
+    string_offsets = array('I', [0])
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+
+    kic_index = cache['kic_index']
+    sections = [
+        ('strings', 'B', b''.join(encoded)),
+        ('string_offsets', 'I', string_offsets),
+        ('records', 'I', records),
+        ('trigram_grams', 'I', gram_ids),
+        ('trigram_offsets', 'I', gram_offsets),
+        ('trigram_postings', 'I', postings),
+        ('prefix_ids', 'I', array('I', cache['prefix_index'].ids)),
+        ('kic_codes', 'Q', array('Q', kic_index.codes)),
+        ('kic_ids', 'I', array('I', kic_index.ids)),
+    ]
+    if cache.get('positions') is not None:
+        # Номера записей не совпадают с порядком строк таблицы (после изменений по месту)
+        sections.append(('positions', 'I', array('I', cache['positions'])))
+
+    layout = {}
+    offset = 0
+    for name, typecode, data in sections:
+        offset = _align(offset)
+        size = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        layout[name] = [typecode, offset, size]
+        offset += size
+
+    header = json.dumps({
+        **(meta or {}),
+        'version': version,
+        'byteorder': sys.byteorder,
+        'fields': RECORD_FIELDS,
+        'record_count': len(cache['all_records']),
+        'kic_branch_widths': sorted(kic_index.branch_widths),
+        'sections': layout,
+    }, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(PREFIX.pack(SHARED_SNAPSHOT_MAGIC, len(header)))
+            f.write(header)
+            data_start = _align(PREFIX.size + len(header))
+            for name, typecode, data in sections:
+                f.write(b'\0' * (data_start + layout[name][1] - f.tell()))
+                f.write(data if isinstance(data, bytes) else data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SharedSnapshot:
+    """Общий снимок, отображенный в память только для чтения.
+
+    Массивы (записи, списки триграмм, порядок префиксного индекса, коды КИЦ)
+    читаются прямо из страниц файла, общих для всех процессов; в памяти
+    процесса создаются только строки (по одной на уникальное значение).
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_size)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, header_size = PREFIX.unpack_from(self.map, 0)
+        if magic != SHARED_SNAPSHOT_MAGIC:
+            raise ValueError(f"Неизвестный формат общего снимка: {magic!r}")
+
+        self.header = json.loads(self.map[PREFIX.size:PREFIX.size + header_size].decode('utf-8'))
+        if self.header['byteorder'] != sys.byteorder or list(self.header['fields']) != list(RECORD_FIELDS):
+            raise ValueError("Общий снимок записан в несовместимом формате")
+
+        self.version = self.header['version']
+        data_start = _align(PREFIX.size + header_size)
+        view = memoryview(self.map)
+        self.sections = {}
+        for name, (typecode, offset, size) in self.header['sections'].items():
+            start = data_start + offset
+            self.sections[name] = view[start:start + size].cast(typecode)
+
+        self._strings = None
+
+    @property
+    def strings(self):
+        """Таблица строк (декодируется один раз)"""
+        if self._strings is None:
+            blob = self.sections['strings']
+            offsets = self.sections['string_offsets']
+            self._strings = [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+        return self._strings
+
+    def records(self):
+        """Записи (строки общие с таблицей строк)"""
+        strings = self.strings
+        ids = self.sections['records']
+        width = len(RECORD_FIELDS)
+        return [Record(*[strings[sid] for sid in ids[start:start + width]])
+                for start in range(0, len(ids), width)]
+
+    def trigram_postings(self):
+        """Триграмма → номера записей (срезы отображенного массива, без копирования)"""
+        strings = self.strings
+        grams = self.sections['trigram_grams']
+        offsets = self.sections['trigram_offsets']
+        postings = self.sections['trigram_postings']
+        return {strings[gram_id]: postings[offsets[i]:offsets[i + 1]] for i, gram_id in enumerate(grams)}
+
+
+def read_shared_version(path):
+    """Версия и идентификатор файла общего снимка без его отображения → (version, identity) или None"""
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            magic, header_size = PREFIX.unpack(f.read(PREFIX.size))
+            if magic != SHARED_SNAPSHOT_MAGIC:
+                return None
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        return header['version'], (stat.st_ino, stat.st_size)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+
+class RefreshLock:
+    """Межпроцессная блокировка обновления данных (flock на отдельном файле)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """Попытка взять блокировку без ожидания → True, если взята"""
+        if fcntl is None:
+            return True
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
@@ -0,0 +1,96 @@
+from records import record_values
+
+# Сколько названий из каждой группы изменений показывать в журнале
+CHANGELOG_SAMPLE_SIZE = 5
+
+
+def row_key(record):
+    """Ключ строки: населенный пункт и тип - по нему изменение отличаем от удаления и вставки"""
+    return (record['locality'].lower(), record['type'])
+
+
+class SheetChanges:
+    """Отличия новой выгрузки таблицы от текущих записей"""
+
+    def __init__(self, record_count=0):
+        self.updates = []  # (номер записи, новая запись, позиция в таблице)
+        self.deletes = []  # номера удаленных записей, по убыванию
+        self.inserts = []  # (новая запись, позиция в таблице)
+        self.unchanged = 0
+        # Номер записи → ее позиция среди записей новой выгрузки (для неизменившихся)
+        self.positions = [0] * record_count
+
+    @property
+    def total(self):
+        return len(self.updates) + len(self.deletes) + len(self.inserts)
+
+    def summary(self, old_records, limit=CHANGELOG_SAMPLE_SIZE):
+        """Счетчики и примеры изменений для журнала в /debug"""
+        return {
+            'unchanged': self.unchanged,
+            'inserted': len(self.inserts),
+            'updated': len(self.updates),
+            'deleted': len(self.deletes),
+            'inserted_sample': [record['locality'] for record, _ in self.inserts[:limit]],
+            'updated_sample': [record['locality'] for _, record, _ in self.updates[:limit]],
+            'deleted_sample': [old_records[record_id]['locality'] for record_id in self.deletes[:limit]],
+        }
+
+
+def diff_records(old_records, new_rows, make_record):
+    """Сравнение записей с новой выгрузкой по содержимому строк.
+
+    new_rows - значения полей строк (кортежи, см. row_values). Строки с тем же
+    содержимым остаются как есть (повторы учитываются по количеству), записи
+    создаются через make_record(values) только для остальных; None - строка
+    отбрасывается. Новая и старая строка с одинаковым ключом считаются
+    изменением записи, остальные - вставкой и удалением.
+    Для каждой записи запоминается ее позиция в новой выгрузке: номера
+    записей после изменений не совпадают с порядком строк таблицы.
+    """
+    changes = SheetChanges(len(old_records))
+
+    # Содержимое → номер записи (список номеров, если строка повторяется)
+    old_by_content = {}
+    for record_id, values in enumerate(map(record_values, old_records)):
+        ids = old_by_content.get(values)
+        if ids is None:
+            old_by_content[values] = record_id
+        elif isinstance(ids, list):
+            ids.append(record_id)
+        else:
+            old_by_content[values] = [ids, record_id]
+
+    added = []
+    position = 0
+    for values in new_rows:
+        ids = old_by_content.get(values)
+        if ids is None or ids == []:
+            record = make_record(values)
+            if record is None:
+                continue
+            added.append((record, position))
+        elif isinstance(ids, list):
+            changes.positions[ids.pop(0)] = position
+            changes.unchanged += 1
+        else:
+            old_by_content[values] = []
+            changes.positions[ids] = position
+            changes.unchanged += 1
+        position += 1
+
+    removed_by_key = {}
+    for ids in old_by_content.values():
+        for record_id in (ids if isinstance(ids, list) else (ids,)):
+            removed_by_key.setdefault(row_key(old_records[record_id]), []).append(record_id)
+
+    for record, position in added:
+        ids = removed_by_key.get(row_key(record))
+        if ids:
+            changes.updates.append((ids.pop(), record, position))
+        else:
+            changes.inserts.append((record, position))
+
+    # По убыванию: при удалении на место записи переносится последняя
+    changes.deletes = sorted((record_id for ids in removed_by_key.values() for record_id in ids), reverse=True)
+    return changes
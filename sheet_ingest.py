@@ -0,0 +1,112 @@
+import codecs
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Размер порции при чтении ответа и объем начала файла для определения формата
+INGEST_CHUNK_SIZE = 64 * 1024
+SNIFF_SIZE = 4 * 1024
+
+CSV_DELIMITERS = (',', ';', '\t')
+
+
+def detect_encoding(sample):
+    """Кодировка выгрузки по первым килобайтам: UTF-8 (с BOM или без) или cp1251"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # final=False: последний символ в образце может быть обрезан посередине
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+
+def detect_delimiter(text_sample):
+    """Разделитель CSV - тот из допустимых, что чаще всего встречается в первой строке"""
+    first_line = text_sample.split('\n', 1)[0]
+    counts = {delimiter: first_line.count(delimiter) for delimiter in CSV_DELIMITERS}
+    best = max(CSV_DELIMITERS, key=lambda delimiter: counts[delimiter])
+    return best if counts[best] else ','
+
+
+def read_head(chunks, size=SNIFF_SIZE):
+    """Первые size байт потока → (список прочитанных порций, образец)"""
+    head = []
+    total = 0
+    for chunk in chunks:
+        head.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return head, b''.join(head)
+
+
+def iter_decoded_lines(chunks, encoding):
+    """Строки текста (с '\\n' на конце) из потока байтовых порций.
+
+    Декодирование инкрементальное: в памяти только текущая порция
+    и незаконченная строка, а не весь файл целиком.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    pending = ''
+
+    for chunk in chunks:
+        parts = (pending + decoder.decode(chunk)).split('\n')
+        pending = parts.pop()
+        for part in parts:
+            yield part + '\n'
+
+    tail = pending + decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+class CountingIterator:
+    """Обертка над итератором, считающая выданные элементы"""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        self.count += 1
+        return item
+
+
+def peak_memory_kb():
+    """Пиковый объем памяти процесса (RSS, КБ) или None, если недоступно"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class IngestTimer:
+    """Замер скорости разбора: строки в секунду и пиковая память"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.peak_before = peak_memory_kb()
+
+    def report(self, rows, records, size_bytes, encoding, delimiter, method):
+        seconds = time.perf_counter() - self.started
+        peak_after = peak_memory_kb()
+        return {
+            'method': method,
+            'encoding': encoding,
+            'delimiter': delimiter,
+            'bytes': size_bytes,
+            'rows': rows,
+            'records': records,
+            'seconds': round(seconds, 4),
+            'rows_per_sec': int(rows / seconds) if seconds > 0 else None,
+            'peak_rss_kb': peak_after,
+            'peak_rss_growth_kb': peak_after - self.peak_before if peak_after is not None else None,
+        }
@@ -0,0 +1,32 @@
+import time
+from contextlib import contextmanager
+
+# Момент начала загрузки приложения (модуль импортируется первым)
+STARTED = time.perf_counter()
+
+# Профиль холодного старта (отдается в /debug): время импортов по модулям
+# и первые события процесса - готовность модуля, первый ответ, первая загрузка данных
+profile = {
+    'imports_ms': {},
+    'events': {},
+}
+
+
+def since_start_ms():
+    return round((time.perf_counter() - STARTED) * 1000, 1)
+
+
+@contextmanager
+def measure_import(name):
+    """Замер времени импорта группы модулей"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile['imports_ms'][name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def mark(event, **details):
+    """Первое наступление события: время от старта процесса и подробности"""
+    if event not in profile['events']:
+        profile['events'][event] = {'since_start_ms': since_start_ms(), **details}
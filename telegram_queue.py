@@ -0,0 +1,215 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+import queue
+
+from http_client import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram (для склейки сообщений)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать до отправки"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def is_idle(self):
+        """Ведро полное - его можно удалить без потери информации"""
+        with self.lock:
+            elapsed = time.monotonic() - self.updated
+            return self.tokens + elapsed * self.rate >= self.capacity
+
+
+class OutboundDispatcher:
+    """Очередь исходящих вызовов Telegram Bot API с ограничением скорости.
+
+    Сообщения складываются в очереди по чатам, а рабочие потоки забирают
+    чаты из общей очереди готовности. Один чат в каждый момент обслуживает
+    только один поток, поэтому порядок сообщений внутри чата сохраняется.
+    Вызовы без chat_id (answerInlineQuery, answerCallbackQuery) порядка не
+    требуют: каждый получает отдельную очередь и уходит первым свободным потоком.
+    Перед отправкой поток ждет токены из глобального ведра и ведра чата.
+    """
+
+    def __init__(self, send, workers=4, max_size=1000, global_rate=30, chat_rate=1,
+                 chat_burst=3, max_attempts=5, max_retry_after=60):
+        # send(payload) -> requests.Response
+        self.send = send
+        self.workers = workers
+        self.max_size = max_size
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.max_retry_after = max_retry_after
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.pending = {}  # chat_id → deque сообщений
+        self.direct_ids = itertools.count()  # ключи очередей для вызовов без чата
+        self.ready = queue.Queue()  # чаты, у которых есть что отправить
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.threads = []
+        self.stats = {
+            'enqueued': 0,
+            'sent': 0,
+            'merged': 0,
+            'dropped': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+
+    def start(self):
+        """Запуск рабочих потоков (один раз)"""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'telegram-sender-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def enqueue(self, payload):
+        """Постановка вызова в очередь. Возвращает False, если очередь переполнена"""
+        self.start()
+        chat_id = payload.get('chat_id')
+        if chat_id is None:
+            chat_id = ('direct', next(self.direct_ids))
+
+        with self.lock:
+            messages = self.pending.get(chat_id)
+
+            if messages and self._try_merge(messages[-1], payload):
+                self.stats['merged'] += 1
+                return True
+
+            if self.depth >= self.max_size:
+                self.stats['dropped'] += 1
+                logger.warning(f"Очередь отправки переполнена ({self.depth}), сообщение для {chat_id} отброшено")
+                return False
+
+            self.depth += 1
+            self.stats['enqueued'] += 1
+
+            if messages is None:
+                self.pending[chat_id] = deque([payload])
+                self.ready.put(chat_id)
+            else:
+                messages.append(payload)
+
+        return True
+
+    def _try_merge(self, previous, payload):
+        """Склейка подряд идущих сообщений в один чат (пока они не отправлены)"""
+        if previous.get('method') != 'sendMessage' or payload.get('method') != 'sendMessage':
+            return False
+        if previous.get('parse_mode') != payload.get('parse_mode'):
+            return False
+        if previous.get('reply_markup') and previous.get('reply_markup') != payload.get('reply_markup'):
+            return False
+
+        text = f"{previous['text']}\n\n{payload['text']}"
+        if len(text) > TELEGRAM_MESSAGE_LIMIT:
+            return False
+
+        previous['text'] = text
+        if payload.get('reply_markup'):
+            previous['reply_markup'] = payload['reply_markup']
+        return True
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Не даем словарю ведер расти бесконечно
+            if len(self.chat_buckets) > 10000:
+                for key in [key for key, value in self.chat_buckets.items() if value.is_idle()]:
+                    del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _worker(self):
+        while True:
+            chat_id = self.ready.get()
+            try:
+                self._send_next(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка отправки в чат {chat_id}: {e}", exc_info=True)
+            finally:
+                with self.lock:
+                    messages = self.pending.get(chat_id)
+                    if messages:
+                        # В чате есть еще сообщения - в конец очереди, чтобы не задерживать другие чаты
+                        self.ready.put(chat_id)
+                    else:
+                        self.pending.pop(chat_id, None)
+
+    def _send_next(self, chat_id):
+        if not isinstance(chat_id, tuple):
+            with self.lock:
+                bucket = self._chat_bucket(chat_id)
+            time.sleep(bucket.reserve())
+        time.sleep(self.global_bucket.reserve())
+
+        with self.lock:
+            payload = self.pending[chat_id].popleft()
+            self.depth -= 1
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.send(payload)
+            except Exception as e:
+                logger.error(f"Ошибка вызова {payload.get('method')} для {chat_id}: {e}")
+                response = None
+
+            if response is not None and response.status_code == 200:
+                self.stats['sent'] += 1
+                return
+
+            status = response.status_code if response is not None else None
+            retriable = status is None or status == 429 or status >= 500
+            if not retriable or attempt == self.max_attempts:
+                break
+
+            delay = retry_after_seconds(response) if response is not None else None
+            if delay is None:
+                delay = min(2 ** attempt, self.max_retry_after)
+            if delay > self.max_retry_after:
+                break
+
+            self.stats['retried'] += 1
+            logger.warning(f"Telegram {status} для {chat_id}, повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+        self.stats['failed'] += 1
+        logger.error(f"Не удалось доставить {payload.get('method')} в чат {chat_id}")
+
+    def get_stats(self):
+        """Счетчики для /debug"""
+        with self.lock:
+            return {
+                'queue_depth': self.depth,
+                'chats_pending': len(self.pending),
+                'workers': len(self.threads),
+                **self.stats
+            }
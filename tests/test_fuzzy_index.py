@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import FuzzyIndex
+
+NAMES = ['Октябрьское', 'Октябрьский', 'Новая Березовка', 'Новая Берёзовка', 'Сосновка', 'Салехард']
+
+
+def make_records(names):
+    return [{'locality': name} for name in names]
+
+
+class FuzzyIndexTest(unittest.TestCase):
+    """Словари удалений строятся при первом поиске и переживают копирование"""
+
+    def test_built_on_first_search(self):
+        index = FuzzyIndex(make_records(NAMES))
+        self.assertIsNone(index.names)
+        self.assertEqual(index.search('Октябрьскоее'), [(1, 0)])
+        self.assertEqual(index.search('Новая Березвка'), [(1, 2), (1, 3)])
+        self.assertIsNotNone(index.names)
+
+    def test_copy_before_build_uses_own_records(self):
+        index = FuzzyIndex(make_records(NAMES))
+        clone = index.copy(make_records(NAMES[:4] + ['Сосновка 2']))
+        clone.add(4, 'сосновка 2')
+        self.assertEqual(clone.search('Сосновкаа'), [(2, 4)])
+        self.assertEqual(index.search('Сосновкаа'), [(1, 4)])
+
+    def test_copy_after_build_keeps_original(self):
+        records = make_records(NAMES)
+        index = FuzzyIndex(records)
+        index.search('Салехард')
+
+        clone_records = list(records)
+        clone = index.copy(clone_records)
+        clone.remove(5, 'салехард')
+        clone_records[5] = {'locality': 'Салехардск'}
+        clone.add(5, 'салехардск')
+
+        self.assertEqual(clone.search('Салехардк'), [(1, 5)])
+        self.assertEqual(index.search('Салехардк'), [(1, 5)])
+        self.assertEqual(index.search('Салехардскк'), [])
+        self.assertEqual(clone.search('Салехардскк'), [(1, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client
+
+
+def closed_port():
+    """Порт, на котором никто не слушает (соединение будет отклонено)"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PostRetryTest(unittest.TestCase):
+    """POST повторяется, только если запрос до сервера не дошел"""
+
+    def setUp(self):
+        self.original_backoff = http_client.HTTP_BACKOFF_BASE
+        http_client.HTTP_BACKOFF_BASE = 0.01
+        http_client.http_stats.clear()
+        http_client.get_session()
+
+    def tearDown(self):
+        http_client.HTTP_BACKOFF_BASE = self.original_backoff
+
+    def test_refused_connection_is_retried(self):
+        with self.assertRaises(http_client.requests.exceptions.ConnectionError):
+            http_client.post(f"http://127.0.0.1:{closed_port()}/sendMessage", json={}, retries=2)
+        self.assertEqual(http_client.http_stats['127.0.0.1']['retries'], 2)
+
+    def test_reset_after_sending_is_not_retried(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+
+        def serve():
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except OSError:
+                    return
+                connection.recv(65536)
+                # Закрытие с RST: клиент получит сброс соединения после отправки запроса
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                connection.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        with self.assertRaises(http_client.requests.exceptions.ConnectionError) as raised:
+            http_client.post(f"http://127.0.0.1:{server.getsockname()[1]}/sendMessage", json={}, retries=2)
+        self.assertFalse(http_client.is_connect_error(raised.exception))
+        self.assertEqual(http_client.http_stats['127.0.0.1']['retries'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SNAPSHOT_PATH'] = ''
+
+import app
+import benchmark
+from records import RECORD_FIELDS
+from rendering import record_body_key
+
+QUERIES = ['ка', 'ово', 'новая', 'берёз', 'березовкаа', 'ключ', 'яр', 'светл']
+KIC_QUERIES = ['8598/', '8598/00', '8369', '8647/0001-0020']
+
+
+def sheet_rows(count, seed):
+    """Строки синтетической таблицы в виде словарей, с повторами названий"""
+    rows = [dict(zip(RECORD_FIELDS, row)) for row in benchmark.generate_rows(count, seed)[1:]]
+    rng = random.Random(seed)
+    for _ in range(count // 10):
+        # Тот же населенный пункт в другом КИЦ или с другим адресом
+        row = dict(rng.choice(rows), address=f"ул. Новая, {rng.randint(1, 99)}")
+        rows.insert(rng.randrange(len(rows)), row)
+    return rows
+
+
+def mutate(rows, rng):
+    """Правки таблицы: изменения, удаления, вставки и перестановки строк"""
+    rows = [dict(row) for row in rows]
+    for _ in range(rng.randint(1, 40)):
+        operation = rng.random()
+        index = rng.randrange(len(rows))
+        if operation < 0.3:
+            rows[index]['phone'] = f"8 900 000-{rng.randint(0, 9999):04d}"
+        elif operation < 0.5:
+            del rows[index]
+        elif operation < 0.7:
+            rows.insert(rng.randrange(len(rows)), dict(rows[index], address=f"ул. Мира, {rng.randint(1, 99)}"))
+        elif operation < 0.85:
+            rows.insert(rng.randrange(len(rows)), rows.pop(index))
+        else:
+            rows.append(dict(rows[index], locality=rows[index]['locality'] + ' 2'))
+    return rows
+
+
+def observed(cache):
+    """Все, что видит пользователь, в виде содержимого записей (без их номеров)"""
+    records = cache['all_records']
+    messages = cache['messages']
+
+    def contents(record_ids):
+        return [records[record_id].to_row() for record_id in record_ids]
+
+    result = {
+        'sheet': [record.to_row() for record in app.sheet_records(cache)],
+        'exact': [(key, records[record_id].to_row(), messages.card(record_id))
+                  for key, record_id in cache['locality_map'].items()],
+        'inline': {query: contents(cache['prefix_index'].search(query, 10, order=app.sheet_position_key(cache)))
+                   for query in QUERIES},
+        'fuzzy': {query: contents(record_id for _, record_id in
+                                  cache['fuzzy_index'].search(query, order=app.sheet_position_key(cache)))
+                  for query in QUERIES},
+        'kic': {query: contents(cache['kic_index'].lookup(query, app.sheet_position_key(cache))[0])
+                for query in KIC_QUERIES},
+    }
+    for limit in (None, 5):
+        result[f"search_{limit}"] = {
+            query: contents(app.find_all_match_ids(records, query, cache['trigram_index'], cache['prefix_index'],
+                                                   limit, cache['positions']))
+            for query in QUERIES
+        }
+    return result
+
+
+class IncrementalReloadTest(unittest.TestCase):
+    """Перезагрузка по изменениям дает то же, что полная сборка по тем же строкам"""
+
+    def setUp(self):
+        self.original = (app.INCREMENTAL_RELOAD, app.INCREMENTAL_MAX_CHANGE_RATIO, app.data_cache)
+        app.INCREMENTAL_RELOAD = True
+        app.INCREMENTAL_MAX_CHANGE_RATIO = 1.0
+
+    def tearDown(self):
+        app.INCREMENTAL_RELOAD, app.INCREMENTAL_MAX_CHANGE_RATIO, app.data_cache = self.original
+
+    def test_reloads_match_full_build(self):
+        rng = random.Random(7)
+        rows = sheet_rows(1500, 3)
+        app.data_cache = app.build_data_cache(rows, 0)
+
+        for reload_number in range(15):
+            rows = mutate(rows, rng)
+            cache = app.reload_data_cache(rows, reload_number + 1)
+            self.assertEqual(app.reload_changelog[0]['mode'], 'incremental')
+            full = app.build_data_cache(rows, reload_number + 1)
+            self.assertEqual(observed(cache), observed(full), f"перезагрузка {reload_number + 1}")
+            app.data_cache = cache
+
+    def test_unused_rendered_parts_are_dropped(self):
+        rows = sheet_rows(500, 4)
+        app.data_cache = app.build_data_cache(rows, 0)
+        for reload_number in range(30):
+            rows = [dict(row, phone=f"8 900 {reload_number:03d}-00-00") if index % 5 == 0 else row
+                    for index, row in enumerate(rows)]
+            app.data_cache = app.reload_data_cache(rows, reload_number + 1)
+
+        messages = app.data_cache['messages']
+        used = {record_body_key(record) for record in app.data_cache['all_records']}
+        self.assertLessEqual(len(messages.body_memo), len(used) * 1.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
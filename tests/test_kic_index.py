@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kic_index import KicIndex
+
+# Номера отделений разной длины, как в реальной таблице ("8369/018" и "8598/0496")
+KIC_TEXTS = [
+    'ДО №8369/018 КИЦ Новоуренгойский',
+    'ДО №8369/0180 КИЦ А',
+    'ДО №8369/0185 КИЦ Б',
+    'ДО №8369/086 КИЦ Салехардский',
+    'ДО №8598/0496 КИЦ В',
+    'ДО №8598/0400 КИЦ Г',
+    'ДО №8598/0500 КИЦ Д',
+    'ДО №8598/049 КИЦ Е',
+    'ДО №8647/0001 КИЦ Ж',
+]
+
+
+def make_index(texts):
+    return KicIndex([{'kic': text} for text in texts])
+
+
+class KicIndexMixedWidthTest(unittest.TestCase):
+    """Коды с номерами отделений разной длины не смешиваются"""
+
+    def setUp(self):
+        self.index = make_index(KIC_TEXTS)
+
+    def lookup(self, text):
+        record_ids, _ = self.index.lookup(text)
+        return sorted(record_ids)
+
+    def test_exact_code_keeps_leading_zeros(self):
+        self.assertEqual(self.lookup('8369/018'), [0])
+        self.assertEqual(self.lookup('8369/0180'), [1])
+        self.assertEqual(self.lookup('8598/0496'), [4])
+        self.assertEqual(self.lookup('8598/049'), [7])
+
+    def test_code_of_other_width_is_not_found(self):
+        self.assertEqual(self.lookup('8598/496'), [])
+        self.assertEqual(self.lookup('8369/00018'), [])
+
+    def test_prefix_shorter_than_every_width(self):
+        self.assertEqual(self.lookup('8369/01'), [0, 1, 2])
+        self.assertEqual(self.lookup('8598/04'), [4, 5, 7])
+        self.assertEqual(self.lookup('8598/'), [4, 5, 6, 7])
+
+    def test_range_compares_branch_numbers(self):
+        self.assertEqual(self.lookup('8598/0400-0499'), [4, 5])
+        self.assertEqual(self.lookup('8369/0100-8598/0400'), [1, 2, 5, 7])
+
+    def test_unique_codes_count_widths_separately(self):
+        self.assertEqual(len(make_index(['№8598/0496', '№8598/496', '№8598/0496'])), 2)
+
+    def test_add_and_remove_keep_width(self):
+        index = make_index(KIC_TEXTS)
+        index.remove(1, KIC_TEXTS[1])
+        index.add(1, 'ДО №8369/18 КИЦ З')
+        self.assertEqual(sorted(index.lookup('8369/018')[0]), [0])
+        self.assertEqual(sorted(index.lookup('8369/18')[0]), [1])
+        self.assertEqual(sorted(index.lookup('8369/')[0]), [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
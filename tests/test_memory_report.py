@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SNAPSHOT_PATH'] = ''
+
+import app
+import benchmark
+
+
+class MemoryReportTest(unittest.TestCase):
+    """Отчет о памяти считается один раз на версию данных и не меняет кэш"""
+
+    def setUp(self):
+        self.original = app.data_cache
+        rows = app.parse_csv_simple(benchmark.rows_to_csv(benchmark.generate_rows(300, 5)))
+        app.data_cache = app.build_data_cache(rows, 0)
+
+    def tearDown(self):
+        app.data_cache = self.original
+
+    def test_installed_cache_is_not_changed(self):
+        keys = set(app.data_cache)
+        report = app.get_memory_report()
+        self.assertEqual(set(app.data_cache), keys)
+        self.assertIs(app.get_memory_report(), report)
+
+    def test_new_version_gets_new_report(self):
+        report = app.get_memory_report()
+        app.data_cache = app.reload_data_cache(app.sheet_records(app.data_cache)[:-1], 1)
+        self.assertIsNot(app.get_memory_report(), report)
+        self.assertEqual(len(app.memory_reports), 1)
+
+    def test_report_includes_fuzzy_index_once_built(self):
+        before = app.get_memory_report()['indexes_bytes']['fuzzy_index']
+        app.data_cache['fuzzy_index'].search('Октябрьскоее')
+        self.assertGreater(app.get_memory_report()['indexes_bytes']['fuzzy_index'], before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SNAPSHOT_PATH'] = ''
+
+import app
+import benchmark
+from shared_snapshot import RefreshLock, write_shared_snapshot
+
+ROWS = app.parse_csv_simple(benchmark.rows_to_csv(benchmark.generate_rows(200, 2)))
+
+
+class SharedColdStartTest(unittest.TestCase):
+    """Процесс без данных, пока таблицу загружает другой процесс (блокировка занята)"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'shared.bin')
+        self.original = (app.SHARED_SNAPSHOT_PATH, app.shared_refresh_lock, app.SHARED_SNAPSHOT_WAIT,
+                         app.DATA_SOURCE_LOADERS['csv'], app.data_cache, dict(app.shared_state))
+        app.SHARED_SNAPSHOT_PATH = self.path
+        app.shared_refresh_lock = RefreshLock(f"{self.path}.lock")
+        app.SHARED_SNAPSHOT_WAIT = 2
+        app.DATA_SOURCE_LOADERS['csv'] = lambda conditional=False: ROWS
+        app.data_cache = None
+        app.shared_state.update(version=None, identity=None, checked_at=0)
+
+        # Блокировку держит "другой процесс" - отдельный открытый файл
+        self.holder = open(f"{self.path}.lock", 'a+')
+        fcntl.flock(self.holder.fileno(), fcntl.LOCK_EX)
+
+    def tearDown(self):
+        self.holder.close()
+        (app.SHARED_SNAPSHOT_PATH, app.shared_refresh_lock, app.SHARED_SNAPSHOT_WAIT,
+         app.DATA_SOURCE_LOADERS['csv'], app.data_cache, shared_state) = self.original
+        app.shared_state.update(shared_state)
+        self.directory.cleanup()
+
+    def release_later(self, publish):
+        def release():
+            time.sleep(0.3)
+            if publish:
+                cache = app.build_data_cache(ROWS, time.time())
+                write_shared_snapshot(self.path, cache, 1, {'saved_at': time.time(), 'raw_count': len(ROWS)})
+            self.holder.close()
+
+        threading.Thread(target=release, daemon=True).start()
+
+    def test_waits_for_published_snapshot(self):
+        self.release_later(publish=True)
+        snapshot = app.get_snapshot()
+        self.assertEqual(snapshot['source'], 'shared_snapshot')
+        self.assertEqual(len(snapshot['all_records']), len(ROWS))
+
+    def test_loads_itself_when_holder_publishes_nothing(self):
+        self.release_later(publish=False)
+        snapshot = app.get_snapshot()
+        self.assertEqual(snapshot['source'], 'google_sheets')
+        self.assertEqual(len(snapshot['all_records']), len(ROWS))
+
+    def test_empty_data_after_timeout(self):
+        app.SHARED_SNAPSHOT_WAIT = 0.3
+        snapshot = app.get_snapshot()
+        self.assertEqual(snapshot['source'], 'empty')
+
+        response = app.app.test_client().post('/webhook', json={
+            'update_id': 1,
+            'message': {'message_id': 1, 'chat': {'id': 1}, 'text': 'Салехард'},
+        })
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
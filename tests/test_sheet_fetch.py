@@ -0,0 +1,95 @@
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SNAPSHOT_PATH'] = ''
+
+import app
+import benchmark
+
+ROWS = benchmark.generate_rows(50, 1)
+CSV_BODY = benchmark.rows_to_csv(ROWS).encode('utf-8')
+ETAG = '"sheet-v1"'
+
+
+class SheetHandler(BaseHTTPRequestHandler):
+    """Выгрузка CSV порциями (Transfer-Encoding: chunked), как у Google Sheets"""
+
+    honour_etag = True
+
+    def do_GET(self):
+        if self.honour_etag and self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('ETag', ETAG)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(CSV_BODY), 1000):
+            chunk = CSV_BODY[start:start + 1000]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class SheetFetchTest(unittest.TestCase):
+    """get_google_sheet_data на настоящем потоковом HTTP-ответе"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SheetHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.original_url = app.PUBLIC_SHEET_URL
+        app.PUBLIC_SHEET_URL = f"http://127.0.0.1:{cls.server.server_port}/export?format=csv"
+
+    @classmethod
+    def tearDownClass(cls):
+        app.PUBLIC_SHEET_URL = cls.original_url
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        SheetHandler.honour_etag = True
+        for key in app.sheet_validators:
+            app.sheet_validators[key] = None
+
+    def test_full_download_is_parsed(self):
+        records = app.get_google_sheet_data()
+        self.assertEqual(len(records), len(ROWS) - 1)
+        self.assertEqual(records[0]['locality'], ROWS[1][0])
+        self.assertEqual(app.sheet_validators['etag'], ETAG)
+        self.assertIsNotNone(app.sheet_validators['content_hash'])
+
+    def test_not_modified_by_etag(self):
+        app.get_google_sheet_data()
+        self.assertIs(app.get_google_sheet_data(conditional=True), app.SHEET_NOT_MODIFIED)
+
+    def test_not_modified_by_content_hash(self):
+        app.get_google_sheet_data()
+        SheetHandler.honour_etag = False
+        self.assertIs(app.get_google_sheet_data(conditional=True), app.SHEET_NOT_MODIFIED)
+
+    def test_changed_content_is_parsed_after_hash_check(self):
+        app.get_google_sheet_data()
+        SheetHandler.honour_etag = False
+        app.sheet_validators['content_hash'] = 'outdated'
+        records = app.get_google_sheet_data(conditional=True)
+        self.assertEqual(len(records), len(ROWS) - 1)
+
+    def test_cold_start_loads_sheet(self):
+        app.data_cache = None
+        snapshot = app.get_snapshot()
+        self.assertEqual(snapshot['source'], 'google_sheets')
+        self.assertEqual(len(snapshot['all_records']), len(ROWS) - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Пауза после ошибки getUpdates растет до этого значения (секунды)
+POLL_MAX_BACKOFF = 30
+
+
+def update_chat_key(update):
+    """Чат, к которому относится обновление (для сохранения порядка внутри чата)"""
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        item = update.get(kind)
+        if item:
+            chat = item.get('chat') or (item.get('message') or {}).get('chat')
+            if chat:
+                return chat['id']
+            if item.get('from'):
+                return item['from']['id']
+    return None
+
+
+class UpdatePoller:
+    """Получение обновлений через getUpdates (long polling) и их обработка пулом потоков.
+
+    Пачка обновлений раскладывается по чатам: чаты обрабатываются
+    параллельно, а обновления одного чата - по очереди в одном потоке.
+    Следующий getUpdates со сдвинутым offset (он и подтверждает пачку
+    для Telegram) запрашивается только после обработки всей пачки, поэтому
+    при остановке процесса необработанные обновления не теряются.
+    """
+
+    def __init__(self, fetch, handle, workers=8, limit=100, timeout=25):
+        # fetch(offset, limit, timeout) -> список обновлений, handle(update) - обработка одного
+        self.fetch = fetch
+        self.handle = handle
+        self.workers = workers
+        self.limit = limit
+        self.timeout = timeout
+
+        self.offset = None
+        self.executor = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {
+            'polls': 0,
+            'poll_errors': 0,
+            'received': 0,
+            'handled': 0,
+            'failed': 0,
+            'last_batch_size': 0,
+            'last_batch_ms': None,
+        }
+
+    def run(self):
+        """Цикл опроса до вызова stop()"""
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='update-worker')
+        errors = 0
+        logger.info(f"Long polling запущен: {self.workers} потоков, пачка до {self.limit}")
+        try:
+            while not self.stopped.is_set():
+                try:
+                    self.poll_once()
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    self.stats['poll_errors'] += 1
+                    delay = min(2 ** errors, POLL_MAX_BACKOFF)
+                    logger.error(f"Ошибка getUpdates: {e}, повтор через {delay} с")
+                    self.stopped.wait(delay)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.acknowledge()
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll_once(self):
+        """Одна пачка: получение и обработка. Возвращает число обновлений"""
+        updates = self.fetch(self.offset, self.limit, self.timeout)
+        self.stats['polls'] += 1
+        if not updates:
+            return 0
+
+        started = time.perf_counter()
+        self.process(updates)
+        self.offset = max(update['update_id'] for update in updates) + 1
+
+        self.stats['received'] += len(updates)
+        self.stats['last_batch_size'] = len(updates)
+        self.stats['last_batch_ms'] = int((time.perf_counter() - started) * 1000)
+        return len(updates)
+
+    def process(self, updates):
+        """Обработка пачки с сохранением порядка внутри каждого чата"""
+        by_chat = {}
+        for update in sorted(updates, key=lambda update: update['update_id']):
+            by_chat.setdefault(update_chat_key(update), []).append(update)
+
+        if self.executor is None or len(by_chat) == 1:
+            for chat_updates in by_chat.values():
+                self._handle_chat(chat_updates)
+            return
+
+        wait([self.executor.submit(self._handle_chat, chat_updates) for chat_updates in by_chat.values()])
+
+    def _handle_chat(self, updates):
+        for update in updates:
+            try:
+                self.handle(update)
+                result = 'handled'
+            except Exception as e:
+                # Ошибочное обновление не повторяем, иначе оно заблокирует очередь
+                logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}", exc_info=True)
+                result = 'failed'
+            with self.lock:
+                self.stats[result] += 1
+
+    def acknowledge(self):
+        """Подтверждение обработанных обновлений при остановке"""
+        if self.offset is None:
+            return
+        try:
+            # Обновления подтверждаются запросом со сдвинутым offset; полученное здесь не обработано
+            # и не подтверждено, Telegram отдаст его снова
+            self.fetch(self.offset, 1, 0)
+        except Exception as e:
+            logger.warning(f"Не удалось подтвердить обновления до {self.offset}: {e}")
+
+    def get_stats(self):
+        """Счетчики для /debug"""
+        with self.lock:
+            return {'offset': self.offset, 'workers': self.workers, **self.stats}